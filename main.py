@@ -1,7 +1,9 @@
 #!/usr/bin/env python
 
+import functools
 import html
 import json
+import os
 import tempfile
 import traceback
 import typing as t
@@ -18,34 +20,104 @@ from telegram.ext import (
     filters,
 )
 
-from src import utils, config, memory, agent, audio2text
-
+from src import (
+    utils,
+    config,
+    memory,
+    agent,
+    audio2text,
+    hot_reload,
+    tenant,
+    http_client,
+    wal,
+    tracing,
+    profiler,
+    media_group,
+    runs,
+    scheduler,
+)
+from src.progress import ProgressRenderer
 
 logger = utils.init_logger()
 
+MAX_DAILY_KCAL = 10000  # 超过这个值的每日限额视为输入错误
+
 
 async def short_memory(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Send a message when the command /start is issued."""
     assert update.message is not None
-    if update.message.chat_id != config.app.admin_chat_id:
+    if not tenant.is_allowed(update.message.chat_id):
         await update.message.reply_text("无权限")
         return
 
+    with tenant.use(update.message.chat_id):
+        mem = memory.get_short_memory()
     lines = []
-    lines.append(f"当前短期记忆数量: {len(memory._short_memory)}")
-    if memory._short_memory:
+    lines.append(f"当前短期记忆数量: {len(mem)}")
+    if mem:
         lines.append("最新的短期记忆:")
-        text = json.dumps(memory._short_memory[-1], ensure_ascii=False, indent=2)
+        text = json.dumps(mem[-1], ensure_ascii=False, indent=2)
         lines.append(text)
     await update.message.reply_text("\n".join(lines))
 
 
+async def daily_kcal(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """查看或设置每日热量摄入限额: /daily_kcal [千卡]"""
+    assert update.message is not None
+    chat_id = update.message.chat_id
+    if not tenant.is_allowed(chat_id):
+        await update.message.reply_text("无权限")
+        return
+
+    if context.args:
+        try:
+            kcal = int(context.args[0])
+        except ValueError:
+            kcal = 0
+        if not 0 < kcal <= MAX_DAILY_KCAL:
+            await update.message.reply_text(
+                f"用法: /daily_kcal [千卡]，千卡为1到{MAX_DAILY_KCAL}之间的整数"
+            )
+            return
+        tenant.set_daily_diet_kcal(kcal, chat_id)
+    await update.message.reply_text(
+        f"每日热量摄入限额: {tenant.daily_diet_kcal(chat_id)}千卡"
+    )
+
+
+async def profile(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """管理员命令: /profile [秒]，对运行中的bot采样分析，返回热点函数和折叠栈文件"""
+    assert update.message is not None
+    if update.message.chat_id != config.app.admin_chat_id:
+        await update.message.reply_text("无权限")
+        return
+
+    try:
+        seconds = float(context.args[0]) if context.args else 30
+    except ValueError:
+        await update.message.reply_text("用法: /profile [秒]")
+        return
+    seconds = max(1, min(seconds, profiler.MAX_SECONDS))
+    if profiler.active():
+        await update.message.reply_text("已经在分析中")
+        return
+    await update.message.reply_text(f"开始分析，{seconds:g}秒后返回结果")
+    prof = await profiler.profile(seconds)
+    path = await asyncio.to_thread(prof.dump)
+    await update.message.reply_text(prof.report())
+    with open(path, "rb") as f:
+        await update.message.reply_document(f, filename=os.path.basename(path))
+
+
 async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Send a message when the command /help is issued."""
     assert update.message is not None
     lines = []
     lines.append(f"当前chat id: {update.message.chat_id}")
     lines.append(f"查看短期记忆: /short_memory")
+    lines.append(f"查看或设置每日热量限额: /daily_kcal [千卡]")
+    if update.message.chat_id == config.app.admin_chat_id:
+        lines.append(f"采样分析运行中的bot: /profile [秒]")
     lines.append(f"该bot可以管理食物、记录饮食和热量、查询食物的营养成分等")
     await update.message.reply_text("\n".join(lines))
 
@@ -53,45 +125,88 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
 async def process_audio(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     message = update.message
     assert message is not None
-    logger.info(f"audio: {message.to_json()}")
-    if message.voice:
-        file = await message.voice.get_file()
-        with tempfile.NamedTemporaryFile(suffix=".ogg") as f:
-            await file.download_to_drive(f.name)
-            text = audio2text.qwen_asr(f.name)
-    else:
-        raise NotImplementedError("audio type not supported")
-    await message.reply_text("识别结果: " + text)
-
-    await run_agent(message.chat, update.get_bot(), text, b"")
+    if not tenant.is_allowed(message.chat_id):
+        await message.reply_text("无权限")
+        return
+    with tracing.trace("process_audio", chat_id=message.chat_id):
+        logger.info(f"audio: {message.to_json()}")
+        if message.voice:
+            file = await message.voice.get_file()
+            with tempfile.NamedTemporaryFile(suffix=".ogg") as f:
+                with tracing.span("download audio", "telegram"):
+                    await file.download_to_drive(f.name)
+                with tracing.span("asr", "asr"):
+                    text = audio2text.qwen_asr(f.name)
+        else:
+            raise NotImplementedError("audio type not supported")
+        await message.reply_text("识别结果: " + text)
+
+        with tenant.use(message.chat_id):
+            await run_agent(message.chat, update.get_bot(), text, b"")
 
 
 async def process_text(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Echo the user message."""
     message = update.message
     assert message is not None
-    if message.chat_id != config.app.admin_chat_id:
+    if not tenant.is_allowed(message.chat_id):
         await message.reply_text("无权限")
         return
-    logger.info(f"message: {message.to_json()}")
-
-    # 解析消息
-    text = message.text if message.text else ""
-    img_bytes = b""
-    if message.photo:
-        photo = message.photo[-1]
-        file = await update.get_bot().get_file(photo.file_id)
-        logger.info(f"photo: {file.to_json()}")
-        img_bytes = await file.download_as_bytearray()
-        if message.caption:
-            text += "\n" + message.caption
-
-    await run_agent(message.chat, update.get_bot(), text, img_bytes)
+    with tracing.trace("process_text", chat_id=message.chat_id):
+        logger.info(f"message: {message.to_json()}")
+
+        # 解析消息
+        text = message.text if message.text else ""
+        img: t.Union[bytes, t.Awaitable[bytes], t.List[t.Awaitable[bytes]]] = b""
+        if message.photo:
+            photo = message.photo[-1]
+
+            async def download() -> bytes:
+                with tracing.span("download photo", "telegram") as sp:
+                    file = await update.get_bot().get_file(photo.file_id)
+                    logger.info(f"photo: {file.to_json()}")
+                    data = bytes(await file.download_as_bytearray())
+                    sp.set(bytes=len(data))
+                    return data
+
+            # 图片在后台下载，和agent的其他准备工作并行
+            img = asyncio.create_task(download())
+            if message.caption:
+                text += "\n" + message.caption
+            if message.media_group_id:
+                # 相册中的图片合并为一次agent运行
+                with tracing.span("album window", "telegram") as sp:
+                    album = await media_group.collect(
+                        message.chat_id,
+                        message.media_group_id,
+                        img,
+                        message.caption or "",
+                    )
+                    sp.set(photos=len(album.photos) if album else 0)
+                if album is None:
+                    return
+                img = album.photos
+                text = "\n".join(album.captions)
+
+        with tenant.use(message.chat_id):
+            await run_agent(message.chat, update.get_bot(), text, img)
 
 
 async def run_agent(
-    chat: telegram.Chat, bot: telegram.Bot, text: str, img_bytes: bytes
+    chat: telegram.Chat,
+    bot: telegram.Bot,
+    text: str,
+    img_bytes: t.Union[bytes, t.Awaitable[bytes], t.List[t.Awaitable[bytes]]],
 ) -> None:
+    """运行agent，同一chat的新消息会取代正在进行的运行"""
+    outcome = await runs.start(
+        chat.id, text, img_bytes, functools.partial(_run_agent, chat, bot)
+    )
+    if outcome == runs.TIMEOUT:
+        await bot.send_message(chat.id, f"处理超时（{runs.RUN_DEADLINE:g}秒），请重试")
+
+
+async def _run_agent(chat: telegram.Chat, bot: telegram.Bot, run: runs.Run) -> None:
     # 工具函数
     async def send_text(text: str, **kwargs) -> telegram.Message:
         for k, v in {
@@ -101,39 +216,56 @@ async def run_agent(
         }.items():
             if k not in kwargs:
                 kwargs[k] = v
-        try:
-            return await bot.send_message(**kwargs)
-        except Exception as e:
-            logger.error(f"send_text error: {e}")
-            kwargs["parse_mode"] = None
-            return await bot.send_message(**kwargs)
+        with tracing.span("send_message", "telegram", bytes=len(text.encode())):
+            try:
+                return await bot.send_message(**kwargs)
+            except Exception as e:
+                logger.error(f"send_text error: {e}")
+                kwargs["parse_mode"] = None
+                return await bot.send_message(**kwargs)
 
     # 定义钩子
-    fcs = []
-    fcm: t.Optional[telegram.Message] = None
-    last_edit_time = 0
+    progress = ProgressRenderer(bot, chat.id)
+
+    calls: t.Dict[str, str] = {}
 
     async def pre_func_call(_id, name, args):
-        nonlocal fcm, fcs, last_edit_time
-        fcs.append(f"调用函数: `{name}`")
-        current_time = asyncio.get_event_loop().time()
-        if not fcm:
-            fcm = await send_text("\n".join(fcs), parse_mode=ParseMode.MARKDOWN_V2)
-            last_edit_time = current_time
-        elif current_time - last_edit_time >= 0.5:
-            logger.info(f"edit text: {fcm.text}")
-            await fcm.edit_text(text="\n".join(fcs), parse_mode=ParseMode.MARKDOWN_V2)
-            last_edit_time = current_time
+        progress.add(f"调用函数: `{name}`")
+        calls[_id] = f"{name}({args})"
+
+    async def post_func_call(_id, name, result, seconds):
+        profiler.note(f"tool {name}", seconds)
+        run.tool_calls.append(f"{calls.pop(_id, name)} -> {str(result)[:100]}")
+
+    async def post_llm_call(iteration, seconds, status, resp_bytes):
+        profiler.note("llm", seconds)
+
+    async def post_explain_jpg(jpg_text: str):
+        run.explained(jpg_text)
 
     async def post_llm_resp(resp: str, short_memory: bool):
         if short_memory:
             resp += "\n*已记录到短期记忆*"
         await send_text(resp)
 
-    hooks = agent.Hooks(pre_func_call=pre_func_call, post_llm_resp=post_llm_resp)
+    hooks = agent.Hooks(
+        pre_func_call=pre_func_call,
+        post_func_call=post_func_call,
+        post_llm_call=post_llm_call,
+        post_llm_resp=post_llm_resp,
+        post_explain_jpg=post_explain_jpg,
+    )
 
     # 运行agent
-    await agent.run_agent(user_text=text, jpg_data=img_bytes, hooks=hooks)
+    try:
+        await agent.run_agent(
+            user_text=run.user_text(),
+            jpg_data=run.images,
+            hooks=hooks,
+            jpg_text=run.jpg_text,
+        )
+    finally:
+        await progress.close()
 
 
 async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -177,24 +309,62 @@ async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE) -> N
         await update.get_bot().send_message(context._chat_id, light_tb)
 
 
-def main() -> None:
-    """Start the bot."""
+async def post_init(application: Application) -> None:
+    # restart_bots.sh 在 git pull 后发送 SIGHUP，热重载配置和工具而不是退出进程
+    hot_reload.install(asyncio.get_running_loop())
+    wal.start_periodic_compaction()
+    scheduler.install(application)
+
+
+async def post_shutdown(application: Application) -> None:
+    scheduler.shutdown()
+    await wal.compact_all()
+    await http_client.close()
+
+
+def build_application(bot: t.Optional[telegram.Bot] = None) -> Application:
+    """创建Application并注册处理函数，bot为None时使用配置中的token（负载测试传入假的bot）"""
     # Create the Application and pass it your bot's token.
-    token = config.app.bot_token
-    application = Application.builder().token(token).build()
+    builder = Application.builder().post_init(post_init).post_shutdown(post_shutdown)
+    if bot is None:
+        builder = builder.token(config.app.bot_token)
+    else:
+        builder = builder.bot(bot).updater(None)
+    application = builder.build()
 
     application.add_error_handler(error_handler)
     application.add_handler(CommandHandler("help", help_command))
     application.add_handler(CommandHandler("short_memory", short_memory))
+    application.add_handler(CommandHandler("daily_kcal", daily_kcal))
+    # 分析期间不阻塞其他消息的处理
+    application.add_handler(CommandHandler("profile", profile, block=False))
 
+    # 消息处理都是非阻塞的：运行期间同一chat的新消息要能取代它，
+    # 相册的第一张图片等待收集窗口时，后续图片的消息也需要被处理
     application.add_handler(
-        MessageHandler(filters.TEXT & ~filters.COMMAND, process_text)
+        MessageHandler(
+            filters.TEXT & ~filters.COMMAND,
+            hot_reload.drain_guard(process_text),
+            block=False,
+        )
     )
-    application.add_handler(MessageHandler(filters.PHOTO, process_text))
     application.add_handler(
-        MessageHandler(filters.AUDIO | filters.VOICE, process_audio)
+        MessageHandler(filters.PHOTO, hot_reload.drain_guard(process_text), block=False)
     )
+    application.add_handler(
+        MessageHandler(
+            filters.AUDIO | filters.VOICE,
+            hot_reload.drain_guard(process_audio),
+            block=False,
+        )
+    )
+
+    return application
 
+
+def main() -> None:
+    """Start the bot."""
+    application = build_application()
     # Run the bot until the user presses Ctrl-C
     application.run_polling(allowed_updates=Update.ALL_TYPES)
 
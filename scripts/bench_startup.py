@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+"""
+启动耗时基准：用 `python -X importtime -c "import main"` 统计导入耗时，
+超过阈值或启动时加载了应当延迟加载的模块时以非0状态退出，用于防止启动变慢。
+
+用法: python scripts/bench_startup.py [--max-ms 250] [--runs 5]
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+import typing as t
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+# 这些模块只应在第一次使用时加载
+LAZY_MODULES = ["dashscope", "aiohttp"]
+
+
+def import_times(module: str) -> t.Dict[str, int]:
+    """返回 {模块名: 累计导入耗时(us)}"""
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=ROOT,
+        capture_output=True,
+        text=True,
+    )
+    if proc.returncode != 0:
+        raise RuntimeError(f"import {module} failed:\n{proc.stderr[-2000:]}")
+    times = {}
+    for line in proc.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:") :].split("|")
+        times[name.strip()] = int(cumulative)
+    return times
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--module", default="main")
+    parser.add_argument("--max-ms", type=float, default=250)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--top", type=int, default=10)
+    args = parser.parse_args()
+
+    totals = []
+    times: t.Dict[str, int] = {}
+    for _ in range(args.runs):
+        times = import_times(args.module)
+        totals.append(times[args.module] / 1000)
+    best = min(totals)
+
+    print(
+        f"import {args.module}: best {best:.1f}ms, runs {[round(x, 1) for x in totals]}"
+    )
+    print("top modules (cumulative):")
+    top = sorted(times.items(), key=lambda x: x[1], reverse=True)[: args.top]
+    for name, us in top:
+        print(f"  {us / 1000:8.1f}ms  {name}")
+
+    failed = False
+    eager = [m for m in LAZY_MODULES if m in times]
+    if eager:
+        print(f"FAIL: modules should be lazily imported: {eager}")
+        failed = True
+    if best > args.max_ms:
+        print(f"FAIL: startup {best:.1f}ms > {args.max_ms}ms")
+        failed = True
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+"""
+记录写入吞吐基准：并发写入时对比预写日志（group commit）和逐行 open/write/fsync。
+
+用法: python scripts/bench_wal.py [--writers 50] [--rows 20]
+"""
+
+import argparse
+import asyncio
+import csv
+import os
+import sys
+import tempfile
+import time
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from src import wal
+
+FIELDS = ["food_name", "amount", "energy_kj", "protein", "fat", "carbs", "datetime"]
+
+
+def _row(i: int) -> dict:
+    return {
+        "food_name": f"食物{i}",
+        "amount": "100g",
+        "energy_kj": 300.0 + i,
+        "protein": 1.0,
+        "fat": 2.0,
+        "carbs": 3.0,
+        "datetime": "2025-01-01 12:00:00",
+    }
+
+
+async def bench_naive(path: str, writers: int, rows: int) -> float:
+    lock = asyncio.Lock()
+
+    async def writer(w: int):
+        for i in range(rows):
+            async with lock:
+                # 和旧实现一样逐行写入，额外加上fsync保证落盘
+                with open(path, "a", newline="") as f:
+                    csv.DictWriter(f, fieldnames=FIELDS).writerow(_row(w * rows + i))
+                    f.flush()
+                    os.fsync(f.fileno())
+            await asyncio.sleep(0)
+
+    begin = time.perf_counter()
+    await asyncio.gather(*[writer(w) for w in range(writers)])
+    return time.perf_counter() - begin
+
+
+async def bench_wal(path: str, writers: int, rows: int) -> float:
+    store = wal.store(path, FIELDS)
+
+    async def writer(w: int):
+        for i in range(rows):
+            await store.append(_row(w * rows + i))
+
+    begin = time.perf_counter()
+    await asyncio.gather(*[writer(w) for w in range(writers)])
+    await store.compact()
+    return time.perf_counter() - begin
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--writers", type=int, default=50)
+    parser.add_argument("--rows", type=int, default=20)
+    args = parser.parse_args()
+    total = args.writers * args.rows
+
+    with tempfile.TemporaryDirectory(dir=".") as tmp:
+        naive = asyncio.run(
+            bench_naive(os.path.join(tmp, "naive.csv"), args.writers, args.rows)
+        )
+        path = os.path.join(tmp, "wal.csv")
+        grouped = asyncio.run(bench_wal(path, args.writers, args.rows))
+        stats = wal.stats()[path]
+        with open(path) as f:
+            assert sum(1 for _ in csv.DictReader(f)) == total
+
+    print(f"{args.writers} writers x {args.rows} rows = {total} rows")
+    print(f"  per-row fsync : {total / naive:10.0f} rows/s ({total} fsyncs)")
+    print(
+        f"  group commit  : {total / grouped:10.0f} rows/s "
+        f"({stats['commits']} commits, {stats['compactions']} compactions)"
+    )
+
+
+if __name__ == "__main__":
+    main()
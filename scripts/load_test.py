@@ -0,0 +1,416 @@
+#!/usr/bin/env python
+"""
+负载测试：为多个chat构造假的 Update（文字、图片、语音），交给 main.py 中注册的真实处理函数，
+逐级增加并发用户数，统计吞吐、响应延迟（p50/p99）、事件循环延迟和峰值内存（RSS）。
+
+- 每个用户是一个chat，处理完一条消息后立即发送下一条（闭环负载）
+- Telegram Bot API 由假的请求层应答（发送、编辑消息，获取和下载文件），可以设置延迟
+- LLM 和 Gemini 由独立线程中的桩服务应答：先返回一次工具调用，再返回文字回复
+- 语音识别替换为同步等待，和真实的 dashscope 调用一样会阻塞事件循环
+- 测试在临时目录中进行，不会读写真实的 .data/ 和 .cache/
+
+用法: python scripts/load_test.py [--levels 1,5,20,50] [--duration 20] [--llm-latency 0.5]
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import resource
+import sys
+import tempfile
+import threading
+import time
+import typing as t
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.append(ROOT)
+
+from telegram.request import BaseRequest
+
+BASE_CHAT_ID = 100000  # 第i个用户的chat id为 BASE_CHAT_ID + i
+LAG_INTERVAL = 0.05  # 测量事件循环延迟的间隔（秒）
+ASR_TEXT = "午饭吃了一碗米饭"
+TEXTS = [
+    "午饭吃了一碗米饭和一个鸡蛋",
+    "今天吃了多少热量",
+    "晚饭吃了一个苹果",
+    "看看今天的记录",
+]
+_USAGE = {"prompt_tokens": 1000, "completion_tokens": 50, "total_tokens": 1050}
+
+
+def _percentile(values: t.List[float], p: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))] if values else 0.0
+
+
+class Stub:
+    """LLM 和 Gemini 的桩服务，在独立线程的事件循环中运行"""
+
+    def __init__(self, llm_latency: float, search_latency: float):
+        self.llm_latency = llm_latency
+        self.search_latency = search_latency
+        self.calls = 0
+        self.url = ""
+        self._loop = asyncio.new_event_loop()
+        self._ready = threading.Event()
+
+    def _reply(self, body: dict) -> dict:
+        last = body["messages"][-1]
+        if "image_url" in json.dumps(last, ensure_ascii=False):
+            return {"role": "assistant", "content": "一碗米饭，约150g"}
+        if last["role"] == "tool":
+            return {"role": "assistant", "content": "好的，已记录"}
+        if "吃了" in str(last.get("content", "")):
+            name = "add_diet_record"
+            args = {
+                "food_name": "米饭",
+                "amount": "150g",
+                "energy_kj": 729,
+                "protein": 3.9,
+                "fat": 0.5,
+                "carbs": 38.9,
+            }
+        else:
+            name, args = "query_diet_record", {"days_offset": 0}
+        call = {"name": name, "arguments": json.dumps(args, ensure_ascii=False)}
+        return {
+            "role": "assistant",
+            "content": "",
+            "tool_calls": [{"id": "call_1", "type": "function", "function": call}],
+        }
+
+    async def _chat(self, request: t.Any) -> t.Any:
+        from aiohttp import web
+
+        body = await request.json()
+        self.calls += 1
+        await asyncio.sleep(self.llm_latency)
+        message = self._reply(body)
+        return web.json_response({"choices": [{"message": message}], "usage": _USAGE})
+
+    async def _gemini(self, request: t.Any) -> t.Any:
+        from aiohttp import web
+
+        await asyncio.sleep(self.search_latency)
+        parts = [
+            {
+                "text": "名称,每份,热量kj,蛋白质g,脂肪g,碳水g,备注\n米饭,100g,486,2.6,0.3,25.9,"
+            }
+        ]
+        return web.json_response({"candidates": [{"content": {"parts": parts}}]})
+
+    async def _ok(self, request: t.Any) -> t.Any:
+        from aiohttp import web
+
+        return web.Response()
+
+    def _serve(self) -> None:
+        from aiohttp import web
+
+        async def start():
+            app = web.Application(client_max_size=64 * 1024 * 1024)
+            app.router.add_post("/v1/chat/completions", self._chat)
+            app.router.add_post("/v1beta/models/{model}", self._gemini)
+            app.router.add_route("*", "/{tail:.*}", self._ok)
+            runner = web.AppRunner(app, access_log=None)
+            await runner.setup()
+            site = web.TCPSite(runner, "127.0.0.1", 0)
+            await site.start()
+            port = site._server.sockets[0].getsockname()[1]
+            self.url = f"http://127.0.0.1:{port}"
+            self._ready.set()
+
+        asyncio.set_event_loop(self._loop)
+        self._loop.run_until_complete(start())
+        self._loop.run_forever()
+
+    def start(self) -> None:
+        threading.Thread(target=self._serve, daemon=True).start()
+        self._ready.wait()
+
+
+class FakeRequest(BaseRequest):
+    """代替 Bot API 的请求层：直接应答，不访问网络"""
+
+    def __init__(self, latency: float, photo_size: int):
+        self.latency = latency
+        self.photo = os.urandom(photo_size)
+        self.calls = 0
+        self.first_reply: t.Dict[int, float] = {}  # chat id -> 第一次发送消息的时间
+        self._message_id = 0
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+    def _message(self, params: dict) -> dict:
+        self._message_id += 1
+        chat_id = int(params.get("chat_id", 0))
+        return {
+            "message_id": params.get("message_id", self._message_id),
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "text": params.get("text", ""),
+        }
+
+    async def do_request(
+        self, url: str, method: str, request_data: t.Any = None, **kwargs: t.Any
+    ) -> t.Tuple[int, bytes]:
+        self.calls += 1
+        await asyncio.sleep(self.latency)
+        if "/file/bot" in url:
+            return 200, self.photo
+        params = request_data.parameters if request_data is not None else {}
+        endpoint = url.rsplit("/", 1)[-1]
+        if endpoint == "getMe":
+            result: t.Any = {
+                "id": 1,
+                "is_bot": True,
+                "first_name": "load",
+                "username": "load_test_bot",
+            }
+        elif endpoint == "getFile":
+            file_id = params["file_id"]
+            result = {
+                "file_id": file_id,
+                "file_unique_id": file_id,
+                "file_size": len(self.photo),
+                "file_path": f"files/{file_id}",
+            }
+        elif endpoint in ("sendMessage", "editMessageText"):
+            if endpoint == "sendMessage":
+                self.first_reply.setdefault(int(params["chat_id"]), time.perf_counter())
+            result = self._message(params)
+        else:
+            result = True
+        return 200, json.dumps({"ok": True, "result": result}).encode()
+
+
+class Driver:
+    """构造Update并按 main.py 的注册交给匹配的处理函数"""
+
+    def __init__(self, app: t.Any, request: FakeRequest, photo: float, voice: float):
+        self.app = app
+        self.request = request
+        self.photo = photo
+        self.voice = voice
+        self._update_id = 0
+
+    def make_update(self, chat_id: int) -> t.Any:
+        from telegram import Update
+
+        self._update_id += 1
+        n = self._update_id
+        message: t.Dict[str, t.Any] = {
+            "message_id": n,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "from": {"id": chat_id, "is_bot": False, "first_name": f"user{chat_id}"},
+        }
+        r = random.random()
+        if r < self.photo:
+            message["photo"] = [
+                {
+                    "file_id": f"photo{n}",
+                    "file_unique_id": f"photo{n}",
+                    "width": 1280,
+                    "height": 960,
+                    "file_size": len(self.request.photo),
+                }
+            ]
+            message["caption"] = "午饭"
+        elif r < self.photo + self.voice:
+            message["voice"] = {
+                "file_id": f"voice{n}",
+                "file_unique_id": f"voice{n}",
+                "duration": 3,
+                "mime_type": "audio/ogg",
+            }
+        else:
+            message["text"] = random.choice(TEXTS)
+        return Update.de_json({"update_id": n, "message": message}, self.app.bot)
+
+    async def dispatch(self, update: t.Any) -> None:
+        """和 Application.process_update 一样选择处理函数，但等待处理完成"""
+        for handler in self.app.handlers[0]:
+            check = handler.check_update(update)
+            if check is None or check is False:
+                continue
+            context = self.app.context_types.context.from_update(update, self.app)
+            await handler.handle_update(update, self.app, check, context)
+            return
+        raise RuntimeError(f"no handler for update {update.update_id}")
+
+    async def user(self, chat_id: int, deadline: float, result: dict) -> None:
+        while time.perf_counter() < deadline:
+            update = self.make_update(chat_id)
+            self.request.first_reply.pop(chat_id, None)
+            begin = time.perf_counter()
+            try:
+                await self.dispatch(update)
+            except Exception as e:
+                result["errors"].append(repr(e))
+                continue
+            end = time.perf_counter()
+            result["latency"].append(end - begin)
+            first = self.request.first_reply.get(chat_id)
+            if first is not None:
+                result["first_reply"].append(first - begin)
+
+
+async def _probe_lag(lags: t.List[float]) -> None:
+    while True:
+        begin = time.perf_counter()
+        await asyncio.sleep(LAG_INTERVAL)
+        lags.append(time.perf_counter() - begin - LAG_INTERVAL)
+
+
+async def run_level(driver: Driver, users: int, duration: float) -> dict:
+    result: t.Dict[str, t.List] = {"latency": [], "first_reply": [], "errors": []}
+    lags: t.List[float] = []
+    probe = asyncio.create_task(_probe_lag(lags))
+    begin = time.perf_counter()
+    deadline = begin + duration
+    try:
+        await asyncio.gather(
+            *[driver.user(BASE_CHAT_ID + i, deadline, result) for i in range(users)]
+        )
+    finally:
+        probe.cancel()
+    elapsed = time.perf_counter() - begin
+    latency = result["latency"]
+    return {
+        "users": users,
+        "messages": len(latency),
+        "errors": len(result["errors"]),
+        "first_error": result["errors"][0] if result["errors"] else "",
+        "throughput": len(latency) / elapsed,
+        "p50_ms": _percentile(latency, 0.5) * 1000,
+        "p99_ms": _percentile(latency, 0.99) * 1000,
+        "first_reply_p50_ms": _percentile(result["first_reply"], 0.5) * 1000,
+        "lag_p99_ms": _percentile(lags, 0.99) * 1000,
+        "lag_max_ms": max(lags, default=0.0) * 1000,
+        # Linux 上 ru_maxrss 的单位为KB
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }
+
+
+def summarize(results: t.List[dict]) -> str:
+    lines = [
+        f"{'users':>6} {'msgs':>6} {'err':>4} {'msg/s':>7} {'p50ms':>8} {'p99ms':>8} "
+        f"{'1st p50':>8} {'lag p99':>8} {'lag max':>8} {'rss MB':>7}"
+    ]
+    for x in results:
+        lines.append(
+            f"{x['users']:>6} {x['messages']:>6} {x['errors']:>4} "
+            f"{x['throughput']:>7.1f} {x['p50_ms']:>8.0f} {x['p99_ms']:>8.0f} "
+            f"{x['first_reply_p50_ms']:>8.0f} {x['lag_p99_ms']:>8.1f} "
+            f"{x['lag_max_ms']:>8.1f} {x['peak_rss_mb']:>7.1f}"
+        )
+    for x in results:
+        if x["first_error"]:
+            lines.append(f"  {x['users']} users, first error: {x['first_error'][:200]}")
+    return "\n".join(lines)
+
+
+def _prepare_workdir(workdir: str, stub_url: str, users: int) -> None:
+    """在临时目录中准备配置和数据，使agent只访问桩服务"""
+    os.environ.pop("ENV_FILE", None)
+    os.makedirs(os.path.join(workdir, ".data"))
+    os.makedirs(os.path.join(workdir, ".cache"))
+    with open(os.path.join(workdir, ".data", "daily_diet_kcal"), "w") as f:
+        f.write("2000")
+    allowed = ",".join(str(BASE_CHAT_ID + i) for i in range(users))
+    env = {
+        "bot_token": "123:load",
+        "gemini_key": "load",
+        "admin_chat_id": "1",
+        "dashscope_api_key": "load",
+        "litellm_host": stub_url,
+        "gemini_host": stub_url,
+        "allowed_chat_ids": allowed,
+    }
+    with open(os.path.join(workdir, ".env"), "w") as f:
+        f.writelines(f"{k}={v}\n" for k, v in env.items())
+    # 环境变量优先于 .env，部署环境中设置的真实地址和密钥也要覆盖掉
+    os.environ.update(env)
+
+
+async def load_test(args: argparse.Namespace, levels: t.List[int]) -> t.List[dict]:
+    import telegram
+
+    import main as bot_main
+    from src import audio2text, http_client
+
+    logging.getLogger().setLevel(logging.INFO if args.verbose else logging.WARNING)
+
+    def fake_asr(filepath: str) -> str:
+        time.sleep(args.asr_latency)
+        return ASR_TEXT
+
+    audio2text.qwen_asr = fake_asr
+
+    request = FakeRequest(args.tg_latency, args.photo_kb * 1024)
+    bot = telegram.Bot("123:load", request=request, get_updates_request=request)
+    app = bot_main.build_application(bot)
+    await app.initialize()
+    driver = Driver(app, request, args.photo, args.voice)
+    results = []
+    try:
+        for users in levels:
+            result = await run_level(driver, users, args.duration)
+            results.append(result)
+            print(
+                f"{users} users: {result['throughput']:.1f} msg/s, "
+                f"p99 {result['p99_ms']:.0f}ms",
+                flush=True,
+            )
+    finally:
+        await app.shutdown()
+        await http_client.close()
+    return results
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--levels", default="1,5,20,50", help="逐级的并发用户数")
+    parser.add_argument("--duration", type=float, default=20, help="每级的时长（秒）")
+    parser.add_argument("--photo", type=float, default=0.2, help="图片消息的比例")
+    parser.add_argument("--voice", type=float, default=0.1, help="语音消息的比例")
+    parser.add_argument("--llm-latency", type=float, default=0.5)
+    parser.add_argument("--search-latency", type=float, default=1.0)
+    parser.add_argument("--asr-latency", type=float, default=0.3)
+    parser.add_argument("--tg-latency", type=float, default=0.05)
+    parser.add_argument("--photo-kb", type=int, default=100)
+    parser.add_argument("--json", default="", help="把每级的结果保存为json，便于对比")
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args()
+    levels = [int(x) for x in args.levels.split(",") if x.strip()]
+    json_path = os.path.abspath(args.json) if args.json else ""
+
+    stub = Stub(args.llm_latency, args.search_latency)
+    stub.start()
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as workdir:
+        _prepare_workdir(workdir, stub.url, max(levels))
+        os.chdir(workdir)
+        try:
+            results = asyncio.run(load_test(args, levels))
+        finally:
+            os.chdir(cwd)
+
+    print(summarize(results))
+    print(f"{stub.calls} llm calls, {sum(x['messages'] for x in results)} messages")
+    if json_path:
+        with open(json_path, "w") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,315 @@
+#!/usr/bin/env python
+"""
+离线回放基准：从 recorder 记录的日志（.cache/recorder.csv）中还原对话，
+用本地桩服务按顺序返回记录的LLM/搜索响应，逐轮重新运行agent，统计我们自己的开销
+（序列化、存储、工具执行、钩子等），不需要网络。
+
+- 每轮的总耗时减去等待桩服务的时间即为自身开销
+- 桩服务运行在独立线程的事件循环中，不占用agent所在的事件循环
+- 回放在临时目录中进行，不会读写真实的 .data/ 和 .cache/
+- 记录中没有图片内容，带图片的对话只回放文字部分
+
+用法: python scripts/replay.py [--log .cache/recorder.csv] [--repeat 3] [--json result.json]
+"""
+
+import argparse
+import asyncio
+import csv
+import json
+import logging
+import os
+import sys
+import tempfile
+import threading
+import time
+import typing as t
+from dataclasses import dataclass, field
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.append(ROOT)
+
+# 桩服务在没有对应记录时返回的响应
+_EMPTY_LLM = {
+    "choices": [{"message": {"role": "assistant", "content": "<回放结束>"}}],
+    "usage": {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0},
+}
+_EMPTY_SEARCH = {"candidates": [{"content": {"parts": [{"text": "没有搜索结果"}]}}]}
+
+
+@dataclass
+class Turn:
+    user_text: str
+    responses: t.List[str] = field(default_factory=list)  # 每次LLM调用的响应
+
+
+@dataclass
+class Recording:
+    turns: t.List[Turn] = field(default_factory=list)
+    food_searches: t.Dict[str, str] = field(default_factory=dict)  # 提示词 -> 响应
+    google_searches: t.List[str] = field(default_factory=list)
+    image2text: t.List[str] = field(default_factory=list)
+
+
+def _turn_position(messages: t.List[dict]) -> t.Tuple[str, int]:
+    """返回 (最后一条用户消息, 它之后的助手消息数)，后者即本轮的第几次LLM调用"""
+    for i in range(len(messages) - 1, -1, -1):
+        if messages[i]["role"] == "user":
+            content = messages[i]["content"]
+            if not isinstance(content, str):
+                content = json.dumps(content, ensure_ascii=False)
+            after = messages[i + 1 :]
+            return content, sum(1 for m in after if m["role"] == "assistant")
+    return "", 0
+
+
+def load(path: str) -> Recording:
+    """解析recorder日志，还原每轮对话中LLM的响应序列"""
+    csv.field_size_limit(sys.maxsize)
+    rec = Recording()
+    requests: t.Dict[str, dict] = {}
+    responses: t.Dict[str, str] = {}
+    order: t.List[str] = []
+    food_requests: t.Dict[str, str] = {}
+    with open(path, "r", newline="") as f:
+        reader = csv.reader(f)
+        next(reader, None)
+        for row in reader:
+            kind, data, headers = row[1], row[2], row[3]
+            if kind.startswith("llm req "):
+                uuid = kind[len("llm req ") :]
+                requests[uuid] = json.loads(data)
+                order.append(uuid)
+            elif kind.startswith("llm resp"):
+                responses[kind[len("llm resp") :].strip()] = data
+            elif kind.startswith("search food "):
+                uuid = kind[len("search food ") :]
+                if headers:  # 响应带有http头
+                    if uuid in food_requests:
+                        rec.food_searches[food_requests.pop(uuid)] = data
+                else:
+                    payload = json.loads(data)
+                    food_requests[uuid] = payload["contents"][0]["parts"][0]["text"]
+            elif kind == "google search":
+                rec.google_searches.append(data)
+            elif kind == "image2text resp":
+                rec.image2text.append(data)
+
+    for uuid in order:
+        user_text, n = _turn_position(requests[uuid]["messages"])
+        if n == 0:
+            rec.turns.append(Turn(user_text))
+        elif not rec.turns or len(rec.turns[-1].responses) != n:
+            continue  # 日志不完整（如进程中途退出）
+        if uuid in responses:
+            rec.turns[-1].responses.append(responses[uuid])
+    rec.turns = [x for x in rec.turns if x.user_text and x.responses]
+    return rec
+
+
+class Stub:
+    """按当前回放的轮次返回记录的响应"""
+
+    def __init__(self, rec: Recording):
+        self.rec = rec
+        self.turn: t.Optional[Turn] = None
+        self.calls = 0
+        self.google = 0
+        self.url = ""
+        self._loop = asyncio.new_event_loop()
+        self._ready = threading.Event()
+
+    def begin_turn(self, turn: Turn) -> None:
+        self.turn = turn
+        self.calls = 0
+
+    async def _chat(self, request: t.Any) -> t.Any:
+        from aiohttp import web
+
+        body = await request.json()
+        if "image_url" in json.dumps(body["messages"][-1]):
+            text = self.rec.image2text[0] if self.rec.image2text else None
+        else:
+            turn, i = self.turn, self.calls
+            self.calls += 1
+            text = turn.responses[i] if turn and i < len(turn.responses) else None
+        if text is None:
+            return web.json_response(_EMPTY_LLM)
+        status = 200 if '"choices"' in text else 500
+        return web.Response(text=text, status=status, content_type="application/json")
+
+    async def _gemini(self, request: t.Any) -> t.Any:
+        from aiohttp import web
+
+        body = await request.json()
+        text = None
+        if any("code_execution" in x for x in body.get("tools", [])):
+            prompt = body["contents"][0]["parts"][0]["text"]
+            text = self.rec.food_searches.get(prompt)
+        elif self.rec.google_searches:
+            searches = self.rec.google_searches
+            text = searches[self.google % len(searches)]
+            self.google += 1
+        if text is None:
+            return web.json_response(_EMPTY_SEARCH)
+        return web.Response(text=text, content_type="application/json")
+
+    async def _ok(self, request: t.Any) -> t.Any:
+        from aiohttp import web
+
+        return web.Response()
+
+    def _serve(self) -> None:
+        from aiohttp import web
+
+        async def start():
+            app = web.Application(client_max_size=64 * 1024 * 1024)
+            app.router.add_post("/v1/chat/completions", self._chat)
+            app.router.add_post("/v1beta/models/{model}", self._gemini)
+            app.router.add_route("*", "/{tail:.*}", self._ok)
+            runner = web.AppRunner(app, access_log=None)
+            await runner.setup()
+            site = web.TCPSite(runner, "127.0.0.1", 0)
+            await site.start()
+            port = site._server.sockets[0].getsockname()[1]
+            self.url = f"http://127.0.0.1:{port}"
+            self._ready.set()
+
+        asyncio.set_event_loop(self._loop)
+        self._loop.run_until_complete(start())
+        self._loop.run_forever()
+
+    def start(self) -> None:
+        threading.Thread(target=self._serve, daemon=True).start()
+        self._ready.wait()
+
+
+def _prepare_workdir(workdir: str, stub_url: str) -> None:
+    """在临时目录中准备配置和数据，使agent只访问桩服务"""
+    os.environ.pop("ENV_FILE", None)
+    os.makedirs(os.path.join(workdir, ".data"))
+    os.makedirs(os.path.join(workdir, ".cache"))
+    with open(os.path.join(workdir, ".data", "daily_diet_kcal"), "w") as f:
+        f.write("2000")
+    env = {
+        "bot_token": "replay",
+        "gemini_key": "replay",
+        "admin_chat_id": "1",
+        "dashscope_api_key": "replay",
+        "litellm_host": stub_url,
+        "gemini_host": stub_url,
+    }
+    with open(os.path.join(workdir, ".env"), "w") as f:
+        f.writelines(f"{k}={v}\n" for k, v in env.items())
+    # 环境变量优先于 .env，部署环境中设置的真实地址和密钥也要覆盖掉
+    os.environ.update(env)
+
+
+async def replay(rec: Recording, stub: Stub, repeat: int) -> t.List[dict]:
+    from src import agent, http_client
+
+    results = []
+    llm: t.List[float] = []
+    tools: t.List[float] = []
+
+    async def post_llm_call(iteration, seconds, status, resp_bytes):
+        llm.append(seconds)
+
+    async def post_func_call(_id, name, result, seconds):
+        tools.append(seconds)
+
+    async def post_llm_resp(resp: str, short_memory: bool):
+        pass
+
+    hooks = agent.Hooks(
+        post_func_call=post_func_call,
+        post_llm_call=post_llm_call,
+        post_llm_resp=post_llm_resp,
+    )
+    for r in range(repeat):
+        for i, turn in enumerate(rec.turns):
+            stub.begin_turn(turn)
+            llm.clear()
+            tools.clear()
+            begin = time.perf_counter()
+            error = ""
+            try:
+                await agent.run_agent(user_text=turn.user_text, hooks=hooks)
+            except Exception as e:
+                error = repr(e)
+            total = time.perf_counter() - begin
+            results.append(
+                {
+                    "round": r,
+                    "turn": i,
+                    "llm_calls": len(llm),
+                    "total_ms": total * 1000,
+                    "llm_wait_ms": sum(llm) * 1000,
+                    "tools_ms": sum(tools) * 1000,
+                    "overhead_ms": (total - sum(llm)) * 1000,
+                    "error": error,
+                }
+            )
+    await http_client.close()
+    return results
+
+
+def _percentile(values: t.List[float], p: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))] if values else 0.0
+
+
+def summarize(results: t.List[dict]) -> str:
+    ok = [x for x in results if not x["error"]]
+    lines = [f"{len(results)} turns replayed, {len(results) - len(ok)} failed"]
+    for key in ["total_ms", "llm_wait_ms", "tools_ms", "overhead_ms"]:
+        values = [x[key] for x in ok]
+        if not values:
+            break
+        lines.append(
+            f"  {key:12s}: mean {sum(values) / len(values):8.2f}  "
+            f"p50 {_percentile(values, 0.5):8.2f}  p95 {_percentile(values, 0.95):8.2f}"
+        )
+    for x in results:
+        if x["error"]:
+            lines.append(f"  turn {x['turn']} failed: {x['error'][:200]}")
+    return "\n".join(lines)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--log", default=".cache/recorder.csv")
+    parser.add_argument("--repeat", type=int, default=1, help="回放所有对话的遍数")
+    parser.add_argument("--limit", type=int, default=0, help="只回放前N轮对话")
+    parser.add_argument("--json", default="", help="把每轮的结果保存为json，便于对比")
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args()
+
+    rec = load(args.log)
+    if args.limit:
+        rec.turns = rec.turns[: args.limit]
+    llm_calls = sum(len(x.responses) for x in rec.turns)
+    print(f"{len(rec.turns)} turns, {llm_calls} llm calls in {args.log}")
+    if not rec.turns:
+        return
+    json_path = os.path.abspath(args.json) if args.json else ""
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING)
+
+    stub = Stub(rec)
+    stub.start()
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as workdir:
+        _prepare_workdir(workdir, stub.url)
+        os.chdir(workdir)
+        try:
+            results = asyncio.run(replay(rec, stub, args.repeat))
+        finally:
+            os.chdir(cwd)
+
+    print(summarize(results))
+    if json_path:
+        with open(json_path, "w") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
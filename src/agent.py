@@ -1,23 +1,40 @@
+import asyncio
 import base64
 from collections import defaultdict
 from dataclasses import dataclass
 import json
 import logging
 import time
-import aiohttp
 import os
 import typing as t
 import sys
 
-
 if __name__ == "__main__":
     sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
 
 from src.functions import diet_record
-from src import registry, config, utils, recorder, memory
+from src import (
+    registry,
+    config,
+    utils,
+    recorder,
+    memory,
+    tool_router,
+    http_client,
+    tenant,
+    singleflight,
+    long_memory,
+    tracing,
+    model_router,
+    tool_memo,
+    tool_output,
+)
 
 logger = logging.getLogger()
-litellm_api = f"{config.app.litellm_host}/v1/chat/completions"
+
+
+def litellm_api() -> str:
+    return f"{config.app.litellm_host}/v1/chat/completions"
 
 
 class TokenUsage:
@@ -33,8 +50,59 @@ class TokenUsage:
         return dict(self.usage)
 
 
-async def explain_jpg(jpg_data: bytes, token_usage: TokenUsage) -> str:
-    jpg_base64 = base64.b64encode(jpg_data).decode()
+class LLMError(Exception):
+    """模型请求失败：http错误、网络错误、超时或响应格式不对，可以换一个模型重试"""
+
+    def __init__(self, status: int, text: str):
+        super().__init__(f"llm failed {status}: {text[:500]}")
+        self.status = status  # 没有收到http响应时为0
+        self.text = text
+
+
+async def _post_llm(payload: dict, record_name: str) -> t.Tuple[dict, str]:
+    """
+    发送请求并解析响应
+
+    :return: (解析后的响应, 响应文本)
+    :raises LLMError: 请求或解析失败
+    """
+    import aiohttp
+
+    status, text = 0, ""
+    try:
+        async with http_client.session() as session:
+            async with session.post(litellm_api(), json=payload) as response:
+                status = response.status
+                text = await response.text()
+                hds_str = "\n".join([f"{k}: {v}" for k, v in response.headers.items()])
+                recorder.record(record_name, text, hds_str)
+        if status != 200:
+            raise LLMError(status, text)
+        resp_js = json.loads(text)
+        # 有的服务出错时也返回200，响应中没有回答
+        if not isinstance(resp_js["choices"][0]["message"], dict):
+            raise TypeError("message is not an object")
+        if not isinstance(resp_js["usage"], dict):
+            raise TypeError("usage is not an object")
+        return resp_js, text
+    except (
+        aiohttp.ClientError,
+        asyncio.TimeoutError,
+        json.JSONDecodeError,
+        KeyError,
+        IndexError,
+        TypeError,
+    ) as e:
+        raise LLMError(status, text or repr(e)) from e
+
+
+async def explain_jpg(
+    jpg_data: t.Union[bytes, t.List[bytes]], token_usage: TokenUsage
+) -> str:
+    """
+    :param jpg_data: 一张图片，或同一相册中的多张图片（在一次请求中一起解释）
+    """
+    images = [jpg_data] if isinstance(jpg_data, bytes) else jpg_data
     system_prompt = """你是一名经验丰富的营养师。
 - 如果用户发送的图片是营养成分表，请给出营养成分表的详细信息，包含：
   - 每份的单位，如 100ml
@@ -45,23 +113,26 @@ async def explain_jpg(jpg_data: bytes, token_usage: TokenUsage) -> str:
 
 - 如果用户发送的图片是具体的食物，请给出食物的具体名称和大致分量，如：全麦面包100g + 纯牛奶200ml
 - 如果用户发送的图片是运动记录，请给出运动名称和时长，如：慢跑30分钟
+- 如果用户一次发送了多张图片，它们属于同一餐或同一件事（如餐食、营养成分表、小票），请综合给出一份结果，同一食物不要重复列出
     """
-    messages = [
-        {"role": "system", "content": system_prompt},
+    content: t.List[dict] = [
         {
-            "role": "user",
-            "content": [
-                {
-                    "type": "text",
-                    "text": "解释这张图片",
-                },
-                {
-                    "type": "image_url",
-                    "image_url": {"url": "data:image/jpeg;base64," + jpg_base64},
-                },
-            ],
+            "type": "text",
+            "text": (
+                "解释这张图片" if len(images) == 1 else f"解释这{len(images)}张图片"
+            ),
         },
     ]
+    for image in images:
+        jpg_base64 = base64.b64encode(image).decode()
+        content.append(
+            {
+                "type": "image_url",
+                "image_url": {
+                    "url": f"data:image/jpeg;base64,{jpg_base64}",
+                },
+            }
+        )
     messages = [
         {
             "role": "system",
@@ -69,109 +140,192 @@ async def explain_jpg(jpg_data: bytes, token_usage: TokenUsage) -> str:
         },
         {
             "role": "user",
-            "content": [
-                {
-                    "type": "text",
-                    "text": "解释这张图片",
-                },
-                {
-                    "type": "image_url",
-                    "image_url": {
-                        "url": f"data:image/jpeg;base64,{jpg_base64}",
-                    },
-                },
-            ],
+            "content": content,
         },
     ]
-    model = "grok-2-vision-1212"
-    model = "doubao-1.5-vision-pro-32k"
-    model = "openrouter/qwen/qwen2.5-vl-72b-instruct"
-    model = "gemini/gemini-2.0-flash"
-    payload = {
-        "model": model,
-        "messages": messages,
-        "max_tokens": 2048,
-        "no-log": True,
-    }
-    async with aiohttp.ClientSession() as session:
-        async with session.post(litellm_api, json=payload) as response:
-            text = await response.text()
-            hds_str = "\n".join([f"{k}: {v}" for k, v in response.headers.items()])
-            recorder.record("image2text resp", text, hds_str)
-            if response.status != 200:
-                msg = f"image2text failed {response.status}: {text[:500]}"
-                raise Exception(msg)
-
-            logger.info(f"image2text resp: {text[:500]}")
-            resp_js = json.loads(text)
-            token_usage.add(resp_js["usage"])
-            message: dict = resp_js["choices"][0]["message"]
-            messages.append(message)
-            return message.get("content", "")
+    failed: t.List[str] = []
+    while True:
+        model = model_router.pick(vision=True, exclude=failed)
+        if model is None:
+            raise Exception(f"image2text failed with models {failed}")
+        payload = {
+            "model": model,
+            "messages": messages,
+            "max_tokens": 2048,
+            "no-log": True,
+        }
+        begin = time.time()
+        try:
+            with tracing.span(
+                "llm explain_jpg",
+                "llm",
+                model=model,
+                images=len(images),
+                image_bytes=sum(len(x) for x in images),
+            ) as sp:
+                resp_js, text = await _post_llm(payload, "image2text resp")
+                sp.set(response_bytes=len(text), **_usage_attrs(resp_js["usage"]))
+        except LLMError as e:
+            logger.warning(f"image2text with {model} failed {e.status}: {e.text[:500]}")
+            model_router.report_failure(model, e.status, e.text)
+            failed.append(model)
+            continue
+
+        logger.info(f"image2text resp: {text[:500]}")
+        model_router.report_success(model, time.time() - begin, resp_js["usage"])
+        token_usage.add(resp_js["usage"])
+        message: dict = resp_js["choices"][0]["message"]
+        messages.append(message)
+        return message.get("content", "")
 
 
 @dataclass
 class Hooks:
+    # (tool_call_id, name, args_str)
     pre_func_call: t.Optional[t.Callable] = None
+    # (tool_call_id, name, result, 耗时秒数)
+    post_func_call: t.Optional[t.Callable] = None
+    # (轮次, 请求字节数)
+    pre_llm_call: t.Optional[t.Callable] = None
+    # (轮次, 耗时秒数, http状态码, 响应字节数)
+    post_llm_call: t.Optional[t.Callable] = None
+    # (回复内容, short_memory)
     post_llm_resp: t.Optional[t.Callable] = None
+    # (图片内容) 图片已经解释并加入短期记忆
+    post_explain_jpg: t.Optional[t.Callable] = None
 
 
 DEFAULT_HOOKS = Hooks()
 
 
+async def _timed(name: str, aw: t.Awaitable, timings: t.Dict[str, float]) -> t.Any:
+    begin = time.time()
+    try:
+        with tracing.span(name, "setup"):
+            return await aw
+    finally:
+        timings[name] = round((time.time() - begin) * 1000, 1)
+
+
+async def _as_bytes(data: t.Union[bytes, t.Awaitable[bytes]]) -> bytes:
+    return data if isinstance(data, bytes) else await data
+
+
+def _usage_attrs(usage: dict) -> dict:
+    keys = ["prompt_tokens", "completion_tokens", "total_tokens"]
+    return {k: usage[k] for k in keys if k in usage}
+
+
+async def _call_tool(
+    _id: str, name: str, args: dict, hooks: Hooks, memo: tool_memo.RunMemo
+) -> str:
+    begin = time.time()
+    with tracing.span(f"tool {name}", "tool", args=args) as sp:
+        hits = memo.hits
+        result = await memo.call(name, args, lambda: registry.func_map[name](**args))
+        sp.set(memo_hit=memo.hits > hits)
+        sp.set(result_bytes=len(str(result).encode()))
+    if hooks.post_func_call:
+        await hooks.post_func_call(_id, name, result, time.time() - begin)
+    return result
+
+
 async def run_agent(
-    user_text: str = "", jpg_data: bytes = b"", hooks: Hooks = DEFAULT_HOOKS
+    user_text: str = "",
+    jpg_data: t.Union[
+        bytes, t.Awaitable[bytes], t.Sequence[t.Union[bytes, t.Awaitable[bytes]]]
+    ] = b"",
+    hooks: Hooks = DEFAULT_HOOKS,
+    jpg_text: str = "",
 ) -> None:
-    model = "grok-2-1212"  # 使用tools不积极
-    model = "gemini/gemini-2.0-flash"  # 使用tools不积极+幻觉
-    model = "gemini/gemini-2.0-pro-exp-02-05"  # 使用tools不积极+服务不稳定
-    model = "gemini/gemini-1.5-pro"  # 消极使用tools
-
-    model = (
-        "openrouter/anthropic/claude-3.7-sonnet"  # 表现不错，tools一次用一个，很费token
-    )
-    model = "openrouter/openai/gpt-4o-2024-11-20"  # 使用tools不积极，但提示后可用，支持批量tools
-    model = "deepseek-chat"  # 表现不错，tools支持批量调用
-    model = "qwen-plus-latest"  # 表现不错
-    model = "qwen-max-latest"  # 表现不错
-    model = "hunyuan-turbos-latest"  # 表现极差
-    model = "doubao-1.5-pro-32k"  # 成功实现图片+文本输入；tools一次用一个；多轮表现稳定
+    """
+    :param jpg_data: 图片内容，也可以是正在下载图片的任务，会和其他准备工作并行；
+        相册的多张图片以列表传入，在一次请求中一起解释
+    :param jpg_text: 之前的运行已经解释过的图片内容，已经在短期记忆中，只用于选择工具和召回记忆
+    """
+    memo = tool_memo.RunMemo()  # 本次运行内只读工具的结果
+    # 模型及其表现见 model_router.CATALOG
+    failed_models: t.List[str] = []
+    model = model_router.pick(tools=True)
+    if model is None:
+        raise Exception("no model supports tool calls")
 
     messages = []
 
     def add_msg(role: str, content: str):
         messages.append({"role": role, "content": content})
 
+    token_usage = TokenUsage()
+    # 并行进行准备工作：建立连接、查询今日摄入、下载并解释图片
+    timings: t.Dict[str, float] = {}
+    begin = time.time()
+    warm_up = http_client.warm_up(litellm_api())
+    warm_up_task = asyncio.create_task(_timed("warm_up", warm_up, timings))
+    diet_task = asyncio.create_task(
+        _timed("daily_totals", diet_record._query_diet_record(0), timings)
+    )
+
+    async def load_and_explain_jpg() -> str:
+        items = jpg_data if isinstance(jpg_data, (list, tuple)) else [jpg_data]
+        loaded = await asyncio.gather(*[_as_bytes(x) for x in items])
+        images = [x for x in loaded if x]
+        if not images:
+            return ""
+        jpg_text = await _timed(
+            "explain_jpg", explain_jpg(images, token_usage), timings
+        )
+        size = sum(len(x) for x in images)
+        logger.info(f"explain {len(images)} images ({size} bytes) to: {jpg_text}")
+        return jpg_text
+
+    jpg_task = asyncio.create_task(_timed("image", load_and_explain_jpg(), timings))
+
     # 初始化上下文
     now = time.strftime("%Y-%m-%d %H:%M:%S")
     system_prompt = f"当前时间是{now}。你是一个经验丰富的营养师，你会基于我提供的工具完成用户的需求：管理食物、记录饮食和热量、查询食物的营养成分等。如果用户的输入不完整，你可以向用户询问更多信息。"
-    today_diet = await diet_record._query_diet_record(0)
+    try:
+        today_diet = await diet_task
+        new_jpg_text = await jpg_task
+        # 第一次请求本来也要等连接建立，等预热完成不会更慢
+        await warm_up_task
+    finally:
+        diet_task.cancel()
+        jpg_task.cancel()
+        warm_up_task.cancel()
     today_energy_kj = sum([x.energy_kj for x in today_diet])
     today_energy_kcal = today_energy_kj / 4.184
-    system_prompt += f"\n用户的每日热量摄入限额是{config.daily_diet_kcal}千卡({config.daily_diet_kj}kj)。今日已摄入{today_energy_kcal:.1f}千卡({today_energy_kj:.1f}kj)。"
-    add_msg("system", system_prompt)
-    # todo 长期记忆
+    daily_kcal = tenant.daily_diet_kcal()
+    system_prompt += f"\n用户的每日热量摄入限额是{daily_kcal}千卡({daily_kcal * 4.184:.1f}kj)。今日已摄入{today_energy_kcal:.1f}千卡({today_energy_kj:.1f}kj)。"
 
-    token_usage = TokenUsage()
-    # 解释图片
-    if jpg_data:
-        jpg_text = await explain_jpg(jpg_data, token_usage)
-        logger.info(f"explain {len(jpg_data)} bytes of image to: {jpg_text}")
+    route_text = "\n".join(x for x in [user_text, jpg_text] if x)
+    if new_jpg_text:
         memory.add_short_memory("user", "（图片内容）")
-        memory.add_short_memory("assistant", jpg_text)
+        memory.add_short_memory("assistant", new_jpg_text)
+        route_text += "\n" + new_jpg_text
+        if hooks.post_explain_jpg:
+            await hooks.post_explain_jpg(new_jpg_text)
         if hooks.post_llm_resp:
-            await hooks.post_llm_resp(jpg_text, short_memory=True)
+            await hooks.post_llm_resp(new_jpg_text, short_memory=True)
 
     if not user_text:
         return
+    # 长期记忆
+    recalled = await long_memory.recall(route_text)
+    if recalled:
+        system_prompt += "\n" + recalled
+    add_msg("system", system_prompt)
     messages.extend(memory.get_short_memory())
     add_msg("user", user_text)
+    tools = tool_router.select_tools(route_text)
+    timings["setup"] = round((time.time() - begin) * 1000, 1)
+    logger.info(f"run_agent setup timings(ms): {timings}")
+    used_tools = []
     final_resp = "<没有回答>"
-    for _ in range(20):
+    for i in range(20):
         payload = {
             "model": model,
             "messages": messages,
-            "tools": registry.tool_openai_fmt,
+            "tools": tools,
             "max_tokens": 2048,
             "no-log": True,
         }
@@ -179,60 +333,87 @@ async def run_agent(
         req_str = json.dumps(payload, ensure_ascii=False)
         recorder.record("llm req " + uuid, req_str)
         logger.info(f"[{uuid}] call llm")
-        async with aiohttp.ClientSession() as session:
-            async with session.post(litellm_api, json=payload) as response:
-                resp_text = await response.text()
-                hds_str = "\n".join([f"{k}: {v}" for k, v in response.headers.items()])
-                recorder.record("llm resp" + uuid, resp_text, hds_str)
-
-                if response.status != 200:
-                    if (
-                        "The tool call is not supported" in resp_text
-                        or "Function call is not supported for this model" in resp_text
-                    ):
-                        logger.warning(f"[{uuid}] llm not support tool call, retry")
-                        time.sleep(1)
-                        continue
-                    raise Exception(
-                        f"[{uuid}] llm failed {response.status}: {resp_text[:500]}"
-                    )
-                logger.info(f"[{uuid}] llm resp: {resp_text[:500]}")
-                resp_js = json.loads(resp_text)
-                token_usage.add(resp_js["usage"])
-                message: dict = resp_js["choices"][0]["message"]
-                messages.append(message)
-                content = message.get("content", "")
-                tool_calls = message.get("tool_calls", [])
-
-                if not tool_calls:  # llm没有输出工具调用
-                    final_resp = content if content else final_resp
-                    break
-                if content:  # llm输出了文字
-                    logger.info(f"model response: {content}")
-                    if hooks.post_llm_resp:
-                        await hooks.post_llm_resp(content, short_memory=False)
-                for tool_call in tool_calls:
-                    _id = tool_call["id"]
-                    tool_name = tool_call["function"]["name"]
-                    args_str = tool_call["function"]["arguments"]
-                    logger.info(f"tool call: {_id} {tool_name} {args_str}")
-                    if hooks.pre_func_call:
-                        await hooks.pre_func_call(_id, tool_name, args_str)
-                    args = json.loads(tool_call["function"]["arguments"])
-                    tool_res = await registry.func_map[tool_name](**args)
-
-                    logger.info(f"tool response: {tool_res}")
-                    messages.append(
-                        {
-                            "role": "tool",
-                            "tool_call_id": _id,
-                            "content": tool_res,
-                        }
-                    )
+        llm_span = tracing.span(
+            "llm", "llm", model=model, iteration=i, request_bytes=len(req_str)
+        )
+        if hooks.pre_llm_call:
+            await hooks.pre_llm_call(i, len(req_str))
+        llm_begin = time.time()
+        try:
+            # span只包含请求和解析，之后的回复和工具调用不计入LLM的时间
+            with llm_span:
+                resp_js, resp_text = await _post_llm(payload, "llm resp" + uuid)
+                llm_span.set(
+                    response_bytes=len(resp_text), **_usage_attrs(resp_js["usage"])
+                )
+        except LLMError as e:
+            if hooks.post_llm_call:
+                await hooks.post_llm_call(
+                    i, time.time() - llm_begin, e.status, len(e.text)
+                )
+            # 换一个模型重试，消息历史保持不变
+            model_router.report_failure(model, e.status, e.text)
+            failed_models.append(model)
+            next_model = model_router.pick(tools=True, exclude=failed_models)
+            if next_model is None:
+                raise Exception(f"[{uuid}] {e}") from e
+            logger.warning(
+                f"[{uuid}] {model} failed {e.status}, "
+                f"fail over to {next_model}: {e.text[:200]}"
+            )
+            model = next_model
+            continue
+        if hooks.post_llm_call:
+            await hooks.post_llm_call(i, time.time() - llm_begin, 200, len(resp_text))
+        logger.info(f"[{uuid}] llm resp: {resp_text[:500]}")
+        model_router.report_success(model, time.time() - llm_begin, resp_js["usage"])
+        token_usage.add(resp_js["usage"])
+        message: dict = resp_js["choices"][0]["message"]
+        messages.append(message)
+        content = message.get("content", "")
+        tool_calls = message.get("tool_calls", [])
+
+        if not tool_calls:  # llm没有输出工具调用
+            final_resp = content if content else final_resp
+            break
+        if content:  # llm输出了文字
+            logger.info(f"model response: {content}")
+            if hooks.post_llm_resp:
+                await hooks.post_llm_resp(content, short_memory=False)
+        calls = []
+        for tool_call in tool_calls:
+            _id = tool_call["id"]
+            tool_name = tool_call["function"]["name"]
+            args_str = tool_call["function"]["arguments"]
+            logger.info(f"tool call: {_id} {tool_name} {args_str}")
+            if hooks.pre_func_call:
+                await hooks.pre_func_call(_id, tool_name, args_str)
+            used_tools.append(tool_name)
+            args = json.loads(tool_call["function"]["arguments"])
+            calls.append((_id, tool_name, args))
+
+        # 同一轮的工具调用并行执行，重复的查询会被合并为一次上游调用
+        results = await asyncio.gather(
+            *[_call_tool(_id, name, args, hooks, memo) for _id, name, args in calls]
+        )
+        for (_id, _, _), tool_res in zip(calls, results):
+            logger.info(f"tool response: {tool_res}")
+            messages.append(
+                {
+                    "role": "tool",
+                    "tool_call_id": _id,
+                    "content": tool_res,
+                }
+            )
 
     logger.info(f"token usage: {token_usage.get()}")
+    logger.info(f"singleflight: {singleflight.stats()}")
+    logger.info(f"model router: {model_router.stats()}")
+    logger.info(f"tool memo: {memo.hits} hits, compact output: {tool_output.stats}")
+    tool_router.note_tool_use(used_tools)
     memory.add_short_memory("user", user_text)
     memory.add_short_memory("assistant", final_resp)
+    await long_memory.add_turn(user_text, final_resp)
     if hooks.post_llm_resp:
         await hooks.post_llm_resp(final_resp, short_memory=True)
 
@@ -258,6 +439,7 @@ async def _local_test():
         if not text:
             break
         await run_agent(text)
+    await http_client.close()
 
 
 if __name__ == "__main__":
@@ -1,18 +1,20 @@
 import logging
 import os
 
-import dashscope
-from dashscope.api_entities.dashscope_response import MultiModalConversationResponse
-
 from src import config
 
 logger = logging.getLogger()
 
-dashscope.api_key = config.app.dashscope_api_key
-
 
 def qwen_asr(filepath: str) -> str:
     """Use qwen's ASR to convert audio to text"""
+    # dashscope导入很慢，只在第一次识别语音时加载
+    import dashscope
+    from dashscope.api_entities.dashscope_response import (
+        MultiModalConversationResponse,
+    )
+
+    dashscope.api_key = config.app.dashscope_api_key
     abs_path = os.path.abspath(filepath)
     messages = [
         {
@@ -0,0 +1,290 @@
+"""
+安全的算术表达式引擎，供 calc 工具使用。
+
+表达式先做单位改写，再用 ast 解析并按白名单校验，编译结果会被缓存。
+支持带单位的计算，如 `52kcal/100g*150g in kj`。
+"""
+
+import ast
+import functools
+import math
+import re
+import typing as t
+
+# 单位 -> (基本单位, 换算系数)，基本单位为 g、ml、kj
+_units: t.Dict[str, t.Tuple[str, float]] = {
+    "mg": ("g", 0.001),
+    "g": ("g", 1),
+    "克": ("g", 1),
+    "kg": ("g", 1000),
+    "千克": ("g", 1000),
+    "公斤": ("g", 1000),
+    "ml": ("ml", 1),
+    "毫升": ("ml", 1),
+    "l": ("ml", 1000),
+    "升": ("ml", 1000),
+    "kj": ("kj", 1),
+    "千焦": ("kj", 1),
+    "kcal": ("kj", 4.184),
+    "千卡": ("kj", 4.184),
+    "大卡": ("kj", 4.184),
+}
+_unit_names = {"g": "g", "ml": "ml", "kj": "kJ"}
+_unit_pattern = "|".join(sorted(map(re.escape, _units), key=len, reverse=True))
+# 200g、1.5 kcal 改写成 (200*_u_g)
+_quantity = re.compile(
+    rf"(?<![\w.])(\d+(?:\.\d+)?)\s*({_unit_pattern})(?![a-zA-Z])", re.I
+)
+# 末尾的 in kcal / to kcal / -> kcal 表示结果的单位
+_target = re.compile(rf"\s*(?:\bin\b|\bto\b|->|=>)\s*({_unit_pattern})\s*$", re.I)
+
+MAX_POWER = 100
+
+
+class Quantity:
+    """带量纲的数值，dims为 {基本单位: 幂次}"""
+
+    __slots__ = ("value", "dims")
+
+    def __init__(self, value: float, dims: t.Optional[t.Dict[str, int]] = None):
+        self.value = value
+        self.dims = {k: v for k, v in (dims or {}).items() if v}
+
+    @staticmethod
+    def of(x: t.Any) -> "Quantity":
+        return x if isinstance(x, Quantity) else Quantity(float(x))
+
+    def _combine(self, other: "Quantity", sign: int) -> t.Dict[str, int]:
+        dims = dict(self.dims)
+        for k, v in other.dims.items():
+            dims[k] = dims.get(k, 0) + sign * v
+        return dims
+
+    def _same(self, other: "Quantity", op: str) -> None:
+        if self.dims != other.dims:
+            raise ValueError(f"单位不一致: {self.unit()} {op} {other.unit()}")
+
+    def __add__(self, other):
+        other = Quantity.of(other)
+        self._same(other, "+")
+        return Quantity(self.value + other.value, self.dims)
+
+    def __sub__(self, other):
+        other = Quantity.of(other)
+        self._same(other, "-")
+        return Quantity(self.value - other.value, self.dims)
+
+    def __mul__(self, other):
+        other = Quantity.of(other)
+        return Quantity(self.value * other.value, self._combine(other, 1))
+
+    def __truediv__(self, other):
+        other = Quantity.of(other)
+        return Quantity(self.value / other.value, self._combine(other, -1))
+
+    def __mod__(self, other):
+        other = Quantity.of(other)
+        self._same(other, "%")
+        return Quantity(self.value % other.value, self.dims)
+
+    def __pow__(self, other):
+        other = Quantity.of(other)
+        if other.dims:
+            raise ValueError("指数不能带单位")
+        if abs(other.value) > MAX_POWER:
+            raise ValueError(f"指数过大: {other.value}")
+        if self.dims and other.value != int(other.value):
+            raise ValueError("带单位的数只能做整数次幂")
+        dims = {k: int(v * other.value) for k, v in self.dims.items()}
+        return Quantity(self.value**other.value, dims)
+
+    def __radd__(self, other):
+        return Quantity.of(other) + self
+
+    def __rsub__(self, other):
+        return Quantity.of(other) - self
+
+    def __rmul__(self, other):
+        return Quantity.of(other) * self
+
+    def __rtruediv__(self, other):
+        return Quantity.of(other) / self
+
+    def __rpow__(self, other):
+        return Quantity.of(other) ** self
+
+    def __neg__(self):
+        return Quantity(-self.value, self.dims)
+
+    def __pos__(self):
+        return self
+
+    def __lt__(self, other):
+        other = Quantity.of(other)
+        self._same(other, "<")
+        return self.value < other.value
+
+    def __gt__(self, other):
+        other = Quantity.of(other)
+        self._same(other, ">")
+        return self.value > other.value
+
+    def unit(self) -> str:
+        num = [(_unit_names[k], v) for k, v in sorted(self.dims.items()) if v > 0]
+        den = [(_unit_names[k], -v) for k, v in sorted(self.dims.items()) if v < 0]
+
+        def fmt(items):
+            return "*".join(k if v == 1 else f"{k}^{v}" for k, v in items)
+
+        text = fmt(num) or "1"
+        if den:
+            text += "/" + fmt(den)
+        return "" if text == "1" else text
+
+    def format(self, target: str = "") -> str:
+        if target:
+            base, factor = _units[target.lower()]
+            if self.dims != {base: 1}:
+                raise ValueError(
+                    f"无法将 {self.unit() or '无单位的数'} 转换为 {target}"
+                )
+            return f"{round(self.value / factor, 2)}{target}"
+        text = f"{round(self.value, 2)}"
+        unit = self.unit()
+        if unit == "kJ":
+            return f"{text}kJ ({round(self.value / 4.184, 2)}kcal)"
+        return text + unit
+
+
+_bin_ops = {ast.Add, ast.Sub, ast.Mult, ast.Div, ast.Mod, ast.Pow}
+_unary_ops = {ast.USub, ast.UAdd}
+_funcs: t.Dict[str, t.Callable] = {
+    "abs": lambda x: (
+        abs(x) if not isinstance(x, Quantity) else Quantity(abs(x.value), x.dims)
+    ),
+    "round": lambda x, n=0: (
+        round(x, int(n))
+        if not isinstance(x, Quantity)
+        else Quantity(round(x.value, int(n)), x.dims)
+    ),
+    "min": min,
+    "max": max,
+    "sqrt": math.sqrt,
+}
+_names: t.Dict[str, t.Any] = {
+    f"_u_{k}": Quantity(factor, {base: 1}) for k, (base, factor) in _units.items()
+}
+_names.update(_funcs)
+
+
+def _check(node: ast.AST) -> None:
+    """白名单校验，只允许数字、四则运算、幂、取模、单位和少量函数"""
+    for child in ast.walk(node):
+        if isinstance(child, (ast.Expression, ast.Load, ast.operator, ast.unaryop)):
+            if isinstance(child, ast.operator) and type(child) not in _bin_ops:
+                raise ValueError(f"不支持的运算: {type(child).__name__}")
+            if isinstance(child, ast.unaryop) and type(child) not in _unary_ops:
+                raise ValueError(f"不支持的运算: {type(child).__name__}")
+            continue
+        if isinstance(child, (ast.BinOp, ast.UnaryOp)):
+            continue
+        if isinstance(child, ast.Constant):
+            if not isinstance(child.value, (int, float)) or isinstance(
+                child.value, bool
+            ):
+                raise ValueError(f"不支持的常量: {child.value!r}")
+            # 统一用浮点数计算，避免 9**9**9 这类大整数运算卡死
+            child.value = float(child.value)
+            continue
+        if isinstance(child, ast.Name):
+            if child.id not in _names:
+                raise ValueError(f"未知的名称: {child.id}")
+            continue
+        if isinstance(child, ast.Call):
+            if not isinstance(child.func, ast.Name) or child.func.id not in _funcs:
+                raise ValueError("不支持的函数调用")
+            if child.keywords:
+                raise ValueError("不支持关键字参数")
+            continue
+        raise ValueError(f"不支持的语法: {type(child).__name__}")
+
+
+class Compiled(t.NamedTuple):
+    source: str  # 原始表达式
+    code: t.Optional[t.Any]  # 编译后的代码，解析失败时为None
+    target: str  # 结果单位
+    error: str  # 解析错误
+
+
+def _rewrite(exp: str) -> t.Tuple[str, str]:
+    target = ""
+    m = _target.search(exp)
+    if m:
+        target = m.group(1)
+        exp = exp[: m.start()]
+    exp = exp.replace("×", "*").replace("÷", "/").replace("^", "**")
+    exp = _quantity.sub(lambda m: f"({m.group(1)}*_u_{m.group(2).lower()})", exp)
+    return exp, target
+
+
+@functools.lru_cache(maxsize=1024)
+def compile_batch(text: str) -> t.Tuple[Compiled, ...]:
+    """
+    解析并编译逗号分隔的一批表达式，结果会被缓存。
+
+    :param text: 表达式，如 `1+1, 52kcal/100g*150g`
+    :return: 每个表达式的编译结果
+    """
+    items = []
+    for source in _split(text):
+        try:
+            exp, target = _rewrite(source)
+            tree = ast.parse(exp.strip(), mode="eval")
+            _check(tree)
+            code = compile(tree, "<calc>", "eval")
+            items.append(Compiled(source, code, target, ""))
+        except (SyntaxError, ValueError) as e:
+            items.append(Compiled(source, None, "", f"{type(e).__name__}: {e}"))
+    return tuple(items)
+
+
+def _split(text: str) -> t.List[str]:
+    """按不在括号内的逗号分隔"""
+    parts, depth, begin = [], 0, 0
+    for i, c in enumerate(text):
+        if c in "([":
+            depth += 1
+        elif c in ")]":
+            depth -= 1
+        elif c in ",，" and depth == 0:
+            parts.append(text[begin:i])
+            begin = i + 1
+    parts.append(text[begin:])
+    return [p.strip() for p in parts if p.strip()]
+
+
+def evaluate(text: str) -> t.List[t.Tuple[str, str]]:
+    """
+    计算逗号分隔的一批表达式。
+
+    :param text: 表达式，如 `1+1, 2*3`
+    :return: [(表达式, 结果或错误)]
+    """
+    results = []
+    for item in compile_batch(text):
+        if item.code is None:
+            results.append((item.source, f"Error: {item.error}"))
+            continue
+        try:
+            value = eval(item.code, {"__builtins__": {}}, _names)
+            results.append((item.source, Quantity.of(value).format(item.target)))
+        except (ArithmeticError, ValueError, TypeError) as e:
+            results.append((item.source, f"Error: {e}"))
+    return results
+
+
+if __name__ == "__main__":
+    for exp, res in evaluate(
+        "1+1, 2*3, 52kcal/100g*150g, 1000kj in kcal, 200ml*1.03, 1/0, __import__('os'), 3g+2ml"
+    ):
+        print(f"{exp} = {res}")
@@ -0,0 +1,358 @@
+"""
+CSV主存储的列式缓存，读取多年的记录时只需要映射文件，不用逐行解析。
+
+每个CSV文件对应一个目录 `<csv>.cols/`：
+
+- 每列一个定长的二进制文件 `<列名>.<代>.bin`：数值列为 float64，时间列为 int64（秒），
+  字符串列为 int32，指向字符串表中的下标
+- `strings.<代>.bin` 字符串表，每项为 `uint32长度 + utf8`，相同的字符串（如食物名）只存一份
+- `meta.json` 当前的代、已经缓存的CSV字节数、行数等，最后写入，崩溃后多出的部分会被截掉
+
+文件可能正被快照映射，只会追加，不会原地截短已经映射的部分；重建时写入新一代的文件，
+再删除旧的文件（删除不影响已有的映射）。
+
+CSV只会被追加（见 wal.Store 的压缩），读取时只解析新追加的部分；
+CSV被替换或改写（如 food_import）时重建缓存。尚未压缩的日志行不进入缓存，读取时另外返回。
+数值不合法的单元格（如空的 energy_kj）缓存为 NaN，时间不合法或缺少列的行被跳过，都只记录警告。
+"""
+
+import array
+import bisect
+import csv
+import datetime
+import io
+import json
+import logging
+import math
+import mmap
+import os
+import struct
+import threading
+import time
+import typing as t
+import zlib
+
+from src import wal
+
+logger = logging.getLogger()
+
+FLOAT = "d"  # float64
+TIME = "q"  # int64，"%Y-%m-%d %H:%M:%S" 格式时间的秒数
+STRING = "i"  # int32，字符串表中的下标
+
+VERSION = 2
+TAIL_CHECK = 4096  # 校验已缓存部分末尾的字节数，发现CSV被改写
+
+_EPOCH = datetime.datetime(1970, 1, 1)
+_SECOND = datetime.timedelta(seconds=1)
+_LEN = struct.Struct("<I")
+
+_caches: t.Dict[str, "ColumnCache"] = {}
+_caches_lock = threading.Lock()
+
+
+def to_float(text: str) -> float:
+    """不合法的数值（如空字符串）返回 NaN"""
+    try:
+        return float(text)
+    except (TypeError, ValueError):
+        return math.nan
+
+
+def to_seconds(text: str) -> int:
+    return (datetime.datetime.fromisoformat(text) - _EPOCH) // _SECOND
+
+
+def from_seconds(seconds: int) -> str:
+    return (_EPOCH + datetime.timedelta(seconds=seconds)).strftime("%Y-%m-%d %H:%M:%S")
+
+
+def _tail_crc(f: t.BinaryIO, offset: int) -> int:
+    begin = max(0, offset - TAIL_CHECK)
+    f.seek(begin)
+    return zlib.crc32(f.read(offset - begin))
+
+
+class Snapshot:
+    """某一时刻的缓存内容，列是只读的内存映射，之后的追加不影响已有的快照"""
+
+    def __init__(
+        self,
+        schema: t.List[t.Tuple[str, str]],
+        n: int,
+        columns: t.Dict[str, t.Sequence],
+        strings: t.List[str],
+        ordered: t.Dict[str, bool],
+        wal_rows: t.List[dict],
+    ):
+        self.schema = schema
+        self.n = n
+        self.columns = columns
+        self.strings = strings
+        self.ordered = ordered
+        self.wal_rows = wal_rows  # 尚未压缩到CSV的行，值未经转换
+
+    def where_time(
+        self, name: str, begin: datetime.datetime, end: datetime.datetime
+    ) -> t.Sequence[int]:
+        """时间列在 [begin, end) 中的行号，列有序时二分查找"""
+        col = self.columns[name]
+        lo, hi = (begin - _EPOCH) // _SECOND, (end - _EPOCH) // _SECOND
+        if self.ordered.get(name):
+            return range(bisect.bisect_left(col, lo), bisect.bisect_left(col, hi))
+        return [i for i, x in enumerate(col) if lo <= x < hi]
+
+    def rows(self, indices: t.Optional[t.Iterable[int]] = None) -> t.Iterator[tuple]:
+        """按schema的顺序返回各行的值：float、时间字符串和字符串"""
+        strings = self.strings
+        getters = []
+        for name, kind in self.schema:
+            col = self.columns[name]
+            if kind == FLOAT:
+                getters.append(col.__getitem__)
+            elif kind == TIME:
+                getters.append(lambda i, col=col: from_seconds(col[i]))
+            else:
+                getters.append(lambda i, col=col: strings[col[i]])
+        for i in range(self.n) if indices is None else indices:
+            yield tuple(get(i) for get in getters)
+
+
+class ColumnCache:
+    def __init__(self, store: wal.Store, schema: t.List[t.Tuple[str, str]]):
+        self.store = store
+        self.schema = schema
+        self.dir = store.csv_path + ".cols"
+        self.meta_path = os.path.join(self.dir, "meta.json")
+        self.stats = {"rows": 0, "parsed": 0, "rebuilds": 0}
+        self._meta: t.Optional[dict] = None
+        self._strings: t.List[str] = []
+        self._intern: t.Dict[str, int] = {}
+        self._maps: t.Dict[str, t.Sequence] = {}
+        self._mapped = -1  # 已映射的行数
+
+    def _col_path(self, name: str, gen: t.Optional[int] = None) -> str:
+        """列文件的路径，name为 "strings" 时为字符串表"""
+        if gen is None:
+            assert self._meta is not None
+            gen = self._meta["gen"]
+        return os.path.join(self.dir, f"{name}.{gen}.bin")
+
+    def snapshot(self) -> Snapshot:
+        """同步CSV新追加的部分，返回缓存和日志行的快照"""
+        columns, wal_rows = self.store.read_with(self._sync)
+        return Snapshot(*columns, wal_rows)
+
+    # ---------- 同步 ----------
+
+    def _sync(self, csv_path: str) -> tuple:
+        if not os.path.isfile(csv_path):
+            return self.schema, 0, self._empty(), [], {}
+        meta = self._load()
+        try:
+            with open(csv_path, "rb") as f:
+                st = os.fstat(f.fileno())
+                if meta["offset"] and (
+                    meta["ino"] != st.st_ino
+                    or st.st_size < meta["offset"]
+                    or _tail_crc(f, meta["offset"]) != meta["tail_crc"]
+                ):
+                    logger.info(f"colcache: {csv_path} rewritten, rebuild")
+                    self.stats["rebuilds"] += 1
+                    meta = self._reset()
+                if st.st_size > meta["offset"]:
+                    meta["ino"] = st.st_ino
+                    self._append(f, meta)
+        except BaseException:
+            # 内存中的状态可能和文件不一致，下次从文件重新加载
+            self._meta, self._strings, self._intern = None, [], {}
+            raise
+        self._map(meta["rows"])
+        self.stats["rows"] = meta["rows"]
+        return (
+            self.schema,
+            meta["rows"],
+            dict(self._maps),
+            self._strings,
+            dict(meta["ordered"]),
+        )
+
+    def _append(self, f: t.BinaryIO, meta: dict) -> None:
+        """解析CSV从 meta["offset"] 开始的新行，追加到各列"""
+        f.seek(meta["offset"])
+        data = f.read()
+        data = data[: data.rfind(b"\n") + 1]  # 只处理完整的行
+        if not data:
+            return
+        reader = csv.reader(io.StringIO(data.decode(), newline=""))
+        if not meta["header"]:
+            meta["header"] = next(reader)
+        pos = {name: meta["header"].index(name) for name, _ in self.schema}
+
+        values: t.Dict[str, array.array] = {
+            name: array.array(kind) for name, kind in self.schema
+        }
+        new_strings: t.List[str] = []
+        n, skipped, nan = 0, 0, 0
+        for row in reader:
+            if not row:
+                continue
+            try:
+                texts = [row[pos[name]] for name, _ in self.schema]
+                times = {
+                    name: to_seconds(texts[i])
+                    for i, (name, kind) in enumerate(self.schema)
+                    if kind == TIME
+                }
+            except (IndexError, ValueError):
+                skipped += 1
+                continue
+            for (name, kind), text in zip(self.schema, texts):
+                if kind == FLOAT:
+                    value = to_float(text)
+                    nan += value != value
+                    values[name].append(value)
+                elif kind == TIME:
+                    seconds = times[name]
+                    if seconds < meta["last"].get(name, seconds):
+                        meta["ordered"][name] = False
+                    meta["last"][name] = seconds
+                    values[name].append(seconds)
+                else:
+                    idx = self._intern.get(text)
+                    if idx is None:
+                        idx = self._intern[text] = len(self._strings)
+                        self._strings.append(text)
+                        new_strings.append(text)
+                    values[name].append(idx)
+            n += 1
+
+        for name, _ in self.schema:
+            with open(self._col_path(name), "ab") as out:
+                values[name].tofile(out)
+        with open(self._col_path("strings"), "ab") as out:
+            for s in new_strings:
+                b = s.encode()
+                out.write(_LEN.pack(len(b)) + b)
+            meta["strings_size"] = out.tell()
+        meta["rows"] += n
+        meta["offset"] += len(data)
+        meta["tail_crc"] = _tail_crc(f, meta["offset"])
+        self._save(meta)
+        self.stats["parsed"] += n
+        if skipped or nan:
+            logger.warning(
+                f"colcache: {self.store.csv_path}: skipped {skipped} malformed rows, "
+                f"{nan} non-numeric cells cached as NaN"
+            )
+        logger.info(f"colcache: {n} rows appended to {self.dir}")
+
+    # ---------- 元数据 ----------
+
+    def _fresh(self) -> dict:
+        return {
+            "version": VERSION,
+            "gen": time.time_ns(),
+            "schema": self.schema,
+            "ino": 0,
+            "offset": 0,
+            "tail_crc": 0,
+            "header": [],
+            "rows": 0,
+            "strings_size": 0,
+            "ordered": {name: True for name, kind in self.schema if kind == TIME},
+            "last": {},
+        }
+
+    def _reset(self) -> dict:
+        """开始新一代的空文件，旧的文件可能仍被快照映射，不能截短，只能删除"""
+        os.makedirs(self.dir, exist_ok=True)
+        meta = self._fresh()
+        names = [name for name, _ in self.schema] + ["strings"]
+        for name in names:
+            open(self._col_path(name, meta["gen"]), "xb").close()
+        self._strings, self._intern = [], {}
+        self._maps, self._mapped = {}, -1
+        self._save(meta)
+        keep = {os.path.basename(self._col_path(name)) for name in names}
+        for f in os.listdir(self.dir):
+            if f.endswith(".bin") and f not in keep:
+                os.remove(os.path.join(self.dir, f))
+        return meta
+
+    def _load(self) -> dict:
+        if self._meta is not None:
+            return self._meta
+        try:
+            with open(self.meta_path, "r") as f:
+                meta = json.load(f)
+            if meta["version"] != VERSION or meta["schema"] != [
+                list(x) for x in self.schema
+            ]:
+                raise ValueError("version or schema changed")
+            # 截掉崩溃或追加失败时写入了一半的部分，它们在meta记录的行数之后，没有被映射
+            sizes = {
+                name: meta["rows"] * array.array(kind).itemsize
+                for name, kind in self.schema
+            }
+            sizes["strings"] = meta["strings_size"]
+            for name, size in sizes.items():
+                path = self._col_path(name, meta["gen"])
+                if os.path.getsize(path) < size:
+                    raise ValueError(f"{name} shorter than meta")
+                if os.path.getsize(path) > size:
+                    os.truncate(path, size)
+            with open(self._col_path("strings", meta["gen"]), "rb") as f:
+                data = f.read()
+            pos = 0
+            while pos < len(data):
+                (size,) = _LEN.unpack_from(data, pos)
+                self._strings.append(data[pos + 4 : pos + 4 + size].decode())
+                pos += 4 + size
+            self._intern = {s: i for i, s in enumerate(self._strings)}
+            self._meta = meta
+        except (OSError, ValueError, KeyError) as e:
+            if os.path.exists(self.meta_path):
+                logger.warning(f"colcache: drop {self.dir}: {e}")
+            self._meta = self._reset()
+        return self._meta
+
+    def _save(self, meta: dict) -> None:
+        tmp = self.meta_path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(meta, f)
+        os.replace(tmp, self.meta_path)
+        self._meta = meta
+
+    def _empty(self) -> t.Dict[str, t.Sequence]:
+        return {name: memoryview(b"").cast(kind) for name, kind in self.schema}
+
+    def _map(self, rows: int) -> None:
+        """映射各列的前rows行，已有的快照继续使用旧的映射"""
+        if rows == self._mapped:
+            return
+        if rows == 0:
+            self._maps, self._mapped = self._empty(), 0
+            return
+        maps = {}
+        for name, kind in self.schema:
+            size = rows * array.array(kind).itemsize
+            with open(self._col_path(name), "rb") as f:
+                mm = mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ)
+            maps[name] = memoryview(mm).cast(kind)
+        self._maps, self._mapped = maps, rows
+
+
+def cache(store: wal.Store, schema: t.List[t.Tuple[str, str]]) -> ColumnCache:
+    """获取存储对应的列式缓存
+
+    :param schema: [(字段名, FLOAT/TIME/STRING)]，顺序即 Snapshot.rows 返回值的顺序
+    """
+    with _caches_lock:
+        if store.csv_path not in _caches:
+            _caches[store.csv_path] = ColumnCache(store, schema)
+        return _caches[store.csv_path]
+
+
+def stats() -> t.Dict[str, dict]:
+    return {path: dict(c.stats) for path, c in _caches.items()}
@@ -1,5 +1,5 @@
 import typing as t
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 import os
 from string import Template
 
@@ -14,40 +14,74 @@ class _config:
     dashscope_api_key: str
     gemini_host: str = "https://generativelanguage.googleapis.com"
     litellm_host: str = "http://127.0.0.1:4000"
+    allowed_chat_ids: t.List[int] = field(default_factory=list)  # 逗号分隔
+    chat_models: t.List[str] = field(default_factory=list)  # 逗号分隔，按偏好排序
+    vision_models: t.List[str] = field(default_factory=list)  # 逗号分隔，按偏好排序
+    daily_summary_time: str = ""  # 每日总结的推送时间，如 21:30，为空时不推送
 
     def fix_type(self):
         if isinstance(self.admin_chat_id, str):
             self.admin_chat_id = int(self.admin_chat_id)
+        if isinstance(self.allowed_chat_ids, str):
+            ids = self.allowed_chat_ids.split(",")
+            self.allowed_chat_ids = [int(x) for x in ids if x.strip()]
+        if isinstance(self.chat_models, str):
+            names = self.chat_models.split(",")
+            self.chat_models = [x.strip() for x in names if x.strip()]
+        if isinstance(self.vision_models, str):
+            names = self.vision_models.split(",")
+            self.vision_models = [x.strip() for x in names if x.strip()]
 
 
-_values: dict = {}
+app: _config
+daily_diet_kcal: int  # 默认的每日热量摄入限额，租户可单独设置
+daily_diet_kj: float  # 默认的每日热量摄入限额，租户可单独设置
 
-# Load values from environment variables and .env files
-for f in ["~/.config/.env", "/config/.env", ".env", os.environ.get("ENV_FILE", "")]:
-    if "~" in f:
-        f = os.path.expanduser(f)
-    if f and os.path.isfile(f):
-        _values.update(dotenv.dotenv_values(f))
 
-# 处理变量
-_keys = _values.keys()
-_values.update(os.environ)
-for k in _keys:
-    if "$" in _values[k]:
-        t = Template(_values[k])
-        try:
-            _values[k] = t.substitute(_values)
-        except KeyError as e:
-            raise KeyError(f"var in {repr(_values[k])} not found: {e}")
+def _load_app() -> _config:
+    values: dict = {}
 
-_values = {k: v for k, v in _values.items() if k in _config.__dataclass_fields__}
-app = _config(**_values)
-app.fix_type()
+    # Load values from environment variables and .env files
+    for f in ["~/.config/.env", "/config/.env", ".env", os.environ.get("ENV_FILE", "")]:
+        if "~" in f:
+            f = os.path.expanduser(f)
+        if f and os.path.isfile(f):
+            values.update(dotenv.dotenv_values(f))
 
+    # 处理变量
+    keys = values.keys()
+    values.update(os.environ)
+    for k in keys:
+        if "$" in values[k]:
+            tpl = Template(values[k])
+            try:
+                values[k] = tpl.substitute(values)
+            except KeyError as e:
+                raise KeyError(f"var in {repr(values[k])} not found: {e}")
+
+    values = {k: v for k, v in values.items() if k in _config.__dataclass_fields__}
+    cfg = _config(**values)
+    cfg.fix_type()
+    return cfg
+
+
+def load() -> None:
+    """加载（或重新加载）配置。首次访问配置项时会自动调用，导入本模块时不做任何文件IO"""
+    global app, daily_diet_kcal, daily_diet_kj
+    new_app = _load_app()
+    with open(".data/daily_diet_kcal", "r") as f:
+        kcal = int(f.read())
+    # 全部读取成功后再替换，避免重载失败时配置只更新了一半
+    app, daily_diet_kcal, daily_diet_kj = new_app, kcal, kcal * 4.184
+
+
+def __getattr__(name: str) -> t.Any:
+    if name in ("app", "daily_diet_kcal", "daily_diet_kj"):
+        load()
+        return globals()[name]
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
-with open(".data/daily_diet_kcal", "r") as f:
-    daily_diet_kcal = int(f.read())  # 每日热量摄入限额
-    daily_diet_kj = daily_diet_kcal * 4.184  # 每日热量摄入限额
 
 if __name__ == "__main__":
+    load()
     print(app)
@@ -0,0 +1,333 @@
+"""
+批量导入食物营养数据到食物数据库（food_db.csv）。
+
+支持 CSV、JSON 数组和 JSON Lines，流式读取，按批校验和归一化（单位、kJ/kcal），
+按名称与已有数据去重，最后一次性原子写入。
+
+导入期间独占食物数据库的存储（见 wal.Store.locked），可以在机器人运行时执行，
+机器人对食物数据库的写入会等待导入完成。
+
+用法: python src/food_import.py <文件> [--chat-id ID] [--rejects rejects.csv]
+"""
+
+import argparse
+import collections
+import csv
+import dataclasses
+import json
+import logging
+import os
+import re
+import shutil
+import sys
+import tempfile
+import time
+import typing as t
+
+if __name__ == "__main__":
+    sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+
+from src import tenant, utils
+from src.functions.diet_record import FoodNutrition
+
+logger = logging.getLogger()
+
+BATCH_SIZE = 5000
+KCAL_TO_KJ = 4.184
+MAX_KJ_PER_100 = 3900  # 纯脂肪约3700kj/100g，超过视为数据错误
+
+# 源数据字段名 -> FoodNutrition字段
+_aliases = {
+    "name": ["name", "food_name", "食物", "食物名称", "名称", "food"],
+    "per_unit": ["per_unit", "unit", "每份", "单位", "serving"],
+    "energy_kj": ["energy_kj", "kj", "energy(kj)", "能量(kj)", "能量kj", "热量kj"],
+    "energy_kcal": [
+        "energy_kcal",
+        "kcal",
+        "calories",
+        "energy(kcal)",
+        "能量(kcal)",
+        "热量",
+        "能量",
+        "热量kcal",
+    ],
+    "protein": ["protein", "蛋白质", "蛋白质(g)"],
+    "fat": ["fat", "脂肪", "脂肪(g)"],
+    "carbs": ["carbs", "carbohydrate", "碳水化合物", "碳水化合物(g)", "碳水"],
+    "remark": ["remark", "备注", "note", "source"],
+}
+_alias_index = {a.lower(): k for k, names in _aliases.items() for a in names}
+
+_number = re.compile(r"^\s*(-?\d+(?:\.\d+)?)\s*([a-zA-Z一-鿿]*)\s*$")
+_units = {
+    "g": "g",
+    "克": "g",
+    "kg": "kg",
+    "千克": "kg",
+    "公斤": "kg",
+    "ml": "ml",
+    "毫升": "ml",
+    "l": "l",
+    "升": "l",
+    "份": "份",
+    "个": "个",
+    "杯": "杯",
+    "碗": "碗",
+}
+
+
+class Reject(Exception):
+    pass
+
+
+def normalize_name(name: str) -> str:
+    """名称索引使用的键：去掉首尾空白、合并空白、小写"""
+    return " ".join(name.split()).lower()
+
+
+def _parse_number(value: t.Any, field: str) -> t.Tuple[float, str]:
+    if isinstance(value, (int, float)):
+        return float(value), ""
+    m = _number.match(str(value or "").replace(",", ""))
+    if not m:
+        raise Reject(f"bad {field}")
+    return float(m.group(1)), m.group(2).lower()
+
+
+def _normalize_unit(value: t.Any) -> str:
+    if not value:
+        return "100g"
+    text = str(value).strip().lower().removeprefix("每").removeprefix("per")
+    m = _number.match(text)
+    if not m:
+        unit = _units.get(text.strip())
+        if unit:
+            return f"1{unit}"
+        return text.strip()
+    amount, unit = m.group(1), m.group(2)
+    return f"{amount}{_units.get(unit, unit or 'g')}"
+
+
+def _rename(row: dict) -> dict:
+    out = {}
+    for k, v in row.items():
+        key = _alias_index.get(str(k).strip().lower())
+        if key and key not in out:
+            out[key] = v
+    return out
+
+
+def normalize_batch(
+    rows: t.List[dict],
+) -> t.Tuple[t.List[FoodNutrition], t.List[t.Tuple[dict, str]]]:
+    """
+    校验并归一化一批原始数据。
+
+    :param rows: 原始数据（任意字段名）
+    :return: (合法的食物, [(原始数据, 拒绝原因)])
+    """
+    ok: t.List[FoodNutrition] = []
+    rejects: t.List[t.Tuple[dict, str]] = []
+    renamed = [_rename(row) for row in rows]
+    for raw, row in zip(rows, renamed):
+        try:
+            name = str(row.get("name") or "").strip()
+            if not name:
+                raise Reject("missing name")
+            if row.get("energy_kj") not in (None, ""):
+                energy, unit = _parse_number(row["energy_kj"], "energy")
+                energy = (
+                    energy * KCAL_TO_KJ if unit in ("kcal", "千卡", "大卡") else energy
+                )
+            elif row.get("energy_kcal") not in (None, ""):
+                energy, unit = _parse_number(row["energy_kcal"], "energy")
+                energy = energy if unit in ("kj", "千焦") else energy * KCAL_TO_KJ
+            else:
+                raise Reject("missing energy")
+            protein, _ = _parse_number(row.get("protein", 0) or 0, "protein")
+            fat, _ = _parse_number(row.get("fat", 0) or 0, "fat")
+            carbs, _ = _parse_number(row.get("carbs", 0) or 0, "carbs")
+            if min(energy, protein, fat, carbs) < 0:
+                raise Reject("negative value")
+            per_unit = _normalize_unit(row.get("per_unit"))
+            if per_unit in ("100g", "100ml"):
+                if energy > MAX_KJ_PER_100:
+                    raise Reject("energy too high")
+                if protein + fat + carbs > 100:
+                    raise Reject("macros exceed 100g")
+            remark = str(row.get("remark") or "").strip()
+            ok.append(
+                FoodNutrition(
+                    name,
+                    per_unit,
+                    round(energy, 1),
+                    round(protein, 2),
+                    round(fat, 2),
+                    round(carbs, 2),
+                    remark,
+                )
+            )
+        except Reject as e:
+            rejects.append((raw, str(e)))
+    return ok, rejects
+
+
+def _iter_json(f: t.TextIO) -> t.Iterator[dict]:
+    """流式读取JSON数组或JSON Lines"""
+    decoder = json.JSONDecoder()
+    buf = ""
+    started = False
+    while True:
+        chunk = f.read(1 << 16)
+        buf += chunk
+        pos = 0
+        while True:
+            while pos < len(buf) and buf[pos] in " \t\r\n,":
+                pos += 1
+            if not started and pos < len(buf) and buf[pos] == "[":
+                started = True
+                pos += 1
+                continue
+            if pos < len(buf) and buf[pos] == "]":
+                pos += 1
+                continue
+            if pos >= len(buf):
+                break
+            try:
+                obj, end = decoder.raw_decode(buf, pos)
+            except json.JSONDecodeError:
+                if not chunk:
+                    raise
+                break  # 数据不完整，继续读取
+            if isinstance(obj, dict):
+                yield obj
+            pos = end
+        buf = buf[pos:]
+        if not chunk:
+            return
+
+
+def iter_rows(filepath: str) -> t.Iterator[dict]:
+    with open(filepath, "r", encoding="utf-8-sig", newline="") as f:
+        if filepath.lower().endswith((".json", ".jsonl", ".ndjson")):
+            yield from _iter_json(f)
+        else:
+            yield from csv.DictReader(f)
+
+
+def _batches(rows: t.Iterator[dict], size: int) -> t.Iterator[t.List[dict]]:
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def import_foods(filepath: str, rejects_path: str = "") -> dict:
+    """
+    导入文件中的食物到当前租户的食物数据库。
+
+    :param filepath: CSV/JSON/JSONL 文件路径
+    :param rejects_path: 被拒绝的数据写入该CSV文件，为空则不写
+    :return: 导入统计
+    """
+    store = FoodNutrition.store()
+    with store.locked():
+        # 先把预写日志中的食物合并到CSV，再整体替换
+        store.compact_sync()
+        return _import(filepath, rejects_path)
+
+
+def _import(filepath: str, rejects_path: str) -> dict:
+    begin = time.time()
+    db_loc = FoodNutrition.db_loc()
+    fieldnames = list(FoodNutrition.__annotations__.keys())
+    known = set()
+    if os.path.isfile(db_loc):
+        with open(db_loc, "r") as f:
+            known = {normalize_name(row["name"]) for row in csv.DictReader(f)}
+
+    total, duplicates = 0, 0
+    reasons: t.Counter[str] = collections.Counter()
+    rejects_file = open(rejects_path, "w", newline="") if rejects_path else None
+    rejects_writer = None
+    # 写入临时文件，全部成功后原子替换，中途失败不会影响原数据库
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(db_loc), suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w", newline="") as out:
+            if os.path.isfile(db_loc):
+                with open(db_loc, "r") as f:
+                    out.write(f.read())
+            writer = csv.DictWriter(out, fieldnames=fieldnames)
+            if out.tell() == 0:
+                writer.writeheader()
+            for batch in _batches(iter_rows(filepath), BATCH_SIZE):
+                total += len(batch)
+                foods, rejects = normalize_batch(batch)
+                rows = []
+                for food in foods:
+                    key = normalize_name(food.name)
+                    if key in known:
+                        duplicates += 1
+                        continue
+                    known.add(key)
+                    rows.append(dataclasses.asdict(food))
+                writer.writerows(rows)
+                for raw, reason in rejects:
+                    reasons[reason] += 1
+                    if rejects_file:
+                        if rejects_writer is None:
+                            rejects_writer = csv.writer(rejects_file)
+                            rejects_writer.writerow(["reason", "row"])
+                        rejects_writer.writerow(
+                            [reason, json.dumps(raw, ensure_ascii=False)]
+                        )
+            out.flush()
+            os.fsync(out.fileno())
+        if os.path.isfile(db_loc):
+            shutil.copymode(db_loc, tmp_path)
+        else:
+            os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, db_loc)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+    finally:
+        if rejects_file:
+            rejects_file.close()
+
+    cost = time.time() - begin
+    rejected = sum(reasons.values())
+    imported = total - rejected - duplicates
+    return {
+        "total": total,
+        "imported": imported,
+        "duplicates": duplicates,
+        "rejected": rejected,
+        "reject_reasons": dict(reasons),
+        "seconds": round(cost, 3),
+        "rows_per_second": round(total / cost) if cost > 0 else total,
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="批量导入食物营养数据")
+    parser.add_argument("file", help="CSV/JSON/JSONL 文件")
+    parser.add_argument(
+        "--chat-id", type=int, default=None, help="导入到该租户，默认管理员"
+    )
+    parser.add_argument("--rejects", default="", help="被拒绝的数据写入该CSV文件")
+    args = parser.parse_args()
+
+    utils.init_logger()
+    chat_id = tenant.current() if args.chat_id is None else args.chat_id
+    with tenant.use(chat_id):
+        stats = import_foods(args.file, args.rejects)
+    print(json.dumps(stats, ensure_ascii=False, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -3,13 +3,10 @@ import os
 import sys
 import logging
 
-import aiohttp
-
-
 if __name__ == "__main__":
     sys.path.append(os.path.join(os.path.dirname(__file__), "..", ".."))
 
-from src import config, recorder
+from src import config, recorder, http_client, calc_engine, singleflight, long_memory
 
 logger = logging.getLogger()
 
@@ -17,25 +14,27 @@ logger = logging.getLogger()
 async def calc(exp: str) -> str:
     """
     Calculate the expression and return the result. support multiple expressions, separated by comma(,).
+    Numbers can carry units (g, kg, ml, l, kJ, kcal), and a trailing `in <unit>` converts the result.
 
-    :param exp: The expression to be calculated, e.g. 1+1, 2*3
+    :param exp: The expression to be calculated, e.g. 1+1, 2*3, 52kcal/100g*150g in kJ
     :return: The result of the calculation.
     """
-    try:
-        if "," in exp:
-            exps = [e.strip() for e in exp.split(",")]
-        else:
-            exps = [exp]
-        results = []
-        for exp in exps:
-            result = eval(exp)
-            result = round(float(result), 2)
-            results.append(f"{exp} = {result}")
-        return "\n".join(results)
-    except (SyntaxError, NameError, ZeroDivisionError) as e:
-        return f"Error: {e}"
+    results = calc_engine.evaluate(exp)
+    return "\n".join([f"{e} = {r}" for e, r in results])
+
+
+async def remember_fact(fact: str) -> str:
+    """
+    Save a long-term fact about the user, e.g. allergies, goals, body weight or eating habits, so it can be recalled in later conversations.
+
+    :param fact: The fact to remember, in one sentence.
+    :return: A success message.
+    """
+    await long_memory.add("fact", fact)
+    return "success"
 
 
+@singleflight.coalesce("google_search", key=lambda query: singleflight.normalize(query))
 async def google_search(query: str) -> str:
     """
     Search for the query on Google and return the search results.
@@ -54,7 +53,7 @@ async def google_search(query: str) -> str:
     req_str = json.dumps(payload, ensure_ascii=False)
     logger.info(f"google search: {req_str}")
 
-    async with aiohttp.ClientSession() as session:
+    async with http_client.new_session() as session:
         async with session.post(url, json=payload) as response:
             text = await response.text()
             recorder.record("google search", text)
@@ -73,7 +72,7 @@ if __name__ == "__main__":
     import asyncio
 
     async def _local_test():
-        print(await calc("1+1, 2*3"))
+        print(await calc("1+1, 2*3, 52kcal/100g*150g in kJ"))
         # print(await google_search("apple"))
 
     asyncio.run(_local_test())
@@ -1,25 +1,35 @@
+import asyncio
 import csv
-from dataclasses import dataclass
+from dataclasses import asdict, dataclass
 import datetime
+import io
 import json
 import logging
 import typing as t
 import os
 
-import aiohttp
-
 if __name__ == "__main__":
     import sys
     import os
 
     sys.path.append(os.path.join(os.path.dirname(__file__), "..", ".."))
 
-from src import config, utils, recorder
+from src import (
+    colcache,
+    config,
+    utils,
+    recorder,
+    http_client,
+    tenant,
+    singleflight,
+    wal,
+    tool_output,
+)
 
 logger = logging.getLogger()
 
 
-@dataclass
+@dataclass(slots=True)
 class FoodNutrition:
     name: str
     per_unit: str
@@ -31,16 +41,47 @@ class FoodNutrition:
 
     @staticmethod
     def db_loc():
-        return ".data/food_db.csv"
+        return tenant.path("food_db.csv")
+
+    @staticmethod
+    def store() -> wal.Store:
+        return wal.store(FoodNutrition.db_loc(), FoodNutrition.__annotations__.keys())
 
     @staticmethod
-    def from_dict(d: dict):
+    def columns() -> colcache.ColumnCache:
+        return colcache.cache(FoodNutrition.store(), FOOD_COLUMNS)
+
+    @staticmethod
+    def from_dict(d: dict) -> "FoodNutrition":
+        d = dict(d)
+        for field in ["energy_kj", "protein", "fat", "carbs"]:
+            # 旧的或模型添加的食物可能缺少数值，和列式缓存一样作为 NaN
+            d[field] = colcache.to_float(d[field])
         return FoodNutrition(**d)
 
     def __str__(self) -> str:
         return f"{self.name} ({self.per_unit}): 热量 {self.energy_kj}kj, 蛋白质 {self.protein}g, 脂肪 {self.fat}g, 碳水化合物 {self.carbs}g, 备注 {self.remark}"
 
 
+# 列式缓存的字段，顺序和类的字段相同
+FOOD_COLUMNS = [
+    ("name", colcache.STRING),
+    ("per_unit", colcache.STRING),
+    ("energy_kj", colcache.FLOAT),
+    ("protein", colcache.FLOAT),
+    ("fat", colcache.FLOAT),
+    ("carbs", colcache.FLOAT),
+    ("remark", colcache.STRING),
+]
+
+
+def read_foods() -> t.List[FoodNutrition]:
+    snap = FoodNutrition.columns().snapshot()
+    foods = [FoodNutrition(*row) for row in snap.rows()]
+    foods.extend(FoodNutrition.from_dict(x) for x in snap.wal_rows)
+    return foods
+
+
 async def add_food_to_database(
     name: str,
     per_unit: str,
@@ -63,17 +104,11 @@ async def add_food_to_database(
     :return: A success message.
     """
     item = FoodNutrition(name, per_unit, energy_kj, protein, fat, carbs, remark)
-    if not os.path.isfile(item.db_loc()):
-        with open(item.db_loc(), "w") as f:
-            writer = csv.DictWriter(f, fieldnames=item.__annotations__.keys())
-            writer.writeheader()
-    with open(item.db_loc(), "a") as f:
-        writer = csv.DictWriter(f, fieldnames=item.__annotations__.keys())
-        writer.writerow(item.__dict__)
+    await item.store().append(asdict(item))
     return "success"
 
 
-@dataclass
+@dataclass(slots=True)
 class DietRecord:
     food_name: str
     amount: str
@@ -85,7 +120,15 @@ class DietRecord:
 
     @staticmethod
     def db_loc():
-        return ".data/diet_record.csv"
+        return tenant.path("diet_record.csv")
+
+    @staticmethod
+    def store() -> wal.Store:
+        return wal.store(DietRecord.db_loc(), DietRecord.__annotations__.keys())
+
+    @staticmethod
+    def columns() -> colcache.ColumnCache:
+        return colcache.cache(DietRecord.store(), DIET_COLUMNS)
 
     @staticmethod
     def from_dict(d: dict) -> "DietRecord":
@@ -100,6 +143,32 @@ class DietRecord:
         return f"{self.datetime}: {self.food_name} ({self.amount}): 热量 {self.energy_kj}kj, 蛋白质 {self.protein}g, 脂肪 {self.fat}g, 碳水化合物 {self.carbs}g"
 
 
+DIET_COLUMNS = [
+    ("food_name", colcache.STRING),
+    ("amount", colcache.STRING),
+    ("energy_kj", colcache.FLOAT),
+    ("protein", colcache.FLOAT),
+    ("fat", colcache.FLOAT),
+    ("carbs", colcache.FLOAT),
+    ("datetime", colcache.TIME),
+]
+
+
+def read_day(day: datetime.date) -> t.List[DietRecord]:
+    """某一天的饮食记录，已压缩的部分从列式缓存中按时间二分查找"""
+    begin = datetime.datetime.combine(day, datetime.time())
+    snap = DietRecord.columns().snapshot()
+    rows = snap.rows(snap.where_time("datetime", begin, begin + datetime.timedelta(1)))
+    records = [DietRecord(*row) for row in rows]
+    prefix = day.strftime("%Y-%m-%d")
+    records.extend(
+        DietRecord.from_dict(x)
+        for x in snap.wal_rows
+        if x["datetime"].startswith(prefix)
+    )
+    return records
+
+
 async def add_diet_record(
     food_name: str,
     amount: str,
@@ -121,55 +190,72 @@ async def add_diet_record(
     """
     now = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
     record = DietRecord(food_name, amount, energy_kj, protein, fat, carbs, now)
-    if not os.path.isfile(record.db_loc()):
-        with open(record.db_loc(), "w") as f:
-            writer = csv.DictWriter(f, fieldnames=record.__annotations__.keys())
-            writer.writeheader()
-    with open(record.db_loc(), "a") as f:
-        writer = csv.DictWriter(f, fieldnames=record.__annotations__.keys())
-        writer.writerow(record.__dict__)
+    await record.store().append(asdict(record))
     return "success"
 
 
 async def _query_diet_record(days_offset: int = 0) -> t.List[DietRecord]:
-    now = datetime.datetime.now()
-    prefix = (now - datetime.timedelta(days=days_offset)).strftime("%Y-%m-%d")
-    records = []
-    if os.path.isfile(DietRecord.db_loc()):
-        with open(DietRecord.db_loc(), "r") as f:
-            reader = csv.DictReader(f)
-            records = map(DietRecord.from_dict, reader)
-            records = [x for x in records if x.datetime.startswith(prefix)]
-    return records
+    # 在线程中读取文件，不阻塞事件循环
+    return await asyncio.to_thread(_read_diet_record, days_offset)
 
 
-async def query_diet_record(days_offset: int = 0) -> str:
+def _read_diet_record(days_offset: int = 0) -> t.List[DietRecord]:
+    return read_day(datetime.date.today() + datetime.timedelta(days=days_offset))
+
+
+async def query_diet_record(days_offset: int = 0, offset: int = 0) -> str:
     """
-    Query the user's dietary records within a day
+    Query the user's dietary records within a day, as CSV with a totals row
 
     :param days_offset: The number of days to offset from today. 0 means today, -1 means yesterday.
+    :param offset: Row offset starting from 0, used when the result says more rows are available.
     """
     if isinstance(days_offset, str):
         days_offset = int(days_offset)
+    if isinstance(offset, str):
+        offset = int(offset)
     if days_offset > 0:
         return "不支持查询未来的记录"
     records = await _query_diet_record(days_offset)
     if not records:
         return "没有找到记录"
-    return "\n".join([str(x) for x in records])
-
-
+    num = tool_output.num
+    header = ["时间", "食物", "数量", "热量kj", "蛋白质g", "脂肪g", "碳水g"]
+    header[0] = f"时间({records[0].datetime[:10]})"
+    rows = [
+        [
+            x.datetime[11:16],
+            x.food_name,
+            x.amount,
+            num(x.energy_kj),
+            num(x.protein),
+            num(x.fat),
+            num(x.carbs),
+        ]
+        for x in records
+    ]
+    totals = ["合计", f"{len(records)}条", ""]
+    for field in ["energy_kj", "protein", "fat", "carbs"]:
+        totals.append(num(sum(getattr(x, field) for x in records)))
+    result = tool_output.table(header, rows, totals, offset)
+    tool_output.report(
+        "query_diet_record", "\n".join([str(x) for x in records]), result
+    )
+    return result
+
+
+# 提示词中包含租户的食物数据库，只合并同一租户的查询
+@singleflight.coalesce(
+    "query_food_nutrition",
+    key=lambda name: (tenant.current(), singleflight.normalize(name)),
+)
 async def query_food_nutrition(name: str) -> str:
     """
     Query the nutrition information of a food item.
 
     :param name: The name of the food item.
     """
-    already_known: t.List[FoodNutrition] = []
-    if os.path.isfile(FoodNutrition.db_loc()):
-        with open(FoodNutrition.db_loc(), "r") as f:
-            reader = csv.DictReader(f)
-            already_known = [FoodNutrition.from_dict(row) for row in reader]
+    already_known = await asyncio.to_thread(read_foods)
 
     payload = {
         "contents": [],
@@ -181,10 +267,27 @@ async def query_food_nutrition(name: str) -> str:
 
     prompt = f"你是一个经验丰富的营养师，可以通过已知信息或搜索引擎查询食物的营养信息。我们现在需要查询`{name}`的营养成分信息，"
     prompt += "包括每份的数量（如 每100g）、热量（单位：千焦，注意不是千卡）、蛋白质含量（单位：克）、脂肪含量（单位：克）、碳水化合物含量（单位：克）等。"
+    prompt += "回答尽量简洁，最后用CSV给出结果，表头为：名称,每份,热量kj,蛋白质g,脂肪g,碳水g,备注"
     add_text(prompt)
     if already_known:
-        lines = [str(x) for x in already_known]
-        add_text("已知食物信息：\n" + "\n".join(lines))
+        header = ["名称", "每份", "热量kj", "蛋白质g", "脂肪g", "碳水g", "备注"]
+        lines = io.StringIO()
+        writer = csv.writer(lines, lineterminator="\n")
+        writer.writerow(header)
+        num = tool_output.num
+        for x in already_known:
+            writer.writerow(
+                [
+                    x.name,
+                    x.per_unit,
+                    num(x.energy_kj),
+                    num(x.protein),
+                    num(x.fat),
+                    num(x.carbs),
+                    x.remark,
+                ]
+            )
+        add_text("已知食物信息：\n" + lines.getvalue())
 
     req_str = json.dumps(payload, ensure_ascii=False)
     uuid = utils.get_random_str(10)
@@ -193,7 +296,7 @@ async def query_food_nutrition(name: str) -> str:
 
     model = "gemini-2.0-flash"
     url = f"{config.app.gemini_host}/v1beta/models/{model}:generateContent?key={config.app.gemini_key}"
-    async with aiohttp.ClientSession() as session:
+    async with http_client.new_session() as session:
         async with session.post(url, json=payload) as response:
             text = await response.text()
             hds_str = "\n".join([f"{k}: {v}" for k, v in response.headers.items()])
@@ -205,7 +308,9 @@ async def query_food_nutrition(name: str) -> str:
             resp_js = json.loads(text)
             parts = resp_js["candidates"][0]["content"]["parts"]
             full_text = "\n".join([part["text"] for part in parts])
-            return full_text
+            result = tool_output.truncate(full_text)
+            tool_output.report("query_food_nutrition", full_text, result)
+            return result
 
 
 async def main():
@@ -219,6 +324,4 @@ async def main():
 
 
 if __name__ == "__main__":
-    import asyncio
-
     asyncio.run(main())
@@ -1,11 +1,18 @@
-import csv
-from dataclasses import dataclass
+import asyncio
+from dataclasses import asdict, dataclass
 import datetime
 import os
 import typing as t
 
+if __name__ == "__main__":
+    import sys
+
+    sys.path.append(os.path.join(os.path.dirname(__file__), "..", ".."))
+
+from src import tenant, tool_output, wal
+
 
-@dataclass
+@dataclass(slots=True)
 class FitnessRecord:
     datetime: str
     name: str
@@ -14,7 +21,11 @@ class FitnessRecord:
 
     @staticmethod
     def db_loc():
-        return ".data/fitness_record.csv"
+        return tenant.path("fitness_record.csv")
+
+    @staticmethod
+    def store() -> wal.Store:
+        return wal.store(FitnessRecord.db_loc(), FitnessRecord.__annotations__.keys())
 
     @staticmethod
     def from_dict(d: dict):
@@ -41,39 +52,37 @@ async def add_fitness_record(
     """
     now = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
     record = FitnessRecord(now, name, duration, remark)
-    if not os.path.isfile(record.db_loc()):
-        with open(record.db_loc(), "w") as f:
-            writer = csv.DictWriter(f, fieldnames=record.__annotations__.keys())
-            writer.writeheader()
-    with open(record.db_loc(), "a") as f:
-        writer = csv.DictWriter(f, fieldnames=record.__annotations__.keys())
-        writer.writerow(record.__dict__)
+    await record.store().append(asdict(record))
     return "success"
 
 
-async def query_fitness_record(days_offset=0) -> str:
+async def query_fitness_record(days_offset=0, offset: int = 0) -> str:
     """
     查询用户的运动记录。
 
     :param days_offset: The number of days to offset from today, eg 0 for today, -1 for yesterday.
-    :return: A list of FitnessRecord objects.
+    :param offset: Row offset starting from 0, used when the result says more rows are available.
+    :return: The records as CSV.
     """
     if isinstance(days_offset, str):
         days_offset = int(days_offset)
+    if isinstance(offset, str):
+        offset = int(offset)
     if days_offset > 0:
         return "未来的记录无法查询"
-    if not os.path.isfile(FitnessRecord.db_loc()):
-        return "暂无记录"
-    with open(FitnessRecord.db_loc(), "r") as f:
-        reader = csv.DictReader(f)
-        prefix = (
-            datetime.datetime.now() - datetime.timedelta(days=days_offset)
-        ).strftime("%Y-%m-%d")
-        records = map(FitnessRecord.from_dict, reader)
-        records = [record for record in records if record.datetime.startswith(prefix)]
+    rows = await asyncio.to_thread(FitnessRecord.store().read_rows)
+    prefix = (datetime.datetime.now() + datetime.timedelta(days=days_offset)).strftime(
+        "%Y-%m-%d"
+    )
+    records = map(FitnessRecord.from_dict, rows)
+    records = [record for record in records if record.datetime.startswith(prefix)]
     if not records:
         return "暂无记录"
-    return "\n".join(map(str, records))
+    header = [f"时间({prefix})", "运动", "时长", "备注"]
+    rows = [[x.datetime[11:16], x.name, x.duration, x.remark] for x in records]
+    result = tool_output.table(header, rows, offset=offset)
+    tool_output.report("query_fitness_record", "\n".join(map(str, records)), result)
+    return result
 
 
 async def _local_test():
@@ -83,6 +92,4 @@ async def _local_test():
 
 
 if __name__ == "__main__":
-    import asyncio
-
     asyncio.run(_local_test())
@@ -0,0 +1,79 @@
+import asyncio
+import functools
+import logging
+import signal
+import typing as t
+
+from src import config, registry
+
+logger = logging.getLogger()
+
+DRAIN_TIMEOUT = 120  # 等待处理中的消息完成的最长时间（秒）
+
+_inflight = 0
+_idle = asyncio.Event()  # 没有处理中的消息
+_idle.set()
+_open = asyncio.Event()  # 允许处理新消息
+_open.set()
+_reload_lock = asyncio.Lock()
+
+
+def drain_guard(handler: t.Callable) -> t.Callable:
+    """
+    包装消息处理函数：重载期间新消息会等待重载完成，重载会等待处理中的消息完成。
+    """
+
+    @functools.wraps(handler)
+    async def wrapper(*args, **kwargs):
+        global _inflight
+        await _open.wait()
+        _inflight += 1
+        _idle.clear()
+        try:
+            return await handler(*args, **kwargs)
+        finally:
+            _inflight -= 1
+            if _inflight == 0:
+                _idle.set()
+
+    return wrapper
+
+
+async def reload() -> None:
+    """
+    不停机重载：先暂停接收新消息并等待处理中的消息完成，再重新加载配置和工具模块。
+    短期记忆等进程内状态不受影响。重载失败时保留旧的配置和工具。
+    """
+    if _reload_lock.locked():
+        logger.info("hot reload already in progress")
+        return
+    async with _reload_lock:
+        _open.clear()
+        try:
+            logger.info(f"hot reload: draining {_inflight} in-flight updates")
+            try:
+                await asyncio.wait_for(_idle.wait(), DRAIN_TIMEOUT)
+            except asyncio.TimeoutError:
+                logger.warning(
+                    f"hot reload: {_inflight} updates still running, reload anyway"
+                )
+            config.load()
+            registry.reload()
+            logger.info(
+                f"hot reload done, daily_diet_kcal={config.daily_diet_kcal}, "
+                f"tools={list(registry.func_map)}"
+            )
+        except Exception:
+            logger.exception("hot reload failed, keep running with old code")
+        finally:
+            _open.set()
+
+
+def install(loop: asyncio.AbstractEventLoop) -> None:
+    """注册SIGHUP处理函数"""
+
+    def on_sighup():
+        logger.info("received SIGHUP, hot reload")
+        loop.create_task(reload())
+
+    loop.add_signal_handler(signal.SIGHUP, on_sighup)
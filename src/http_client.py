@@ -0,0 +1,51 @@
+import asyncio
+import contextlib
+import logging
+import typing as t
+
+if t.TYPE_CHECKING:
+    import aiohttp
+
+logger = logging.getLogger()
+
+# 每个事件循环共用一个会话，复用连接
+_shared: t.Dict[asyncio.AbstractEventLoop, "aiohttp.ClientSession"] = {}
+
+
+def new_session() -> "aiohttp.ClientSession":
+    """创建http会话。aiohttp导入较慢，延迟到第一次发请求时再加载"""
+    import aiohttp
+
+    from src import tracing
+
+    return aiohttp.ClientSession(trace_configs=[tracing.aiohttp_trace_config()])
+
+
+def shared_session() -> "aiohttp.ClientSession":
+    """获取当前事件循环共用的http会话，连接会被复用"""
+    loop = asyncio.get_running_loop()
+    session = _shared.get(loop)
+    if session is None or session.closed:
+        session = _shared[loop] = new_session()
+    return session
+
+
+@contextlib.asynccontextmanager
+async def session() -> t.AsyncIterator["aiohttp.ClientSession"]:
+    """`async with http_client.session() as s` 使用共用会话，退出时不关闭"""
+    yield shared_session()
+
+
+async def warm_up(url: str) -> None:
+    """提前建立到url所在主机的连接，失败时忽略"""
+    try:
+        async with shared_session().head(url, allow_redirects=False) as response:
+            await response.release()
+    except Exception as e:
+        logger.info(f"warm up {url} failed: {e}")
+
+
+async def close() -> None:
+    session = _shared.pop(asyncio.get_running_loop(), None)
+    if session is not None:
+        await session.close()
@@ -0,0 +1,173 @@
+"""
+长期记忆：保存历史对话和用户告知的事实，用BM25检索和当前输入相关的记忆。
+
+中文按字的二元组（bigram）分词，英文和数字按词分词。
+倒排索引常驻内存，新增记忆时增量更新；记忆本身通过预写日志持久化。
+"""
+
+import asyncio
+import collections
+import datetime
+import logging
+import heapq
+import math
+import re
+import threading
+import time
+import typing as t
+
+from src import tenant, tracing, utils, wal
+
+logger = logging.getLogger()
+
+TOP_K = 5
+TOKEN_BUDGET = 500  # 注入到提示词中的记忆最多占用的token数
+RECENT_TURNS = 5  # 最近几轮对话已经在短期记忆中，不再检索
+K1 = 1.5
+B = 0.75
+MAX_DF_RATIO = 0.2  # 出现在超过这个比例的记忆中的词不参与检索
+
+# 对话记忆中每条都有的词
+_stop_terms = {"用户", "助手"}
+
+_fields = ["datetime", "kind", "text"]
+_word = re.compile(r"[a-z0-9]+(?:\.[0-9]+)?|[一-鿿]+")
+
+
+def tokenize(text: str) -> t.List[str]:
+    """中文字二元组 + 英文/数字单词"""
+    tokens = []
+    for m in _word.finditer(text.lower()):
+        word = m.group()
+        if "一" <= word[0] <= "鿿":
+            if len(word) == 1:
+                tokens.append(word)
+            tokens.extend(word[i : i + 2] for i in range(len(word) - 1))
+        else:
+            tokens.append(word)
+    return [x for x in tokens if x not in _stop_terms]
+
+
+class Index:
+    """增量更新的BM25倒排索引"""
+
+    def __init__(self):
+        self.docs: t.List[dict] = []
+        self.lengths: t.List[int] = []
+        self.postings: t.Dict[str, t.Dict[int, int]] = collections.defaultdict(dict)
+        self.total_len = 0
+        self.turns: t.List[int] = []  # 对话类记忆的id
+
+    def add(self, doc: dict) -> None:
+        doc_id = len(self.docs)
+        tokens = tokenize(doc["text"])
+        self.docs.append(doc)
+        self.lengths.append(len(tokens))
+        self.total_len += len(tokens)
+        for term, tf in collections.Counter(tokens).items():
+            self.postings[term][doc_id] = tf
+        if doc["kind"] == "turn":
+            self.turns.append(doc_id)
+
+    def search(self, query: str, k: int = TOP_K) -> t.List[t.Tuple[float, dict]]:
+        n = len(self.docs)
+        if not n:
+            return []
+        avg_len = self.total_len / n
+        lengths = self.lengths
+        terms = [x for x in set(tokenize(query)) if x in self.postings]
+        # 出现在大部分记忆中的词区分度很低，却要遍历很长的倒排表，直接跳过
+        max_df = n * MAX_DF_RATIO if n >= 100 else n
+        terms = [x for x in terms if len(self.postings[x]) <= max_df]
+        a = K1 * (1 - B)
+        b = K1 * B / avg_len
+        scores: t.Dict[int, float] = collections.defaultdict(float)
+        for term in terms:
+            posting = self.postings[term]
+            idf = math.log(1 + (n - len(posting) + 0.5) / (len(posting) + 0.5))
+            for doc_id, tf in posting.items():
+                scores[doc_id] += idf * tf * (K1 + 1) / (tf + a + b * lengths[doc_id])
+        for doc_id in self.turns[-RECENT_TURNS:]:
+            scores.pop(doc_id, None)
+        top = heapq.nlargest(k, scores.items(), key=lambda x: x[1])
+        return [(score, self.docs[doc_id]) for doc_id, score in top]
+
+
+# chat id -> 索引
+_indexes: t.Dict[int, Index] = {}
+_lock = threading.Lock()
+
+
+def _store() -> wal.Store:
+    return wal.store(tenant.path("long_memory.csv"), _fields)
+
+
+def _index() -> Index:
+    """当前租户的索引，第一次访问时从存储中构建"""
+    chat_id = tenant.current()
+    with _lock:
+        if chat_id not in _indexes:
+            index = Index()
+            for row in _store().read_rows():
+                index.add(row)
+            _indexes[chat_id] = index
+        return _indexes[chat_id]
+
+
+async def add(kind: str, text: str) -> None:
+    """
+    加入一条长期记忆。
+
+    :param kind: turn 表示一轮对话，fact 表示用户的事实信息
+    :param text: 记忆内容
+    """
+    doc = {
+        "datetime": datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        "kind": kind,
+        "text": text,
+    }
+    # 先构建索引再写入，避免新记忆被重复加入索引
+    index = await asyncio.to_thread(_index)
+    await _store().append(doc)
+    with _lock:
+        index.add(doc)
+
+
+async def add_turn(user_text: str, resp: str) -> None:
+    await add("turn", f"用户: {user_text}\n助手: {resp}")
+
+
+def _recall(query: str, k: int, budget: int) -> t.List[str]:
+    begin = time.perf_counter()
+    index = _index()
+    with _lock:
+        results = index.search(query, k)
+    lines, used = [], 0
+    for _, doc in results:
+        line = f"- [{doc['datetime']}] {doc['text']}"
+        tokens = utils.estimate_tokens(line)
+        if used + tokens > budget:
+            continue
+        lines.append(line)
+        used += tokens
+    cost = (time.perf_counter() - begin) * 1000
+    logger.info(
+        f"long memory: {len(lines)}/{len(index.docs)} memories, ~{used} tokens, {cost:.2f}ms"
+    )
+    return lines
+
+
+async def recall(query: str, k: int = TOP_K, budget: int = TOKEN_BUDGET) -> str:
+    """
+    检索和query相关的长期记忆，结果不超过budget个token。
+
+    :return: 可以直接放入提示词的文本，没有相关记忆时为空
+    """
+    with tracing.span("long_memory recall", "memory") as sp:
+        lines = await asyncio.to_thread(_recall, query, k, budget)
+        sp.set(memories=len(lines))
+    if not lines:
+        return ""
+    return "以下是可能相关的长期记忆（较早的对话和用户告知的事实）：\n" + "\n".join(
+        lines
+    )
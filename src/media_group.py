@@ -0,0 +1,56 @@
+"""
+相册（media group）收集：Telegram把相册中的每张图片作为单独的消息发送，它们有相同的
+media_group_id。第一张图片的处理函数等待收集窗口结束，把整个相册交给一次agent运行；
+其余图片只加入相册后立即返回。
+"""
+
+import asyncio
+import time
+import typing as t
+from dataclasses import dataclass, field
+
+ALBUM_WINDOW = 1.0  # 相册最后一张图片到达后再等待的时间（秒）
+
+
+@dataclass
+class Album:
+    photos: t.List[t.Awaitable[bytes]] = field(default_factory=list)
+    captions: t.List[str] = field(default_factory=list)
+    last: float = 0.0
+
+    def add(self, photo: t.Awaitable[bytes], caption: str) -> None:
+        self.photos.append(photo)
+        if caption:
+            self.captions.append(caption)
+        self.last = time.monotonic()
+
+
+# (chat id, media group id) -> 正在收集的相册
+_albums: t.Dict[t.Tuple[int, str], Album] = {}
+
+
+async def collect(
+    chat_id: int, media_group_id: str, photo: t.Awaitable[bytes], caption: str
+) -> t.Optional[Album]:
+    """
+    把相册中的一张图片加入收集窗口。处理函数需要以非阻塞方式运行，否则等待期间收不到后续图片。
+
+    :param photo: 正在下载图片的任务
+    :return: 第一张图片的调用在窗口结束后返回整个相册，其余调用返回None
+    """
+    key = (chat_id, media_group_id)
+    album = _albums.get(key)
+    if album is not None:
+        album.add(photo, caption)
+        return None
+
+    album = _albums[key] = Album()
+    album.add(photo, caption)
+    try:
+        while True:
+            wait = album.last + ALBUM_WINDOW - time.monotonic()
+            if wait <= 0:
+                return album
+            await asyncio.sleep(wait)
+    finally:
+        del _albums[key]
@@ -1,16 +1,20 @@
 import typing as t
 
-_short_memory = []
+from src import tenant
+
+# chat id -> 短期记忆
+_short_memory: t.Dict[int, t.List[dict]] = {}
 SHORT_MEMORY_SIZE = 10
 
 
 def add_short_memory(role: str, content: t.Any):
-    """加入到短期记忆"""
-    _short_memory.append({"role": role, "content": content})
-    if len(_short_memory) > SHORT_MEMORY_SIZE:
-        _short_memory.pop(0)
+    """加入到当前租户的短期记忆"""
+    mem = _short_memory.setdefault(tenant.current(), [])
+    mem.append({"role": role, "content": content})
+    if len(mem) > SHORT_MEMORY_SIZE:
+        mem.pop(0)
 
 
-def get_short_memory():
-    """获取短期记忆"""
-    return _short_memory
+def get_short_memory() -> t.List[dict]:
+    """获取当前租户的短期记忆"""
+    return _short_memory.get(tenant.current(), [])
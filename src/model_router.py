@@ -0,0 +1,205 @@
+"""
+模型路由：在候选模型中按能力和实时统计选择模型，出错时自动切换。
+
+每个模型维护延迟、错误率和每次回答token数的指数加权移动平均（EWMA），
+得分 = 延迟 * (1 + 错误率惩罚) + token成本 + 配置顺序的偏好，得分最低的模型被选中。
+还没有成功过的模型假定延迟等于已有统计的模型的平均值，因此在有统计之前按配置的顺序选择。
+连续出错的模型会冷却一段时间；返回“不支持工具调用”的模型在进程内不再用于需要工具的请求。
+"""
+
+import logging
+import time
+import typing as t
+from dataclasses import dataclass
+
+from src import config
+
+logger = logging.getLogger()
+
+ALPHA = 0.3  # EWMA中新样本的权重
+DEFAULT_LATENCY = 5.0  # 所有模型都没有统计时假定的延迟（秒）
+ERROR_PENALTY = 4.0
+TOKEN_COST = 0.5  # 每1000个token折算成的秒数
+PRIORITY_STEP = 1.0  # 配置中每靠后一位增加的得分（秒）
+COOLDOWN = 30.0  # 第一次出错后的冷却时间（秒），连续出错时加倍
+MAX_COOLDOWN = 600.0
+
+_TOOLS_UNSUPPORTED = [
+    "The tool call is not supported",
+    "Function call is not supported for this model",
+]
+
+
+@dataclass
+class Model:
+    name: str
+    tools: bool = True  # 支持工具调用
+    batch_tools: bool = False  # 一次回答中会调用多个工具
+    vision: bool = False  # 支持图片输入
+    note: str = ""
+
+
+# 试用过的模型
+CATALOG = {
+    m.name: m
+    for m in [
+        Model(
+            "doubao-1.5-pro-32k",
+            vision=True,
+            note="成功实现图片+文本输入；tools一次用一个；多轮表现稳定",
+        ),
+        Model("qwen-max-latest", note="表现不错"),
+        Model("qwen-plus-latest", note="表现不错"),
+        Model("deepseek-chat", batch_tools=True, note="表现不错，tools支持批量调用"),
+        Model("hunyuan-turbos-latest", note="表现极差"),
+        Model(
+            "openrouter/openai/gpt-4o-2024-11-20",
+            batch_tools=True,
+            vision=True,
+            note="使用tools不积极，但提示后可用，支持批量tools",
+        ),
+        Model(
+            "openrouter/anthropic/claude-3.7-sonnet",
+            vision=True,
+            note="表现不错，tools一次用一个，很费token",
+        ),
+        Model("gemini/gemini-1.5-pro", vision=True, note="消极使用tools"),
+        Model(
+            "gemini/gemini-2.0-pro-exp-02-05",
+            vision=True,
+            note="使用tools不积极+服务不稳定",
+        ),
+        Model("gemini/gemini-2.0-flash", vision=True, note="使用tools不积极+幻觉"),
+        Model("grok-2-1212", note="使用tools不积极"),
+        Model("grok-2-vision-1212", tools=False, vision=True),
+        Model("doubao-1.5-vision-pro-32k", tools=False, vision=True),
+        Model("openrouter/qwen/qwen2.5-vl-72b-instruct", tools=False, vision=True),
+    ]
+}
+
+# 没有配置 chat_models / vision_models 时的候选，按偏好排序
+DEFAULT_CHAT_MODELS = ["doubao-1.5-pro-32k", "qwen-max-latest", "deepseek-chat"]
+DEFAULT_VISION_MODELS = [
+    "gemini/gemini-2.0-flash",
+    "openrouter/qwen/qwen2.5-vl-72b-instruct",
+    "doubao-1.5-vision-pro-32k",
+]
+
+
+@dataclass
+class Stats:
+    latency: float = 0.0  # 秒
+    error_rate: float = 0.0
+    tokens: float = 0.0  # 每次回答的token数
+    calls: int = 0
+    errors: int = 0
+    successes: int = 0
+    consecutive_errors: int = 0
+    cooldown_until: float = 0.0
+    tools_unsupported: bool = False
+
+    def score(self, priority: int, assumed_latency: float) -> float:
+        latency = self.latency if self.successes else assumed_latency
+        return (
+            latency * (1 + ERROR_PENALTY * self.error_rate)
+            + TOKEN_COST * self.tokens / 1000
+            + PRIORITY_STEP * priority
+        )
+
+
+_stats: t.Dict[str, Stats] = {}
+
+
+def _ewma(old: float, new: float, first: bool) -> float:
+    return new if first else old + ALPHA * (new - old)
+
+
+def _get(name: str) -> Stats:
+    if name not in _stats:
+        _stats[name] = Stats()
+    return _stats[name]
+
+
+def candidates(vision: bool = False) -> t.List[Model]:
+    """配置的候选模型，未知的模型按默认能力处理"""
+    if vision:
+        names = config.app.vision_models or DEFAULT_VISION_MODELS
+    else:
+        names = config.app.chat_models or DEFAULT_CHAT_MODELS
+    return [CATALOG.get(name, Model(name, vision=vision)) for name in names]
+
+
+def pick(
+    tools: bool = False,
+    vision: bool = False,
+    batch_tools: bool = False,
+    exclude: t.Collection[str] = (),
+) -> t.Optional[str]:
+    """
+    选择得分最低的可用模型。所有模型都在冷却时选择最快结束冷却的一个。
+
+    :param exclude: 本次请求中已经失败的模型
+    :return: 模型名，没有满足条件的模型时为None
+    """
+    now = time.time()
+    models = candidates(vision)
+    measured = [_get(m.name).latency for m in models if _get(m.name).successes]
+    assumed = sum(measured) / len(measured) if measured else DEFAULT_LATENCY
+    usable: t.List[t.Tuple[float, float, str]] = []
+    for priority, m in enumerate(models):
+        s = _get(m.name)
+        if m.name in exclude or (vision and not m.vision):
+            continue
+        if tools and (not m.tools or s.tools_unsupported):
+            continue
+        if batch_tools and not m.batch_tools:
+            continue
+        cooling = max(0.0, s.cooldown_until - now)
+        usable.append((cooling, s.score(priority, assumed), m.name))
+    if not usable:
+        return None
+    return min(usable)[2]
+
+
+def report_success(name: str, seconds: float, usage: dict) -> None:
+    s = _get(name)
+    s.error_rate = _ewma(s.error_rate, 0.0, s.calls == 0)
+    s.calls += 1
+    # 延迟和token数只来自成功的调用
+    first = s.successes == 0
+    s.successes += 1
+    s.latency = _ewma(s.latency, seconds, first)
+    s.tokens = _ewma(s.tokens, usage.get("total_tokens", 0), first)
+    s.consecutive_errors = 0
+    s.cooldown_until = 0.0
+
+
+def report_failure(name: str, status: int, text: str) -> None:
+    """记录一次失败；不支持工具调用的模型之后不再用于需要工具的请求"""
+    s = _get(name)
+    first = s.calls == 0
+    s.calls += 1
+    s.errors += 1
+    s.error_rate = _ewma(s.error_rate, 1.0, first)
+    if any(x in text for x in _TOOLS_UNSUPPORTED):
+        s.tools_unsupported = True
+        logger.warning(f"model router: {name} does not support tool calls")
+        return
+    s.consecutive_errors += 1
+    cooldown = min(COOLDOWN * 2 ** (s.consecutive_errors - 1), MAX_COOLDOWN)
+    s.cooldown_until = time.time() + cooldown
+    logger.warning(f"model router: {name} failed ({status}), cool down {cooldown}s")
+
+
+def stats() -> t.Dict[str, dict]:
+    return {
+        name: {
+            "latency": round(s.latency, 3),
+            "error_rate": round(s.error_rate, 3),
+            "tokens": round(s.tokens),
+            "calls": s.calls,
+            "errors": s.errors,
+        }
+        for name, s in _stats.items()
+        if s.calls
+    }
@@ -0,0 +1,173 @@
+"""
+运行中的采样分析器，供管理员的 /profile 命令使用，不需要重启进程。
+
+- 后台线程定时采样事件循环线程的调用栈，统计热点函数（自身/累计占比）
+- 事件循环中的探测任务测量调度延迟（loop lag），阻塞事件循环的代码会让它变大
+- 统计期间进程的CPU时间
+- agent的钩子上报的LLM和工具调用耗时
+
+完整的调用栈以折叠栈（collapsed stack）格式保存，可以用 https://www.speedscope.app
+或 flamegraph.pl 查看火焰图。
+"""
+
+import asyncio
+import collections
+import datetime
+import functools
+import logging
+import os
+import sys
+import threading
+import time
+import typing as t
+
+logger = logging.getLogger()
+
+INTERVAL = 0.005  # 采样间隔（秒）
+LAG_INTERVAL = 0.05  # 事件循环延迟的探测间隔（秒）
+MAX_SECONDS = 300
+PROFILE_DIR = ".cache"
+
+_active: t.Optional["Profiler"] = None
+
+
+@functools.lru_cache(maxsize=4096)
+def _short_path(filename: str) -> str:
+    """项目内的文件用相对路径，其他（标准库、第三方包）只保留文件名"""
+    try:
+        path = os.path.relpath(filename)
+    except ValueError:
+        return filename
+    return os.path.basename(filename) if path.startswith("..") else path
+
+
+def _frame_name(code: t.Any) -> str:
+    return f"{code.co_name} ({_short_path(code.co_filename)}:{code.co_firstlineno})"
+
+
+def _is_idle(leaf: str) -> bool:
+    """事件循环在等待IO"""
+    return leaf.startswith("select (selectors.py")
+
+
+class Profiler:
+    def __init__(self, thread_id: int):
+        self.thread_id = thread_id
+        self.stacks: t.Counter[t.Tuple[str, ...]] = collections.Counter()
+        self.samples = 0
+        self.idle = 0
+        self.lags: t.List[float] = []
+        self.timings: t.Dict[str, t.List[float]] = collections.defaultdict(list)
+        self.wall = 0.0
+        self.cpu = 0.0
+        self._stop = threading.Event()
+
+    def _sample(self) -> None:
+        while not self._stop.wait(INTERVAL):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                stack.append(_frame_name(frame.f_code))
+                frame = frame.f_back
+            if not stack:
+                continue
+            self.samples += 1
+            if _is_idle(stack[0]):
+                self.idle += 1
+                continue
+            self.stacks[tuple(reversed(stack))] += 1
+
+    async def _probe_lag(self) -> None:
+        while True:
+            begin = time.perf_counter()
+            await asyncio.sleep(LAG_INTERVAL)
+            self.lags.append(time.perf_counter() - begin - LAG_INTERVAL)
+
+    async def run(self, seconds: float) -> None:
+        sampler = threading.Thread(target=self._sample, daemon=True)
+        probe = asyncio.create_task(self._probe_lag())
+        wall, cpu = time.perf_counter(), time.process_time()
+        sampler.start()
+        try:
+            await asyncio.sleep(seconds)
+        finally:
+            self._stop.set()
+            probe.cancel()
+            await asyncio.to_thread(sampler.join)
+            self.wall = time.perf_counter() - wall
+            self.cpu = time.process_time() - cpu
+
+    def hot_functions(self, top: int) -> t.List[t.Tuple[str, int, int]]:
+        """返回 [(函数, 自身样本数, 累计样本数)]，按自身样本数排序"""
+        own: t.Counter[str] = collections.Counter()
+        total: t.Counter[str] = collections.Counter()
+        for stack, n in self.stacks.items():
+            own[stack[-1]] += n
+            for name in set(stack):
+                total[name] += n
+        return [(name, n, total[name]) for name, n in own.most_common(top)]
+
+    def report(self, top: int = 15) -> str:
+        lines = []
+        busy = self.samples - self.idle
+        lines.append(
+            f"采样 {self.wall:.1f}秒，{self.samples} 个样本，"
+            f"事件循环繁忙 {busy / max(self.samples, 1):.0%}"
+        )
+        lines.append(
+            f"CPU时间: {self.cpu:.2f}秒 ({self.cpu / max(self.wall, 1e-9):.0%})"
+        )
+        if self.lags:
+            lags = sorted(self.lags)
+            p99 = lags[min(len(lags) - 1, int(len(lags) * 0.99))]
+            lines.append(
+                f"事件循环延迟: 平均 {sum(lags) / len(lags) * 1000:.1f}ms，"
+                f"p99 {p99 * 1000:.1f}ms，最大 {lags[-1] * 1000:.1f}ms"
+            )
+        if self.timings:
+            lines.append("调用耗时:")
+            for name, values in sorted(self.timings.items()):
+                lines.append(
+                    f"  {name}: {len(values)}次，平均 {sum(values) / len(values):.2f}秒，"
+                    f"最大 {max(values):.2f}秒"
+                )
+        if busy:
+            lines.append("热点函数（自身% / 累计%）:")
+            for name, own, total in self.hot_functions(top):
+                lines.append(f"  {own / busy:.0%} / {total / busy:.0%}  {name}")
+        return "\n".join(lines)
+
+    def dump(self) -> str:
+        """保存折叠栈，返回文件路径"""
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        now = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+        path = os.path.join(PROFILE_DIR, f"profile_{now}.txt")
+        with open(path, "w") as f:
+            for stack, n in self.stacks.most_common():
+                f.write(f"{';'.join(stack)} {n}\n")
+        return path
+
+
+def active() -> bool:
+    return _active is not None
+
+
+def note(name: str, seconds: float) -> None:
+    """分析期间记录一次调用的耗时，没有在分析时忽略"""
+    if _active is not None:
+        _active.timings[name].append(seconds)
+
+
+async def profile(seconds: float) -> Profiler:
+    """分析当前事件循环所在的线程seconds秒，同一时间只能有一个分析"""
+    global _active
+    if _active is not None:
+        raise RuntimeError("profiler is already running")
+    prof = _active = Profiler(threading.get_ident())
+    logger.info(f"profiler: start for {seconds}s")
+    try:
+        await prof.run(min(seconds, MAX_SECONDS))
+    finally:
+        _active = None
+    logger.info(f"profiler: {prof.samples} samples")
+    return prof
@@ -0,0 +1,113 @@
+import asyncio
+import datetime
+import logging
+import time
+import typing as t
+
+import telegram
+from telegram.constants import ParseMode
+from telegram.error import BadRequest, RetryAfter, TelegramError
+
+from src import tracing
+
+logger = logging.getLogger()
+
+MIN_INTERVAL = 1.0  # 同一个chat两次发送/编辑之间的最小间隔（秒）
+CLOSE_TIMEOUT = 10.0  # 结束时等待最后一次刷新的最长时间（秒）
+
+# chat id -> 最近一次发送/编辑的时间，同一chat的多个进度消息共享限速
+_last_sent: t.Dict[int, float] = {}
+
+
+class ProgressRenderer:
+    """
+    在后台维护一条进度消息：合并频繁的更新、按chat限速、遇到RetryAfter退避，
+    结束时保证最后一次更新被刷新。调用方只追加内容，不会被Telegram请求阻塞。
+    """
+
+    def __init__(
+        self,
+        bot: telegram.Bot,
+        chat_id: int,
+        parse_mode: t.Optional[str] = ParseMode.MARKDOWN_V2,
+    ):
+        self.bot = bot
+        self.chat_id = chat_id
+        self.parse_mode = parse_mode
+        self.lines: t.List[str] = []
+        self.message: t.Optional[telegram.Message] = None
+        self._rendered = ""
+        self._dirty = asyncio.Event()
+        self._closed = False
+        self._task: t.Optional[asyncio.Task] = None
+
+    def add(self, line: str) -> None:
+        """追加一行进度，立即返回"""
+        self.lines.append(line)
+        self._dirty.set()
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def close(self) -> None:
+        """刷新最后的更新并停止后台任务"""
+        self._closed = True
+        self._dirty.set()
+        if self._task is None:
+            return
+        try:
+            await asyncio.wait_for(self._task, CLOSE_TIMEOUT)
+        except asyncio.TimeoutError:
+            logger.warning(f"progress renderer of chat {self.chat_id} flush timeout")
+        except Exception as e:
+            logger.error(f"progress renderer of chat {self.chat_id} failed: {e}")
+
+    async def _run(self) -> None:
+        while True:
+            await self._dirty.wait()
+            wait = _last_sent.get(self.chat_id, 0) + MIN_INTERVAL - time.monotonic()
+            if wait > 0:
+                # 等待期间到达的更新会合并到这一次刷新
+                await asyncio.sleep(wait)
+            self._dirty.clear()
+            await self._flush()
+            if self._closed and not self._dirty.is_set():
+                return
+
+    async def _flush(self) -> None:
+        while True:
+            # 重试时使用最新的内容
+            text = "\n".join(self.lines)
+            if text == self._rendered:
+                return
+            try:
+                with tracing.span(
+                    "progress", "telegram", edit=self.message is not None
+                ):
+                    if self.message is None:
+                        self.message = await self.bot.send_message(
+                            self.chat_id, text, parse_mode=self.parse_mode
+                        )
+                    else:
+                        await self.message.edit_text(text, parse_mode=self.parse_mode)
+                self._rendered = text
+                return
+            except RetryAfter as e:
+                delay = e.retry_after
+                if isinstance(delay, datetime.timedelta):
+                    delay = delay.total_seconds()
+                logger.warning(f"progress of chat {self.chat_id} retry after {delay}s")
+                await asyncio.sleep(delay)
+            except BadRequest as e:
+                if "not modified" in str(e):
+                    self._rendered = text
+                    return
+                if self.parse_mode and "parse entities" in str(e):
+                    self.parse_mode = None  # markdown有误时以纯文本显示
+                    continue
+                logger.error(f"progress of chat {self.chat_id} render failed: {e}")
+                return
+            except TelegramError as e:
+                logger.error(f"progress of chat {self.chat_id} render failed: {e}")
+                return
+            finally:
+                _last_sent[self.chat_id] = time.monotonic()
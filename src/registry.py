@@ -1,7 +1,9 @@
+import importlib
 import inspect
 import typing as t
 import sys
 import os
+from dataclasses import dataclass
 
 if __name__ == "__main__":
 
@@ -9,16 +11,48 @@ if __name__ == "__main__":
 
 from src.functions import diet_record, common, fitness_record
 
-_functions: t.List[t.Callable] = [
-    diet_record.add_diet_record,
-    diet_record.query_diet_record,
-    diet_record.add_food_to_database,
-    diet_record.query_food_nutrition,
-    fitness_record.add_fitness_record,
-    fitness_record.query_fitness_record,
-    common.calc,
-    common.google_search,
-]
+_modules = [diet_record, fitness_record, common]
+
+
+def _collect() -> t.List[t.Callable]:
+    return [
+        diet_record.add_diet_record,
+        diet_record.query_diet_record,
+        diet_record.add_food_to_database,
+        diet_record.query_food_nutrition,
+        fitness_record.add_fitness_record,
+        fitness_record.query_fitness_record,
+        common.calc,
+        common.google_search,
+        common.remember_fact,
+    ]
+
+
+@dataclass(frozen=True)
+class Access:
+    read_only: bool
+    resources: t.FrozenSet[str]  # 读写的数据
+
+
+# 工具读写的数据：只读工具的结果可以在一次运行内缓存，写工具执行后读取相同数据的缓存失效
+_access = {
+    "add_diet_record": Access(False, frozenset({"diet_record"})),
+    "query_diet_record": Access(True, frozenset({"diet_record"})),
+    "add_food_to_database": Access(False, frozenset({"food_db"})),
+    "query_food_nutrition": Access(True, frozenset({"food_db"})),
+    "add_fitness_record": Access(False, frozenset({"fitness_record"})),
+    "query_fitness_record": Access(True, frozenset({"fitness_record"})),
+    "calc": Access(True, frozenset()),
+    "google_search": Access(True, frozenset()),
+    "remember_fact": Access(False, frozenset({"long_memory"})),
+}
+# 没有登记的工具按写入所有数据处理
+_unknown_access = Access(False, frozenset({"*"}))
+
+
+def access(name: str) -> Access:
+    return _access.get(name, _unknown_access)
+
 
 func_map = {}
 
@@ -47,7 +81,7 @@ openai format:
     }
 }]
 """
-tool_openai_fmt = []
+_tool_openai_fmt: t.List[dict] = []
 
 
 def parse_docstring(
@@ -97,23 +131,46 @@ def parse_docstring(
     return " ".join(description).strip(), parameters, required
 
 
-def __init__():
-    for method in _functions:
+def _build_func_map() -> t.Dict[str, t.Callable]:
+    new_map = {}
+    for method in _collect():
         name = method.__name__
         if not callable(method) or not inspect.iscoroutinefunction(method):
             continue
         if name.startswith("__"):
             continue
-        if name in func_map:
+        if name in new_map:
             raise ValueError(f"重复注册: {name}")
-        func_map[name] = method
+        new_map[name] = method
+    return new_map
+
+
+def __init__():
+    func_map.update(_build_func_map())
+
+
+def reload() -> None:
+    """重新导入工具模块并替换已注册的函数，用于不停机更新"""
+    for module in _modules:
+        importlib.reload(module)
+    new_map = _build_func_map()
+    func_map.clear()
+    func_map.update(new_map)
+    _tool_openai_fmt.clear()
+
+
+def tool_openai_fmt() -> t.List[dict]:
+    """获取openai格式的工具列表，第一次调用时才解析docstring"""
+    if _tool_openai_fmt:
+        return _tool_openai_fmt
+    for name, method in func_map.items():
         # 获取函数签名
         sig = inspect.signature(method)
         docstring = method.__doc__ or ""
         description, parameters, required = parse_docstring(docstring, sig)
 
         # 解析成openai格式
-        tool_openai_fmt.append(
+        _tool_openai_fmt.append(
             {
                 "type": "function",
                 "function": {
@@ -127,6 +184,7 @@ def __init__():
                 },
             }
         )
+    return _tool_openai_fmt
 
 
 __init__()
@@ -134,5 +192,4 @@ __init__()
 if __name__ == "__main__":
     import json
 
-    print(json.dumps(tool_openai_fmt, indent=4))
-    # print(tool_openai_fmt)
+    print(json.dumps(tool_openai_fmt(), indent=4))
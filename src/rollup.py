@@ -0,0 +1,44 @@
+"""
+每日汇总的存储：每个租户一个 daily_rollup.json，日期 -> 当天的摄入和运动汇总。
+
+汇总由 scheduler 在后台计算并写入，每日总结用它对比之前几天的摄入，不需要重新读取这些天的记录。
+"""
+
+import datetime
+import json
+import os
+import typing as t
+
+from src import tenant
+
+ROLLUP_FILE = "daily_rollup.json"
+
+
+def _read(path: str) -> t.Dict[str, dict]:
+    if not os.path.isfile(path):
+        return {}
+    with open(path, "r") as f:
+        return json.load(f)
+
+
+def recent(
+    day: datetime.date, days: int, chat_id: t.Optional[int] = None
+) -> t.List[dict]:
+    """day 之前 days 天中已经汇总过的各天"""
+    rollups = _read(tenant.path(ROLLUP_FILE, chat_id))
+    keys = [
+        (day - datetime.timedelta(days=i)).strftime("%Y-%m-%d")
+        for i in range(1, days + 1)
+    ]
+    return [rollups[k] for k in keys if k in rollups]
+
+
+def save(day: datetime.date, summary: dict, chat_id: t.Optional[int] = None) -> None:
+    """写入（或覆盖）某一天的汇总，只应该在 scheduler 的线程池中调用，避免并发写入"""
+    path = tenant.path(ROLLUP_FILE, chat_id)
+    rollups = _read(path)
+    rollups[day.strftime("%Y-%m-%d")] = summary
+    tmp = path + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump(rollups, f, ensure_ascii=False, indent=1, sort_keys=True)
+    os.replace(tmp, path)
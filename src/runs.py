@@ -0,0 +1,127 @@
+"""
+按chat跟踪agent运行。
+
+- 同一chat的新消息会取消正在进行的运行（取消会中断其中的http请求），新运行等之前所有
+  被取代的运行都清理完毕后才开始，它们的写入不会交错
+- 被取消的运行尚未提交的写入会被丢弃（见 wal.Store），它的消息、图片和已完成的工具调用
+  并入新运行，不会丢失，模型也能据此修正已经写入的记录；已经解释过的图片只带上解释，
+  不会再次解释
+- 每次运行有总的时间限制，超时后取消；工具或请求自己抛出的超时不算运行超时
+"""
+
+import asyncio
+import logging
+import typing as t
+from dataclasses import dataclass, field
+
+logger = logging.getLogger()
+
+RUN_DEADLINE = 180.0  # 一次运行的最长时间（秒）
+
+DONE = "done"
+SUPERSEDED = "superseded"
+TIMEOUT = "timeout"
+
+Image = t.Union[bytes, t.Awaitable[bytes]]
+
+
+@dataclass
+class Run:
+    chat_id: int
+    text: str
+    images: t.List[Image] = field(default_factory=list)  # 尚未解释的图片
+    jpg_text: str = ""  # 已经解释过的图片内容，已经在短期记忆中
+    tool_calls: t.List[str] = field(default_factory=list)  # 已完成的工具调用
+    interrupted: t.List[str] = field(default_factory=list)  # 被取代的运行完成的工具调用
+    task: t.Optional[asyncio.Task] = None
+    # 被取代、可能仍在清理的运行，包括它们等待的运行
+    pending: t.List[asyncio.Task] = field(default_factory=list)
+    superseded: bool = False
+    timed_out: bool = False
+
+    def user_text(self) -> str:
+        """交给agent的输入，包含被取代的运行已经完成的操作"""
+        if not self.interrupted:
+            return self.text
+        done = "\n".join(f"- {x}" for x in self.interrupted)
+        return f"{self.text}\n（之前的处理被新消息打断，已经完成的操作：\n{done}\n）"
+
+    def explained(self, jpg_text: str) -> None:
+        """图片已经解释，取代这次运行时不再传递图片"""
+        self.images = []
+        self.jpg_text = "\n".join(x for x in [self.jpg_text, jpg_text] if x)
+
+
+# chat id -> 正在进行的运行
+_runs: t.Dict[int, Run] = {}
+
+
+def _supersede(prev: Run, run: Run) -> None:
+    prev.superseded = True
+    if prev.task is not None:
+        prev.task.cancel()
+    run.text = "\n".join(x for x in [prev.text, run.text] if x)
+    run.images = prev.images + run.images
+    run.jpg_text = prev.jpg_text
+    run.interrupted = prev.interrupted + prev.tool_calls
+    run.pending = [x for x in prev.pending if not x.done()]
+    if prev.task is not None:
+        run.pending.append(prev.task)
+    logger.info(f"run of chat {run.chat_id} superseded by a new message")
+
+
+def _expire(run: Run) -> None:
+    run.timed_out = True
+    assert run.task is not None
+    run.task.cancel()
+
+
+async def start(
+    chat_id: int,
+    text: str,
+    images: t.Union[Image, t.List[Image]],
+    fn: t.Callable[[Run], t.Awaitable[None]],
+    timeout: float = RUN_DEADLINE,
+) -> str:
+    """
+    在chat中运行fn，取代该chat正在进行的运行。
+
+    :return: DONE、SUPERSEDED（被之后的消息取代）或 TIMEOUT
+    """
+    if not isinstance(images, list):
+        images = [images] if images else []
+    run = Run(chat_id, text, images)
+    prev = _runs.get(chat_id)
+    if prev is not None:
+        _supersede(prev, run)
+    _runs[chat_id] = run
+
+    async def main() -> None:
+        if run.pending:
+            # 被取代的运行被取消时立即结束等待，它等待的运行可能还在清理，所以等待整条链
+            await asyncio.wait(run.pending)
+        timer = asyncio.get_running_loop().call_later(timeout, _expire, run)
+        try:
+            await fn(run)
+        finally:
+            timer.cancel()
+
+    run.task = asyncio.create_task(main())
+    try:
+        await asyncio.wait([run.task])
+    except asyncio.CancelledError:
+        run.task.cancel()
+        raise
+    finally:
+        if _runs.get(chat_id) is run:
+            del _runs[chat_id]
+
+    if run.task.cancelled():
+        if run.timed_out and not run.superseded:
+            logger.warning(f"run of chat {chat_id} exceeded {timeout}s deadline")
+            return TIMEOUT
+        return SUPERSEDED
+    exc = run.task.exception()
+    if exc is not None:
+        raise exc
+    return DONE
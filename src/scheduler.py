@@ -0,0 +1,214 @@
+"""
+后台定时任务，不在用户请求中做聚合和维护工作。
+
+- 每天本地时间 00:05：压缩存储、预先计算前一天的汇总（见 rollup）、轮转recorder日志、清理 .cache/
+- 配置了 daily_summary_time（如 21:30）时，每天在该时间向有记录的租户推送当日摄入总结，
+  和之前几天已经存储的汇总对比；总结同时写入当天的汇总，午夜的维护再用完整的一天覆盖
+
+优先使用 Application 的 job queue（需要 python-telegram-bot[job-queue]），
+没有安装时退化为事件循环中的定时任务。耗时的文件操作在单独的线程池中执行，
+不占用处理消息时使用的默认线程池。
+"""
+
+import asyncio
+import concurrent.futures
+import datetime
+import functools
+import glob
+import logging
+import os
+import time
+import typing as t
+
+import telegram
+
+from src import config, rollup as rollups, tenant, wal
+from src.functions import diet_record, fitness_record
+
+logger = logging.getLogger()
+
+MAINTENANCE_TIME = datetime.time(0, 5)  # 每天维护的本地时间
+RECORDER_KEEP_DAYS = 14  # 轮转后的recorder日志保留天数
+CACHE_MAX_AGE_DAYS = 7  # .cache/ 中追踪、分析文件的保留天数
+CACHE_DIR = ".cache"
+SUMMARY_COMPARE_DAYS = 7  # 每日总结对比之前几天的平均摄入
+
+_pool = concurrent.futures.ThreadPoolExecutor(
+    max_workers=1, thread_name_prefix="maintenance"
+)
+_tasks: t.List[asyncio.Task] = []
+
+
+async def _in_pool(fn: t.Callable, *args: t.Any) -> t.Any:
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_pool, functools.partial(fn, *args))
+
+
+# ---------- 汇总 ----------
+
+
+def rollup(chat_id: int, day: datetime.date) -> dict:
+    """计算租户某一天的摄入和运动汇总"""
+    prefix = day.strftime("%Y-%m-%d")
+    with tenant.use(chat_id):
+        # 通过模块访问，热重载后使用新的函数
+        diet = diet_record.read_day(day)
+        fitness = [
+            x
+            for x in fitness_record.FitnessRecord.store().read_rows()
+            if x["datetime"].startswith(prefix)
+        ]
+    return {
+        "records": len(diet),
+        "energy_kj": round(sum(x.energy_kj for x in diet), 1),
+        "protein": round(sum(x.protein for x in diet), 1),
+        "fat": round(sum(x.fat for x in diet), 1),
+        "carbs": round(sum(x.carbs for x in diet), 1),
+        "fitness": len(fitness),
+    }
+
+
+def save_rollup(chat_id: int, day: datetime.date) -> dict:
+    summary = rollup(chat_id, day)
+    rollups.save(day, summary, chat_id)
+    return summary
+
+
+def rollup_all(day: datetime.date) -> None:
+    for chat_id in tenant.all_chat_ids():
+        save_rollup(chat_id, day)
+
+
+# ---------- 日志和缓存 ----------
+
+
+def rotate_recorder(day: datetime.date) -> None:
+    """把recorder日志改名为带日期的文件，删除过期的旧日志"""
+    path = os.path.join(CACHE_DIR, "recorder.csv")
+    if os.path.isfile(path):
+        os.replace(path, os.path.join(CACHE_DIR, f"recorder-{day:%Y%m%d}.csv"))
+    oldest = f"recorder-{day - datetime.timedelta(days=RECORDER_KEEP_DAYS):%Y%m%d}.csv"
+    for f in glob.glob(os.path.join(CACHE_DIR, "recorder-*.csv")):
+        if os.path.basename(f) < oldest:
+            os.remove(f)
+
+
+def prune_cache() -> None:
+    """删除过期的追踪和分析文件"""
+    deadline = time.time() - CACHE_MAX_AGE_DAYS * 86400
+    removed = 0
+    for pattern in ["trace_*.json", "profile_*.txt"]:
+        for f in glob.glob(os.path.join(CACHE_DIR, pattern)):
+            if os.path.getmtime(f) < deadline:
+                os.remove(f)
+                removed += 1
+    logger.info(f"scheduler: pruned {removed} cache files")
+
+
+# ---------- 任务 ----------
+
+
+async def maintenance() -> None:
+    """每天的维护：压缩存储、汇总前一天、轮转日志、清理缓存"""
+    begin = time.time()
+    yesterday = datetime.date.today() - datetime.timedelta(days=1)
+    await wal.compact_all()
+    await _in_pool(rollup_all, yesterday)
+    await _in_pool(rotate_recorder, yesterday)
+    await _in_pool(prune_cache)
+    logger.info(f"scheduler: maintenance done in {time.time() - begin:.2f}s")
+
+
+async def daily_summary(bot: telegram.Bot) -> None:
+    """向当天有饮食记录、仍在白名单中的租户推送摄入总结"""
+    today = datetime.date.today()
+    for chat_id in tenant.all_chat_ids():
+        if not tenant.is_allowed(chat_id):
+            continue
+        summary = await _in_pool(save_rollup, chat_id, today)
+        if not summary["records"]:
+            continue
+        kcal = summary["energy_kj"] / 4.184
+        limit = tenant.daily_diet_kcal(chat_id)
+        left = (
+            f"剩余 {limit - kcal:.0f}" if kcal <= limit else f"超出 {kcal - limit:.0f}"
+        )
+        lines = [
+            f"今日摄入 {kcal:.0f} 千卡（{summary['records']} 条记录），"
+            f"限额 {limit} 千卡，{left} 千卡",
+            f"蛋白质 {summary['protein']}g，脂肪 {summary['fat']}g，"
+            f"碳水 {summary['carbs']}g",
+        ]
+        if summary["fitness"]:
+            lines.append(f"运动 {summary['fitness']} 次")
+        past = await _in_pool(rollups.recent, today, SUMMARY_COMPARE_DAYS, chat_id)
+        past = [x for x in past if x["records"]]
+        if past:
+            avg = sum(x["energy_kj"] for x in past) / len(past) / 4.184
+            lines.append(f"之前{len(past)}天平均 {avg:.0f} 千卡")
+        try:
+            await bot.send_message(chat_id, "\n".join(lines))
+        except telegram.error.TelegramError as e:
+            logger.error(f"scheduler: send summary to {chat_id} failed: {e}")
+
+
+def _summary_time() -> t.Optional[datetime.time]:
+    if not config.app.daily_summary_time:
+        return None
+    hour, minute = config.app.daily_summary_time.split(":")
+    return datetime.time(int(hour), int(minute))
+
+
+def _local(at: datetime.time) -> datetime.time:
+    """job queue 默认按UTC解释时间，加上本地时区"""
+    return at.replace(tzinfo=datetime.datetime.now().astimezone().tzinfo)
+
+
+async def _run_safely(name: str, job: t.Callable[[], t.Awaitable[None]]) -> None:
+    try:
+        await job()
+    except Exception:
+        logger.exception(f"scheduler: {name} failed")
+
+
+async def _daily(name: str, at: datetime.time, job: t.Callable) -> None:
+    """没有job queue时使用：每天在本地时间at运行job"""
+    while True:
+        now = datetime.datetime.now()
+        next_run = datetime.datetime.combine(now.date(), at)
+        if next_run <= now:
+            next_run += datetime.timedelta(days=1)
+        await asyncio.sleep((next_run - now).total_seconds())
+        await _run_safely(name, job)
+
+
+def install(application: t.Any) -> None:
+    """注册定时任务，在 post_init 中调用"""
+    jobs: t.List[t.Tuple[str, datetime.time, t.Callable]] = [
+        ("maintenance", MAINTENANCE_TIME, maintenance)
+    ]
+    at = _summary_time()
+    if at is not None:
+        jobs.append(("daily_summary", at, lambda: daily_summary(application.bot)))
+
+    job_queue = application.job_queue
+    for name, at, job in jobs:
+        if job_queue is not None:
+
+            async def callback(context, name=name, job=job):
+                await _run_safely(name, job)
+
+            job_queue.run_daily(callback, _local(at), name=name)
+        else:
+            _tasks.append(asyncio.create_task(_daily(name, at, job)))
+    logger.info(
+        f"scheduler: {[x[0] for x in jobs]} via "
+        + ("job queue" if job_queue is not None else "asyncio tasks")
+    )
+
+
+def shutdown() -> None:
+    for task in _tasks:
+        task.cancel()
+    _tasks.clear()
+    _pool.shutdown(wait=False)
@@ -0,0 +1,94 @@
+import asyncio
+import functools
+import inspect
+import logging
+import typing as t
+
+logger = logging.getLogger()
+
+_groups: t.Dict[str, "Group"] = {}
+
+
+def normalize(text: str) -> str:
+    """合并空白、小写，用作合并请求的键"""
+    return " ".join(str(text).split()).lower()
+
+
+class Group:
+    """
+    合并相同键的并发调用：同一时刻只有一个上游调用，其余调用等待并共享它的结果或异常。
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self._inflight: t.Dict[t.Hashable, asyncio.Task] = {}
+        self.calls = 0  # 总调用次数
+        self.upstream = 0  # 实际发起的上游调用次数
+
+    @property
+    def avoided(self) -> int:
+        return self.calls - self.upstream
+
+    async def do(self, key: t.Hashable, fn: t.Callable[[], t.Awaitable]) -> t.Any:
+        self.calls += 1
+        task = self._inflight.get(key)
+        if task is None:
+            self.upstream += 1
+            task = asyncio.create_task(fn())
+            self._inflight[key] = task
+            task.add_done_callback(functools.partial(self._done, key))
+        else:
+            logger.info(f"singleflight[{self.name}]: share in-flight call {key!r}")
+        # shield: 某个调用方被取消时不影响其他等待者
+        return await asyncio.shield(task)
+
+    def _done(self, key: t.Hashable, task: asyncio.Task) -> None:
+        if self._inflight.get(key) is task:
+            del self._inflight[key]
+        if not task.cancelled():
+            task.exception()  # 所有等待者都被取消时，避免 "exception was never retrieved"
+
+
+def group(name: str) -> Group:
+    if name not in _groups:
+        _groups[name] = Group(name)
+    return _groups[name]
+
+
+def coalesce(name: str, key: t.Callable[..., t.Hashable]) -> t.Callable:
+    """
+    装饰异步函数，参数对应的key相同的并发调用会被合并。
+
+    :param name: 分组名，用于统计
+    :param key: 根据函数参数计算合并键，参数按名字传入（agent以关键字参数调用工具）
+    """
+
+    def decorator(func: t.Callable) -> t.Callable:
+        sig = inspect.signature(func)
+        # 装饰时检查key能否以函数的参数名调用，避免到调用时才出错
+        try:
+            inspect.signature(key).bind(**{p: None for p in sig.parameters})
+        except TypeError as e:
+            raise TypeError(
+                f"singleflight key of {func.__name__} does not accept "
+                f"its parameters {list(sig.parameters)}: {e}"
+            ) from e
+
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            bound = sig.bind(*args, **kwargs)
+            bound.apply_defaults()
+            k = key(**bound.arguments)
+            return await group(name).do(k, lambda: func(*args, **kwargs))
+
+        return wrapper
+
+    return decorator
+
+
+def stats() -> t.Dict[str, t.Dict[str, int]]:
+    """各分组的调用次数、上游调用次数和被合并的次数"""
+    return {
+        name: {"calls": g.calls, "upstream": g.upstream, "avoided": g.avoided}
+        for name, g in _groups.items()
+    }
@@ -0,0 +1,98 @@
+import contextlib
+import contextvars
+import logging
+import os
+import shutil
+import typing as t
+
+from src import config
+
+logger = logging.getLogger()
+
+DATA_ROOT = ".data"
+# 多租户之前所有数据都存放在 .data/ 下，属于管理员
+_LEGACY_FILES = [
+    "diet_record.csv",
+    "fitness_record.csv",
+    "food_db.csv",
+    "daily_diet_kcal",
+]
+
+_current: contextvars.ContextVar[t.Optional[int]] = contextvars.ContextVar(
+    "tenant", default=None
+)
+_migrated = False
+
+
+def is_allowed(chat_id: int) -> bool:
+    """chat是否在白名单中，管理员总是允许"""
+    return chat_id == config.app.admin_chat_id or chat_id in config.app.allowed_chat_ids
+
+
+def current() -> int:
+    """当前处理的租户（chat id），未设置时为管理员"""
+    chat_id = _current.get()
+    return config.app.admin_chat_id if chat_id is None else chat_id
+
+
+@contextlib.contextmanager
+def use(chat_id: int) -> t.Iterator[None]:
+    """在上下文中切换当前租户，工具函数和记忆都会读写该租户的数据"""
+    token = _current.set(chat_id)
+    try:
+        yield
+    finally:
+        _current.reset(token)
+
+
+def _migrate_legacy(admin_dir: str) -> None:
+    global _migrated
+    if _migrated:
+        return
+    _migrated = True
+    for name in _LEGACY_FILES:
+        src = os.path.join(DATA_ROOT, name)
+        dst = os.path.join(admin_dir, name)
+        if os.path.isfile(src) and not os.path.exists(dst):
+            logger.info(f"migrate {src} to {dst}")
+            shutil.copy2(src, dst)
+
+
+def data_dir(chat_id: t.Optional[int] = None) -> str:
+    """租户的数据目录，每个租户的数据存放在单独的文件中，互不影响"""
+    chat_id = current() if chat_id is None else chat_id
+    path = os.path.join(DATA_ROOT, str(chat_id))
+    if not os.path.isdir(path):
+        os.makedirs(path, exist_ok=True)
+    if chat_id == config.app.admin_chat_id:
+        _migrate_legacy(path)
+    return path
+
+
+def all_chat_ids() -> t.List[int]:
+    """所有有数据目录的租户"""
+    if not os.path.isdir(DATA_ROOT):
+        return []
+    return sorted(
+        int(x)
+        for x in os.listdir(DATA_ROOT)
+        if x.lstrip("-").isdigit() and os.path.isdir(os.path.join(DATA_ROOT, x))
+    )
+
+
+def path(name: str, chat_id: t.Optional[int] = None) -> str:
+    return os.path.join(data_dir(chat_id), name)
+
+
+def daily_diet_kcal(chat_id: t.Optional[int] = None) -> int:
+    """租户的每日热量摄入限额，未设置时使用全局限额"""
+    loc = path("daily_diet_kcal", chat_id)
+    if os.path.isfile(loc):
+        with open(loc, "r") as f:
+            return int(f.read())
+    return config.daily_diet_kcal
+
+
+def set_daily_diet_kcal(kcal: int, chat_id: t.Optional[int] = None) -> None:
+    with open(path("daily_diet_kcal", chat_id), "w") as f:
+        f.write(str(kcal))
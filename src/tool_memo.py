@@ -0,0 +1,70 @@
+import asyncio
+import inspect
+import json
+import logging
+import typing as t
+
+from src import registry, singleflight
+
+logger = logging.getLogger()
+
+
+def _key(name: str, args: dict) -> t.Tuple[str, str]:
+    """工具名 + 规范化的参数：补全默认值，字符串合并空白并转小写"""
+    try:
+        bound = inspect.signature(registry.func_map[name]).bind(**args)
+        bound.apply_defaults()
+        args = dict(bound.arguments)
+    except (KeyError, TypeError):
+        pass
+    normalized = {
+        k: singleflight.normalize(v) if isinstance(v, str) else v
+        for k, v in args.items()
+    }
+    return name, json.dumps(normalized, ensure_ascii=False, sort_keys=True)
+
+
+class RunMemo:
+    """
+    一次agent运行内只读工具结果的缓存。同一运行中重复的查询直接返回之前的结果，
+    写工具执行后，读取相同数据的结果失效。失败的调用不缓存。
+    """
+
+    def __init__(self):
+        self._results: t.Dict[t.Tuple[str, str], asyncio.Future] = {}
+        self._resources: t.Dict[t.Tuple[str, str], t.FrozenSet[str]] = {}
+        self.hits = 0
+
+    async def call(
+        self, name: str, args: dict, fn: t.Callable[[], t.Awaitable[str]]
+    ) -> str:
+        acc = registry.access(name)
+        if not acc.read_only:
+            try:
+                return await fn()
+            finally:
+                self.invalidate(acc.resources)
+
+        key = _key(name, args)
+        fut = self._results.get(key)
+        if fut is not None:
+            self.hits += 1
+            logger.info(f"tool memo hit: {name} {key[1]}")
+            return await fut
+        fut = asyncio.ensure_future(fn())
+        self._results[key] = fut
+        self._resources[key] = acc.resources
+        try:
+            return await fut
+        except BaseException:
+            if self._results.get(key) is fut:
+                del self._results[key]
+                del self._resources[key]
+            raise
+
+    def invalidate(self, resources: t.FrozenSet[str]) -> None:
+        """去掉读取了这些数据的缓存，"*" 表示所有数据"""
+        for key, used in list(self._resources.items()):
+            if "*" in resources or used & resources:
+                self._results.pop(key, None)
+                del self._resources[key]
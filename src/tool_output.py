@@ -0,0 +1,88 @@
+"""
+紧凑的工具输出：记录以带表头的CSV返回，限制行数和字符数并分页，可以附加合计行。
+受字符数限制时一页的行数不固定，所以翻页用行的偏移而不是页码。
+工具的输出会进入之后每一轮的提示词，越短越省token。
+"""
+
+import csv
+import io
+import logging
+import os
+import sys
+import typing as t
+
+if __name__ == "__main__":
+    sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+
+from src import utils
+
+logger = logging.getLogger()
+
+MAX_ROWS = 30  # 每页最多的行数
+MAX_CHARS = 3000  # 每页最多的字符数
+
+stats = {"calls": 0, "tokens_saved": 0}
+
+
+def num(x: float) -> str:
+    """最多保留一位小数，去掉多余的0"""
+    text = f"{x:.1f}"
+    return text[:-2] if text.endswith(".0") else text
+
+
+def table(
+    header: t.List[str],
+    rows: t.List[t.List[t.Any]],
+    totals: t.Optional[t.List[t.Any]] = None,
+    offset: int = 0,
+) -> str:
+    """
+    :param totals: 合计行，按所有行（而不只是当前页）计算
+    :param offset: 从第几行开始，从0开始
+    """
+    start = max(offset, 0)
+    buf = io.StringIO()
+    writer = csv.writer(buf, lineterminator="\n")
+    writer.writerow(header)
+    shown = 0
+    for row in rows[start : start + MAX_ROWS]:
+        if shown and buf.tell() > MAX_CHARS:
+            break
+        writer.writerow(row)
+        shown += 1
+    if totals is not None:
+        writer.writerow(totals)
+    remain = len(rows) - start - shown
+    if remain > 0:
+        buf.write(f"（还有{remain}行，用 offset={start + shown} 查看）\n")
+    return buf.getvalue().rstrip("\n")
+
+
+def truncate(text: str, max_chars: int = MAX_CHARS) -> str:
+    if len(text) <= max_chars:
+        return text
+    return text[:max_chars] + f"…（已截断，共{len(text)}字符）"
+
+
+def report(name: str, verbose: str, compact: str) -> None:
+    """记录紧凑输出相对逐条文字描述节省的token数"""
+    saved = utils.estimate_tokens(verbose) - utils.estimate_tokens(compact)
+    stats["calls"] += 1
+    stats["tokens_saved"] += saved
+    logger.info(f"{name}: compact output saved ~{saved} tokens")
+
+
+if __name__ == "__main__":
+    # 每行约200字符，受字符数限制时每一行仍然可以翻到
+    rows = [[i, "x" * 200] for i in range(40)]
+    seen, offset = [], 0
+    while True:
+        text = table(["i", "text"], rows, offset=offset)
+        seen += [
+            int(line.split(",")[0]) for line in text.split("\n")[1:] if "," in line
+        ]
+        if "offset=" not in text:
+            break
+        offset = int(text.rsplit("offset=", 1)[1].split(" ")[0])
+    assert seen == list(range(40)), seen
+    print("ok")
@@ -0,0 +1,156 @@
+import json
+import logging
+import re
+import typing as t
+import os
+import sys
+
+if __name__ == "__main__":
+    sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+
+from src import registry, utils, tenant
+
+logger = logging.getLogger()
+
+# 意图 -> (关键词, 工具)
+_intents: t.Dict[str, t.Tuple[t.List[str], t.List[str]]] = {
+    "diet": (
+        [
+            "吃",
+            "喝",
+            "早餐",
+            "午餐",
+            "晚餐",
+            "早饭",
+            "午饭",
+            "晚饭",
+            "夜宵",
+            "零食",
+            "加餐",
+            "饮食",
+            "热量",
+            "卡路里",
+            "千卡",
+            "kcal",
+            "kj",
+        ],
+        ["add_diet_record", "query_diet_record", "query_food_nutrition"],
+    ),
+    "food_db": (
+        [
+            "食物",
+            "营养",
+            "成分",
+            "蛋白质",
+            "脂肪",
+            "碳水",
+            "每份",
+            "加入",
+            "添加",
+            "数据库",
+        ],
+        ["add_food_to_database", "query_food_nutrition"],
+    ),
+    "fitness": (
+        [
+            "运动",
+            "健身",
+            "锻炼",
+            "跑步",
+            "慢跑",
+            "游泳",
+            "骑行",
+            "走路",
+            "步",
+            "练",
+            "举重",
+            "瑜伽",
+            "分钟",
+            "小时",
+        ],
+        ["add_fitness_record", "query_fitness_record"],
+    ),
+    "calc": (
+        ["计算", "算", "多少", "总共", "合计", "一共"],
+        ["calc"],
+    ),
+    "search": (
+        ["搜索", "搜", "查一下", "天气", "新闻", "google", "谷歌"],
+        ["google_search"],
+    ),
+    "memory": (
+        [
+            "记住",
+            "记一下",
+            "别忘",
+            "我是",
+            "我的",
+            "过敏",
+            "目标",
+            "体重",
+            "减脂",
+            "增肌",
+        ],
+        ["remember_fact"],
+    ),
+}
+_has_amount = re.compile(r"\d+(\.\d+)?\s*(g|kg|ml|l|克|千克|毫升|升|份|个|碗|杯)", re.I)
+
+# chat id -> 最近几轮使用过的工具，会被粘性地保留
+_recent_tools: t.Dict[int, t.List[t.List[str]]] = {}
+RECENT_TURNS = 3
+
+stats = {"turns": 0, "fallback": 0, "tokens_saved": 0}
+
+
+def note_tool_use(names: t.Iterable[str]) -> None:
+    """记录一轮对话中使用过的工具"""
+    recent = _recent_tools.setdefault(tenant.current(), [])
+    recent.append(list(names))
+    if len(recent) > RECENT_TURNS:
+        recent.pop(0)
+
+
+def _match(text: str) -> t.List[str]:
+    text = text.lower()
+    names: t.List[str] = []
+    for keywords, tools in _intents.values():
+        if any(k in text for k in keywords):
+            names.extend(tools)
+    if _has_amount.search(text):
+        names.append("calc")
+    return names
+
+
+def select_tools(text: str) -> t.List[dict]:
+    """
+    根据用户输入和最近的工具使用情况选择本轮需要发送给模型的工具。
+    无法判断意图时返回全部工具。
+
+    :param text: 用户输入（可包含图片解释）
+    :return: openai格式的工具列表
+    """
+    full = registry.tool_openai_fmt()
+    stats["turns"] += 1
+    names = set(_match(text))
+    if not names:
+        stats["fallback"] += 1
+        logger.info("tool router: no intent matched, use all tools")
+        return full
+    for used in _recent_tools.get(tenant.current(), []):
+        names.update(used)
+
+    selected = [x for x in full if x["function"]["name"] in names]
+    saved = utils.estimate_tokens(json.dumps(full, ensure_ascii=False))
+    saved -= utils.estimate_tokens(json.dumps(selected, ensure_ascii=False))
+    stats["tokens_saved"] += saved
+    logger.info(
+        f"tool router: {sorted(names)}, saved ~{saved} tokens, total saved ~{stats['tokens_saved']}"
+    )
+    return selected
+
+
+if __name__ == "__main__":
+    for text in ["我吃了200g香蕉", "今天跑步30分钟", "你是谁", "帮我搜索一下长沙天气"]:
+        print(text, [x["function"]["name"] for x in select_tools(text)])
+    print(stats)
@@ -0,0 +1,168 @@
+"""
+按次运行的结构化追踪。
+
+每次处理消息时用 `tracing.trace(name)` 开启一个追踪，其中的 `tracing.span(name)` 记录
+耗时和属性（模型、token数、请求大小等）。结束时追踪以 Chrome trace 格式写入
+`.cache/trace_*.json`，可以在 chrome://tracing 或 https://ui.perfetto.dev 中以火焰图查看。
+没有开启追踪时 span 几乎没有开销。
+"""
+
+import asyncio
+import contextlib
+import contextvars
+import json
+import logging
+import os
+import time
+import typing as t
+
+from src import utils
+
+logger = logging.getLogger()
+
+TRACE_DIR = ".cache"
+
+_current: contextvars.ContextVar[t.Optional["Trace"]] = contextvars.ContextVar(
+    "trace", default=None
+)
+
+
+def _now_us() -> float:
+    return time.time() * 1e6
+
+
+class Trace:
+    def __init__(self, name: str):
+        self.name = name
+        self.id = utils.get_random_str(10)
+        self.events: t.List[dict] = []
+        self._tids: t.Dict[int, int] = {}
+
+    def tid(self) -> int:
+        """每个asyncio任务一条轨道，并行的工具调用不会互相重叠"""
+        task = asyncio.current_task() if _in_loop() else None
+        return self._tids.setdefault(id(task), len(self._tids) + 1)
+
+    def add(self, name: str, cat: str, begin: float, end: float, args: dict) -> None:
+        self.events.append(
+            {
+                "name": name,
+                "cat": cat,
+                "ph": "X",
+                "ts": begin,
+                "dur": end - begin,
+                "pid": os.getpid(),
+                "tid": self.tid(),
+                "args": args,
+            }
+        )
+
+    def dump(self) -> str:
+        os.makedirs(TRACE_DIR, exist_ok=True)
+        path = os.path.join(TRACE_DIR, f"trace_{self.id}_{self.name}.json")
+        with open(path, "w") as f:
+            json.dump({"traceEvents": self.events}, f, ensure_ascii=False)
+        return path
+
+
+def _in_loop() -> bool:
+    try:
+        asyncio.get_running_loop()
+        return True
+    except RuntimeError:
+        return False
+
+
+class Span:
+    """用 `with` 或 `async with` 记录一段耗时，`set()` 添加属性"""
+
+    __slots__ = ("name", "cat", "attrs", "begin", "trace")
+
+    def __init__(self, name: str, cat: str, attrs: dict):
+        self.name = name
+        self.cat = cat
+        self.attrs = attrs
+        self.begin = 0.0
+        self.trace = _current.get()
+
+    def set(self, **attrs: t.Any) -> None:
+        if self.trace is not None:
+            self.attrs.update(attrs)
+
+    def __enter__(self) -> "Span":
+        self.begin = _now_us()
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        if self.trace is None:
+            return
+        if exc_type is not None:
+            self.attrs["error"] = f"{exc_type.__name__}: {exc}"
+        self.trace.add(self.name, self.cat, self.begin, _now_us(), self.attrs)
+
+    async def __aenter__(self) -> "Span":
+        return self.__enter__()
+
+    async def __aexit__(self, exc_type, exc, tb) -> None:
+        self.__exit__(exc_type, exc, tb)
+
+
+def span(name: str, cat: str = "app", **attrs: t.Any) -> Span:
+    return Span(name, cat, attrs)
+
+
+@contextlib.contextmanager
+def trace(name: str, **attrs: t.Any) -> t.Iterator[Trace]:
+    """开启一次追踪，结束时写入文件"""
+    tr = Trace(name)
+    token = _current.set(tr)
+    try:
+        with span(name, "run", **attrs):
+            yield tr
+    finally:
+        _current.reset(token)
+        try:
+            path = tr.dump()
+            logger.info(f"trace {tr.id}: {len(tr.events)} spans written to {path}")
+        except OSError as e:
+            logger.error(f"write trace {tr.id} failed: {e}")
+
+
+def aiohttp_trace_config() -> t.Any:
+    """记录每个http请求的span：url（不含查询参数，其中可能有密钥）、状态码和收发字节数"""
+    import aiohttp
+
+    def ctx(trace_config_ctx) -> dict:
+        if not hasattr(trace_config_ctx, "span"):
+            trace_config_ctx.span = {"begin": _now_us(), "sent": 0}
+        return trace_config_ctx.span
+
+    async def on_start(session, trace_config_ctx, params):
+        ctx(trace_config_ctx)
+
+    async def on_chunk_sent(session, trace_config_ctx, params):
+        ctx(trace_config_ctx)["sent"] += len(params.chunk)
+
+    async def on_end(session, trace_config_ctx, params):
+        tr = _current.get()
+        if tr is None:
+            return
+        info = ctx(trace_config_ctx)
+        args = {
+            "method": params.method,
+            "url": str(params.url.with_query(None)),
+            "request_bytes": info["sent"],
+        }
+        if isinstance(params, aiohttp.TraceRequestEndParams):
+            args["status"] = params.response.status
+            args["response_bytes"] = params.response.content_length
+        else:
+            args["error"] = repr(params.exception)
+        tr.add(f"http {params.method}", "http", info["begin"], _now_us(), args)
+
+    config = aiohttp.TraceConfig()
+    config.on_request_start.append(on_start)
+    config.on_request_chunk_sent.append(on_chunk_sent)
+    config.on_request_end.append(on_end)
+    config.on_request_exception.append(on_end)
+    return config
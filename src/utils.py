@@ -2,6 +2,7 @@ import datetime
 import json
 import logging
 import random
+import re
 import string
 import time
 import typing as t
@@ -52,28 +53,220 @@ def init_logger(name="") -> logging.Logger:
     return logging.getLogger(name=name)
 
 
+def estimate_tokens(text: str) -> int:
+    """粗略估算token数：中日韩字符按1个token计，其余按4个字符1个token计"""
+    cjk = sum(1 for c in text if "\u2e80" <= c <= "\u9fff" or "\uff00" <= c <= "\uffef")
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+_STRING_SPECIAL = re.compile(r'["\\]')
+_JSON_START = re.compile(r"[{\[]")
+
+
+def _is_document(value: t.Any) -> bool:
+    """对象或对象的数组，说明文字中的“第[1]条”更像是其他数组"""
+    if isinstance(value, list):
+        return all(isinstance(x, dict) for x in value)
+    return isinstance(value, dict)
+
+
+class JsonExtractor:
+    """
+    增量提取文本中的第一个JSON对象或数组，可以在流式输出时逐块调用 feed。
+
+    - 跳过开头的说明文字和 ``` 代码块标记，前面的文字中有不合法的括号时从下一个括号重新开始
+    - 不是对象或对象的数组的候选（如说明文字中的“第[1]条”）先保留，继续查找之后的候选，
+      之后没有对象或对象的数组时才在 close 中返回它
+    - 去掉字符串之外的 // 和 /* */ 注释、对象和数组末尾多余的逗号，字符串的内容保持不变
+    - 流提前结束时 close 返回已经完整的部分，partial 为 True
+    """
+
+    def __init__(self):
+        self._text = ""  # 尚未丢弃的原始文本，从候选的开头开始
+        self._pos = 0
+        self.value: t.Any = None
+        self.done = False
+        self.partial = False
+        self._fallback: t.Optional[list] = None  # 第一个不是对象或对象的数组的候选
+        self._reset()
+
+    def _reset(self) -> None:
+        self._start = -1
+        self._out: t.List[str] = []  # 清理后的JSON片段
+        self._stack: t.List[str] = []  # 需要的右括号
+        self._string = False
+        self._escape = False
+        self._comment = ""  # "//" 或 "/*"
+        self._comma = False  # 暂存的逗号，后面是右括号时丢弃
+        # 最近一个可以截断的位置：(片段数, 需要的右括号)
+        self._safe: t.Tuple[int, t.List[str]] = (0, [])
+
+    def feed(self, chunk: str) -> t.Any:
+        """
+        :return: 第一个完整的对象或对象的数组，尚未完整时返回None
+        """
+        if not self.done:
+            self._text += chunk
+            self._scan()
+        return self.value if self.done else None
+
+    def close(self) -> t.Any:
+        """流已结束，返回完整的值或者已经完整的部分，没有找到JSON时抛出ValueError"""
+        while not self.done and self._start >= 0:
+            value = self._truncated()
+            if value is not None and (self._fallback is None or _is_document(value)):
+                self.value, self.done, self.partial = value, True, True
+                break
+            self._restart()
+            self._scan()
+        if not self.done and self._fallback is not None:
+            self.value, self.done = self._fallback, True
+        if not self.done:
+            raise ValueError("No JSON found")
+        return self.value
+
+    def _restart(self) -> None:
+        """当前候选不是合法的JSON，从它之后的下一个括号重新开始"""
+        self._text = self._text[self._start + 1 :]
+        self._pos = 0
+        self._reset()
+
+    def _truncated(self) -> t.Any:
+        candidates = []
+        out = "".join(self._out)
+        if self._string:
+            if self._escape:
+                out = out[:-1]
+            out += '"'
+        candidates.append(out + "".join(reversed(self._stack)))
+        pieces, stack = self._safe
+        candidates.append("".join(self._out[:pieces]) + "".join(reversed(stack)))
+        for text in candidates:
+            try:
+                return json.loads(text, strict=False)
+            except json.JSONDecodeError:
+                pass
+        return None
+
+    def _scan(self) -> None:
+        text, i, out, stack = self._text, self._pos, self._out, self._stack
+        n = len(text)
+        while i < n:
+            if self._start < 0:
+                m = _JSON_START.search(text, i)
+                if m is None:
+                    self._text, self._pos = "", 0  # 丢弃说明文字
+                    return
+                self._start = i = m.start()
+            elif self._string:
+                if self._escape:
+                    self._escape = False
+                    out.append(text[i])
+                    i += 1
+                    continue
+                m = _STRING_SPECIAL.search(text, i)
+                if m is None:
+                    out.append(text[i:])
+                    i = n
+                    break
+                out.append(text[i : m.end()])
+                i = m.end()
+                if m.group() == "\\":
+                    self._escape = True
+                else:
+                    self._string = False
+                continue
+            elif self._comment == "//":
+                end = text.find("\n", i)
+                if end < 0:
+                    i = n
+                    break
+                self._comment, i = "", end
+                continue
+            elif self._comment == "/*":
+                end = text.find("*/", i)
+                if end < 0:
+                    i = max(i, n - 1)  # 结尾的 * 可能和下一块的 / 组成结束标记
+                    break
+                self._comment, i = "", end + 2
+                continue
+
+            c = text[i]
+            if c in " \t\r\n":
+                out.append(c)
+            elif c == "/":
+                if i + 1 >= n:
+                    break  # 等待下一块判断是否为注释
+                if text[i + 1] in "/*":
+                    self._comment = "/" + text[i + 1]
+                    i += 2
+                    continue
+                out.append(c)
+            elif c == ",":
+                if not self._comma:
+                    self._comma = True
+                    self._safe = (len(out), list(stack))
+            else:
+                if self._comma:
+                    self._comma = False
+                    if c not in "}]":
+                        out.append(",")
+                out.append(c)
+                if c == '"':
+                    self._string = True
+                elif c in "{[":
+                    stack.append("}" if c == "{" else "]")
+                    self._safe = (len(out), list(stack))
+                elif c in "}]":
+                    if c != stack.pop():
+                        self._restart()
+                        text, i, out, stack = self._text, 0, self._out, self._stack
+                        n = len(text)
+                        continue
+                    if not stack:
+                        try:
+                            value = json.loads("".join(out), strict=False)
+                        except json.JSONDecodeError:
+                            self._restart()
+                            text, i, out, stack = self._text, 0, self._out, self._stack
+                            n = len(text)
+                            continue
+                        if not _is_document(value):
+                            if self._fallback is None:
+                                self._fallback = value
+                            # 从这个候选之后继续查找
+                            self._text = text[i + 1 :]
+                            self._reset()
+                            text, i, out, stack = self._text, 0, self._out, self._stack
+                            n = len(text)
+                            continue
+                        self.value = value
+                        self.done = True
+                        self._text = ""
+                        return
+            i += 1
+        self._pos = i
+
+
 def extract_json(text: str) -> t.Any:
     """
-    Extract the JavaScript code from the text.
+    提取文本（如大模型的回复）中的第一个JSON对象或数组，有 ``` 代码块时优先使用代码块中的内容，
+    文本被截断时返回已经完整的部分并记录警告。
 
-    :param text: The text from which the JavaScript code is to be extracted.
-    :return: The JavaScript code.
+    :param text: 可以包含说明文字、代码块标记、注释和多余的逗号
+    :return: 解析后的值
     """
-    # 去掉开头的部分
-    if "```json" in text:
-        text = text.split("```json")[1]
-    elif "```" in text:
-        text = text.split("```")[1]
-
-    # 去掉结尾的部分
-    if "```" in text:
-        text = text.split("```")[0]
-
-    # 去掉每行末尾的 //
-    text = "\n".join([line.split("//")[0] for line in text.split("\n")])
-
-    try:
-        js = json.loads(text)
-        return js
-    except json.JSONDecodeError as e:
-        raise ValueError(f"Invalid JSON: {text}") from e
+    fence = text.find("```")
+    for begin in ([fence, 0] if fence > 0 else [0]):
+        extractor = JsonExtractor()
+        extractor.feed(text[begin:])
+        try:
+            value = extractor.close()
+        except ValueError:
+            continue
+        if extractor.partial:
+            logging.getLogger().warning(
+                f"extract_json: text is truncated, using the complete part: {text[-100:]}"
+            )
+        return value
+    raise ValueError(f"Invalid JSON: {text}")
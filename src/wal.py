@@ -0,0 +1,281 @@
+"""
+记录写入使用的预写日志（write-ahead log）。
+
+- 并发的写入会被合并为一次 write + fsync（group commit）
+- 日志每行为 `crc32<TAB>json`，恢复时跳过校验失败的半行
+- 日志定期压缩（追加）到主存储的CSV文件中，压缩过程可以在崩溃后重做
+
+每个CSV文件对应一个日志文件 `<csv>.wal`，读取记录时会合并两者。
+对文件的写入、压缩和读取都持有 `<csv>.lock` 上的 flock，命令行工具（如 food_import）
+可以在机器人运行时用 `Store.locked()` 独占存储，期间机器人的写入会等待。
+"""
+
+import asyncio
+import contextlib
+import csv
+import fcntl
+import json
+import logging
+import os
+import threading
+import typing as t
+import zlib
+
+logger = logging.getLogger()
+
+COMPACT_ROWS = 200  # 日志超过这么多行时压缩到CSV
+COMPACT_INTERVAL = 600  # 定期压缩的间隔（秒）
+
+T = t.TypeVar("T")
+
+_stores: t.Dict[str, "Store"] = {}
+_stores_lock = threading.Lock()
+
+
+def _encode(row: dict) -> bytes:
+    data = json.dumps(row, ensure_ascii=False, separators=(",", ":"))
+    return f"{zlib.crc32(data.encode()):08x}\t{data}\n".encode()
+
+
+def _decode(line: bytes) -> t.Optional[dict]:
+    """解析一行日志，校验失败返回None"""
+    try:
+        crc, data = line.rstrip(b"\n").split(b"\t", 1)
+        if int(crc, 16) != zlib.crc32(data):
+            return None
+        return json.loads(data)
+    except ValueError:
+        return None
+
+
+def _fsync_dir(path: str) -> None:
+    fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class Store:
+    """一个CSV文件及其预写日志"""
+
+    def __init__(self, csv_path: str, fieldnames: t.List[str]):
+        self.csv_path = csv_path
+        self.wal_path = csv_path + ".wal"
+        self.checkpoint_path = csv_path + ".wal.ckpt"
+        self.lock_path = csv_path + ".lock"
+        self.fieldnames = fieldnames
+        self.wal_rows = 0
+        self.stats = {"rows": 0, "commits": 0, "compactions": 0, "torn": 0}
+        self._pending: t.List[t.Tuple[dict, asyncio.Future]] = []
+        self._flusher: t.Optional[asyncio.Task] = None
+        self._lock = asyncio.Lock()  # 串行化日志写入和压缩
+        self._file_lock = threading.RLock()  # 读取时不能和压缩交错
+        self._lock_fd = -1
+        self._lock_depth = 0
+        self._recover()
+
+    @contextlib.contextmanager
+    def locked(self) -> t.Iterator[None]:
+        """独占存储：进程内用RLock，进程间用flock，可以重入"""
+        with self._file_lock:
+            if self._lock_depth == 0:
+                if self._lock_fd < 0:
+                    self._lock_fd = os.open(self.lock_path, os.O_RDWR | os.O_CREAT)
+                fcntl.flock(self._lock_fd, fcntl.LOCK_EX)
+            self._lock_depth += 1
+            try:
+                yield
+            finally:
+                self._lock_depth -= 1
+                if self._lock_depth == 0:
+                    fcntl.flock(self._lock_fd, fcntl.LOCK_UN)
+
+    # ---------- 写入 ----------
+
+    async def append(self, row: dict) -> None:
+        """写入一行，返回时已经落盘"""
+        fut = asyncio.get_running_loop().create_future()
+        self._pending.append((row, fut))
+        if self._flusher is None or self._flusher.done():
+            self._flusher = asyncio.create_task(self._flush_loop())
+        await fut
+
+    async def _flush_loop(self) -> None:
+        # 写入期间到达的行会在下一轮一起提交
+        while self._pending:
+            batch, self._pending = self._pending, []
+            # 调用方已经被取消（如运行被新消息取代）的写入不再提交
+            batch = [(r, fut) for r, fut in batch if not fut.cancelled()]
+            if not batch:
+                continue
+            try:
+                async with self._lock:
+                    await asyncio.to_thread(self._write, [r for r, _ in batch])
+            except Exception as e:
+                for _, fut in batch:
+                    if not fut.done():
+                        fut.set_exception(e)
+                continue
+            for _, fut in batch:
+                if not fut.done():
+                    fut.set_result(None)
+            if self.wal_rows >= COMPACT_ROWS:
+                await self.compact()
+
+    def _write(self, rows: t.List[dict]) -> None:
+        data = b"".join(_encode(row) for row in rows)
+        with self.locked(), open(self.wal_path, "ab") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        self.wal_rows += len(rows)
+        self.stats["rows"] += len(rows)
+        self.stats["commits"] += 1
+
+    # ---------- 读取 ----------
+
+    def _read_wal(self) -> t.Tuple[t.List[dict], int]:
+        """返回 (合法的行, 最后一个合法行结束的位置)"""
+        rows: t.List[dict] = []
+        end = 0
+        if not os.path.isfile(self.wal_path):
+            return rows, end
+        with open(self.wal_path, "rb") as f:
+            pos = 0
+            for line in f:
+                pos += len(line)
+                row = _decode(line) if line.endswith(b"\n") else None
+                if row is None:
+                    self.stats["torn"] += 1
+                    continue
+                rows.append(row)
+                end = pos
+        return rows, end
+
+    def read_rows(self) -> t.List[dict]:
+        """读取所有记录：CSV中的行 + 尚未压缩的日志行"""
+        with self.locked():
+            rows: t.List[dict] = []
+            if os.path.isfile(self.csv_path):
+                with open(self.csv_path, "r", newline="") as f:
+                    rows.extend(csv.DictReader(f))
+            rows.extend(self._read_wal()[0])
+            return rows
+
+    def read_with(self, read_csv: t.Callable[[str], T]) -> t.Tuple[T, t.List[dict]]:
+        """CSV部分由read_csv(csv路径)读取（如列式缓存），返回其结果和尚未压缩的日志行"""
+        with self.locked():
+            return read_csv(self.csv_path), self._read_wal()[0]
+
+    # ---------- 压缩和恢复 ----------
+
+    async def compact(self) -> None:
+        """把日志中的行追加到CSV并清空日志"""
+        async with self._lock:
+            await asyncio.to_thread(self.compact_sync)
+
+    def compact_sync(self) -> None:
+        """同步压缩，持有 locked()，可以和其他进程的写入并发"""
+        with self.locked():
+            rows, _ = self._read_wal()
+            if not rows:
+                if os.path.exists(self.wal_path):
+                    os.truncate(self.wal_path, 0)
+                self.wal_rows = 0
+                return
+            csv_size = (
+                os.path.getsize(self.csv_path) if os.path.isfile(self.csv_path) else 0
+            )
+            wal_size = os.path.getsize(self.wal_path)
+            # 先记录压缩前的状态，崩溃后可以回滚CSV并重做
+            tmp = self.checkpoint_path + ".tmp"
+            with open(tmp, "w") as f:
+                json.dump({"csv_size": csv_size, "wal_size": wal_size}, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp, self.checkpoint_path)
+            _fsync_dir(self.checkpoint_path)
+            self._apply(rows, csv_size)
+
+    def _apply(self, rows: t.List[dict], csv_size: int) -> None:
+        with open(self.csv_path, "a", newline="") as f:
+            writer = csv.DictWriter(
+                f, fieldnames=self.fieldnames, extrasaction="ignore"
+            )
+            if csv_size == 0:
+                writer.writeheader()
+            writer.writerows(rows)
+            f.flush()
+            os.fsync(f.fileno())
+        os.truncate(self.wal_path, 0)
+        os.remove(self.checkpoint_path)
+        self.wal_rows = 0
+        self.stats["compactions"] += 1
+        logger.info(f"wal: compacted {len(rows)} rows into {self.csv_path}")
+
+    def _recover(self) -> None:
+        with self.locked():
+            if os.path.isfile(self.checkpoint_path):
+                with open(self.checkpoint_path, "r") as f:
+                    ckpt = json.load(f)
+                wal_size = (
+                    os.path.getsize(self.wal_path)
+                    if os.path.isfile(self.wal_path)
+                    else 0
+                )
+                if wal_size < ckpt["wal_size"]:
+                    # 日志已经清空，说明上次压缩已完成
+                    os.remove(self.checkpoint_path)
+                else:
+                    # 回滚CSV中可能只写了一半的追加，然后重做压缩
+                    logger.warning(
+                        f"wal: redo interrupted compaction of {self.csv_path}"
+                    )
+                    if os.path.isfile(self.csv_path):
+                        os.truncate(self.csv_path, ckpt["csv_size"])
+                    rows, _ = self._read_wal()
+                    self._apply(rows, ckpt["csv_size"])
+            rows, end = self._read_wal()
+            if os.path.isfile(self.wal_path) and os.path.getsize(self.wal_path) > end:
+                # 去掉末尾的半行，避免下一次追加和它连在一起
+                logger.warning(f"wal: truncate torn tail of {self.wal_path}")
+                os.truncate(self.wal_path, end)
+            self.wal_rows = len(rows)
+
+
+def store(csv_path: str, fieldnames: t.Iterable[str]) -> Store:
+    """获取CSV文件对应的存储，首次获取时会进行崩溃恢复"""
+    with _stores_lock:
+        if csv_path not in _stores:
+            _stores[csv_path] = Store(csv_path, list(fieldnames))
+        return _stores[csv_path]
+
+
+async def compact_all() -> None:
+    """压缩所有已打开的存储"""
+    for s in list(_stores.values()):
+        await s.compact()
+
+
+async def _compact_periodically() -> None:
+    while True:
+        await asyncio.sleep(COMPACT_INTERVAL)
+        try:
+            await compact_all()
+        except Exception:
+            logger.exception("wal: periodic compaction failed")
+
+
+_compactor: t.Optional[asyncio.Task] = None
+
+
+def start_periodic_compaction() -> None:
+    """在当前事件循环中启动定期压缩"""
+    global _compactor
+    if _compactor is None or _compactor.done():
+        _compactor = asyncio.create_task(_compact_periodically())
+
+
+def stats() -> t.Dict[str, dict]:
+    return {path: dict(s.stats, wal_rows=s.wal_rows) for path, s in _stores.items()}